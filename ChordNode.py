@@ -1,43 +1,62 @@
 import socket
+import random
 import threading
-import time
 from const import *
 from utils import *
+from framing import *
 from ChordNodeReference import ChordNodeReference
 from leader_election import LeaderElection
+from runtime import NodeRuntime
+from lookup_cache import LookupCache, RoutingStats
+from membership import RingView
+from failure_detector import detector
+from scheduler import MaintenanceScheduler
 
 
 class ChordNode:
-    def __init__(self, ip: str, m: int = 160, update_replication = None):
+    def __init__(self, ip: str, m: int = 160, update_replication = None, runtime: NodeRuntime = None, election: LeaderElection = None):
         self.ip = ip
+        self.runtime = runtime or NodeRuntime()  # Event loop serving every port of this node
         self.id = getShaRepr(ip)
         self.chord_port = DEFAULT_NODE_PORT
         self.ref: ChordNodeReference = ChordNodeReference(self.ip, self.chord_port)
         self.succ: ChordNodeReference = self.ref
+        self.succ_list: list[ChordNodeReference] = [self.ref]  # Next successors in ring order, the first one is succ
         self.pred: ChordNodeReference = None
         self.predpred: ChordNodeReference = None
         self.m = m  # Number of bits in the hash/key space
         self.finger = [self.ref] * self.m  # Finger table
-        self.next = 0  # Finger table index to fix next
+        self.scheduler = MaintenanceScheduler()  # Intervals of the maintenance threads, shortened on churn
+        for task in ('stabilize', 'check_predecessor', 'leader_checker'):
+            self.scheduler.add(task, DEFAULT_MAINTENANCE_MIN, DEFAULT_MAINTENANCE_MAX)
+        self.scheduler.add('fix_fingers', DEFAULT_FIX_FINGERS_MIN, DEFAULT_FIX_FINGERS_MAX)
+        detector.add_listener(lambda ip: self.scheduler.churn())
+        self.lookup_cache = LookupCache()  # Owners resolved by lookup, dropped when the ring changes
+        self.routing = RoutingStats()      # Hops taken by lookups that were not cached
+        self.ring_view = RingView(self.ip) # Every member of the ring, for one hop lookups
 
         self.update_replication = update_replication
 
-        self.election = LeaderElection()
+        # Virtual nodes share the leader election and broadcast server of the first node of their host
+        self.primary = election is None
+        self.election = election or LeaderElection()
         
+        self.start_server()
+
         # Start threads
         threading.Thread(target=self.stabilize, daemon=True).start()              # Stabilize thread
         threading.Thread(target=self.check_predecessor, daemon=True).start()      # Check predecessor thread
-        threading.Thread(target=self.start_server, daemon=True).start()           # Server thread
-        threading.Thread(target=self.election.loop, daemon=True).start()          # Leader election thread
-        threading.Thread(target=self._leader_checker, daemon=True).start()        # Periodical leader check TEMPORAL
-        threading.Thread(target=self.start_broadcast_server, daemon=True).start() # Broadcast server thread
+        if self.primary:
+            threading.Thread(target=self.election.loop, daemon=True).start()          # Leader election thread
+            threading.Thread(target=self._leader_checker, daemon=True).start()        # Periodical leader check TEMPORAL
+            threading.Thread(target=self.start_broadcast_server, daemon=True).start() # Broadcast server thread
         threading.Thread(target=self.fix_fingers, daemon=True).start()            # Fix fingers thread
         
 
     # TEMPORAL - Periodical leader check
     def _leader_checker(self):
         while True:
-            time.sleep(10)
+            self.scheduler.wait('leader_checker')
             if self.election.leader:
                 leader_node = ChordNodeReference(self.election.leader)
                 if not leader_node.check_node():
@@ -47,49 +66,195 @@ class ChordNode:
 
     # Method to find the predecessor of a given id
     def find_pred(self, id: int) -> 'ChordNodeReference':
-        node = self
-        while not inbetween(id, node.id, node.succ.id):
-            node = node.succ
-        return node.ref if isinstance(node, ChordNode) else node
+        """Jumps through closest preceding fingers, O(log N) hops. A dead hop, a loop or too many
+        hops fall back to walking successors from the last node that answered, within the same limits"""
+        if inbetween(id, self.id, self.succ.id):
+            return self.ref
+
+        node = self._closest_alive_finger(id)
+        visited = {self.id, node.id}
+        hops = 1
+        while hops < DEFAULT_LOOKUP_MAX_HOPS:
+            try:
+                next_node, final = node.closest_preceding_finger(id)
+            except Exception:
+                return self._walk_pred(self.ref, id, {self.id}, hops)
+            if final:
+                return node
+            if next_node.id in visited:
+                break
+            visited.add(next_node.id)
+            node = next_node
+            hops += 1
+
+        return self._walk_pred(node, id, visited, hops)
+
+    # Internal method to find the predecessor of id walking successors one by one
+    def _walk_pred(self, node: 'ChordNodeReference', id: int, visited: set, hops: int) -> 'ChordNodeReference':
+        while hops < DEFAULT_LOOKUP_MAX_HOPS:
+            succ = self.succ if node.id == self.id else node.succ
+            if inbetween(id, node.id, succ.id) or succ.id in visited:
+                return node
+            visited.add(succ.id)
+            node = succ
+            hops += 1
+        print(f"[*] Predecessor of {id} not found in {hops} hops, using {node.ip}")
+        return node
+
+    # Internal method to find the closest finger preceding id that answers CHECK_NODE
+    def _closest_alive_finger(self, id: int) -> 'ChordNodeReference':
+        for i in range(len(self.finger) - 1, -1, -1):
+            if self.finger[i] and inbetween(self.finger[i].id, self.id, id) and self.finger[i].id != id:
+                if self.finger[i].check_node():
+                    return self.finger[i]
+        return self.succ
 
 
-    def lookup(self, id: int) -> 'ChordNodeReference':
+    def lookup(self, id: int, cached: bool = True) -> 'ChordNodeReference':
+        owner, _ = self.lookup_hops(id, cached)
+        return owner
+
+    def lookup_hops(self, id: int, cached: bool = True) -> tuple['ChordNodeReference', int]:
+        """Returns the owner of id and the number of nodes asked to find it"""
         if self.id == id:
-            return self.ref
+            return self.ref, 0
         # If the id is in the interval (this node's ID, its successor's ID], return the successor.
         if inbetween(id, self.id, self.succ.id):
-            return self.succ
-        
-        # Otherwise, find the closest preceding node in the finger table and ask it.
+            return self.succ, 0
+
+        # Owners resolved through the ring are cached until they expire or the ring changes
+        owner = self.lookup_cache.get(id) if cached else None
+        if owner:
+            return owner, 0
+        owner = self._one_hop_owner(id) if cached else None
+        if owner:
+            return owner, 0
+        epoch = self.lookup_cache.epoch
+        if DEFAULT_ITERATIVE_LOOKUP:
+            owner, hops = self._iterative_lookup(id)
+        else:
+            owner, hops = self._recursive_lookup(id)
+        self.lookup_cache.put(id, owner, epoch)
+        self.routing.add(hops)
+        return owner, hops
+
+    def lookup_many(self, ids: list[int]) -> dict[int, 'ChordNodeReference']:
+        """Resolves a batch of ids in one routing pass, the ids that share a next hop are sent to it in a single request"""
+        owners: dict[int, ChordNodeReference] = {}
+        groups: dict[int, tuple[ChordNodeReference, list[int]]] = {}
+        epoch = self.lookup_cache.epoch
+        for id in set(ids):
+            if self.id == id:
+                owners[id] = self.ref
+                continue
+            if inbetween(id, self.id, self.succ.id):
+                owners[id] = self.succ
+                continue
+            owner = self.lookup_cache.get(id) or self._one_hop_owner(id)
+            if owner:
+                owners[id] = owner
+                continue
+
+            hop = self._closest_alive_finger(id)
+            groups.setdefault(hop.id, (hop, []))[1].append(id)
+
+        for hop, group in groups.values():
+            resolved = hop.lookup_many(group)
+            for id in group:
+                # Ids the hop could not resolve are looked up one by one
+                owner = resolved.get(id) or self.lookup(id)
+                self.lookup_cache.put(id, owner, epoch)
+                owners[id] = owner
+        return owners
+
+    # Internal method to find the owner of id in the membership view, None if it cannot be trusted
+    def _one_hop_owner(self, id: int) -> 'ChordNodeReference':
+        if not DEFAULT_ONE_HOP:
+            return None
+        ip = self.ring_view.owner(id, self.succ.id)
+        if ip is None or detector.suspects(ip):
+            return None
+        return self.ref if ip == self.ip else ChordNodeReference(ip, self.chord_port)
+
+    def _recursive_lookup(self, id: int) -> tuple['ChordNodeReference', int]:
+        # Find the closest preceding node in the finger table and ask it.
         for i in range(len(self.finger) - 1, -1, -1):
             if self.finger[i] and inbetween(self.finger[i].id, self.id, id):
                 if self.finger[i].check_node():
-                    return self.finger[i].lookup(id)
+                    owner, hops = self.finger[i].lookup_hops(id)
+                    return owner, hops + 1
         
-        return self.succ
+        return self.succ, 0
+
+    def _iterative_lookup(self, id: int) -> tuple['ChordNodeReference', int]:
+        """Asks every hop for its closest preceding finger, so no node holds a thread waiting for the next one"""
+        node, final = self.closest_preceding_finger(id)
+        hops = 0
+        while not final:
+            if hops == DEFAULT_LOOKUP_MAX_HOPS:
+                print(f"[*] Lookup of {id} took over {hops} hops, retrying recursively")
+                return self._recursive_lookup(id)
+            hops += 1
+            try:
+                node, final = node.closest_preceding_finger(id)
+            except Exception:
+                # The hop is dead or was leaving, let the fingers that answer CHECK_NODE route it
+                owner, more = self._recursive_lookup(id)
+                return owner, hops + more
+        return node, hops
+
+    # Method to find the closest node preceding id known by this node, final if it is the successor owning id
+    def closest_preceding_finger(self, id: int) -> tuple['ChordNodeReference', bool]:
+        if inbetween(id, self.id, self.succ.id):
+            return self.succ, True
+        for i in range(len(self.finger) - 1, -1, -1):
+            if self.finger[i] and inbetween(self.finger[i].id, self.id, id) and self.finger[i].id != id:
+                return self.finger[i], False
+        return self.succ, False
+
+    # Method to call whenever successor or predecessor change, cached owners may have moved
+    def ring_changed(self):
+        self.lookup_cache.invalidate()
+        self.scheduler.churn()
 
 
 
     # Fix fingers method to periodically update the finger table
     def fix_fingers(self):
-        batch_size = 10
         while True:
-            for _ in range(batch_size):
-                try:
-                    self.next += 1
-                    if self.next >= self.m:
-                        self.next = 0
-                    self.finger[self.next] = self.lookup((self.id + 2 ** self.next) % 2 ** self.m)
-                except Exception as e:
-                    # print(f"Error in fix_fingers: {e}")
-                    pass
-            time.sleep(5)
+            self.scheduler.wait('fix_fingers')
+            # Fingers still moving keep the refresh frequent even if this node saw no churn
+            if self.rebuild_fingers():
+                self.scheduler.reset('fix_fingers')
+
+    # Method to refresh the whole finger table, returns how many entries changed
+    def rebuild_fingers(self) -> int:
+        """Looks up the start of the first entry not resolved yet, every following entry whose
+        start falls before the node found is owned by it too and is filled without another lookup"""
+        changed = 0
+        i = 0
+        while i < self.m:
+            try:
+                node = self.lookup((self.id + 2 ** i) % 2 ** self.m, cached=False)
+            except Exception as e:
+                # print(f"Error in fix_fingers: {e}")
+                i += 1
+                continue
+
+            first = i
+            while i < self.m and (i == first or inbetween((self.id + 2 ** i) % 2 ** self.m, self.id, node.id)):
+                if self.finger[i].id != node.id:
+                    changed += 1
+                self.finger[i] = node
+                i += 1
+        return changed
 
 
 
     # Method to join a Chord network using 'node' as an entry point
     def join(self, node: 'ChordNodeReference' = None):
-        self.election.adopt_leader(self.ip)
+        if self.primary:
+            self.election.adopt_leader(self.ip)
         print("[*] Joining...")
         if node:
             if not node.check_node():
@@ -97,8 +262,10 @@ class ChordNode:
             
             self.pred = None
             self.predpred = None
-            self.succ = node.lookup(self.id)
-            self.election.adopt_leader(node.get_leader())
+            # Owner of the id right after mine, the ring may still list a previous run of this node as the owner of mine
+            self.succ = node.lookup((self.id + 1) % 2 ** self.m)
+            if self.primary:
+                self.election.adopt_leader(node.get_leader())
 
             # Second node joins to chord ring
             if self.succ.succ.id == self.succ.id:
@@ -110,43 +277,93 @@ class ChordNode:
             self.succ = self.ref
             self.pred = None
             self.predpred = None
-            self.election.adopt_leader(self.ip)
+            if self.primary:
+                self.election.adopt_leader(self.ip)
+        self.ring_changed()
 
         print("[*] end join")
 
     # Stabilize method to periodically verify and update the successor and predecessor
     def stabilize(self):
         while True:
-            if self.succ.id != self.id:
-                print('[⚖] Stabilizating...')
+            self.scheduler.wait('stabilize')
+            try:
+                if self.succ.id != self.id:
+                    print('[⚖] Stabilizating...')
 
-                # Check successor is alve before stabilization
-                if self.succ.check_node():
-                    x = self.succ.pred
+                    # Check successor is alve before stabilization
+                    if self.succ.check_node():
+                        x = self.succ.pred
 
-                    if x.id != self.id:
+                        if x.id != self.id:
                         
-                        # Check is there is anyone between me and my successor
-                        if x and inbetween(x.id, self.id, self.succ.id):
-                            # Setearlo si no es el mismo
-                            if x.id != self.succ.id:
-                                self.succ = x
-                                self.update_replication(False, True, False, False)
+                            # Check is there is anyone between me and my successor
+                            if x and inbetween(x.id, self.id, self.succ.id) and x.check_node():
+                                # Setearlo si no es el mismo
+                                if x.id != self.succ.id:
+                                    self.succ = x
+                                    self.ring_changed()
+                                    self.update_replication(False, True, False, False)
                         
-                        # Notify mi successor
-                        self.succ.notify(self.ref)
+                            # Notify mi successor
+                            self.succ.notify(self.ref)
 
-                        print('[⚖] end stabilize...')
-                    else:
-                        print("[⚖] 🟢 Already stable")
+                            print('[⚖] end stabilize...')
+                        else:
+                            print("[⚖] 🟢 Already stable")
 
-                    if self.pred and self.pred.check_node():
-                        self.predpred = self.pred.pred
+                        self.refresh_successors()
+                        self.gossip()
 
-                else:
-                    print("[⚖] I lost my successor, waiting for predecesor check...")
+                        if self.pred and self.pred.check_node():
+                            self.predpred = self.pred.pred
 
-            time.sleep(10)
+                    elif not self.fail_over_successor():
+                        print("[⚖] I lost my successor, waiting for predecesor check...")
+            except Exception as e:
+                # A successor trusted by the failure detector may have just died, the next round fails over
+                print(f"[⚖] Stabilize failed: {e}")
+
+    # Method to rebuild the successor list from the one piggybacked on my successor GET_SUCCESSOR reply
+    def refresh_successors(self):
+        succ_list = [self.succ]
+        for node in self.succ.successors():
+            # The list wraps around on rings smaller than it
+            if len(succ_list) == DEFAULT_SUCCESSOR_LIST or node.id == self.id or node.id in (n.id for n in succ_list):
+                break
+            succ_list.append(node)
+        self.succ_list = succ_list
+
+    # Method to exchange membership views with my successor and a random member
+    def gossip(self):
+        self.ring_view.beat()
+        targets = {self.succ.ip}
+        members = self.ring_view.members()
+        if members:
+            targets.add(random.choice(members))
+
+        for ip in targets:
+            node = ChordNodeReference(ip, self.chord_port)
+            digest = node.gossip(self.ring_view.digest())
+            if digest:
+                self.ring_view.merge(digest)
+            elif detector.suspects(ip):
+                self.ring_view.remove(ip)
+
+    # Method to switch to the first live node of the successor list when the successor dies
+    def fail_over_successor(self) -> bool:
+        lost = self.succ
+        for i, node in enumerate(self.succ_list):
+            if node.id in (lost.id, self.id):
+                continue
+            if node.check_node():
+                print(f"[⚖] Successor {lost.ip} lost, switching to {node.ip}")
+                self.succ = node
+                self.succ_list = self.succ_list[i:]
+                self.ring_changed()
+                self.update_replication(False, True, False, False)
+                return True
+        return False
 
     # Notify method to inform the node about another node
     def notify(self, node: 'ChordNodeReference'):
@@ -157,6 +374,7 @@ class ChordNode:
             if self.pred is None:
                 self.pred = node
                 self.predpred = node.pred
+                self.ring_changed()
                 self.update_replication(False, True)
                 
             # Check node still exists
@@ -165,12 +383,14 @@ class ChordNode:
                 if inbetween(node.id, self.pred.id, self.id):
                     self.predpred = self.pred
                     self.pred = node
+                    self.ring_changed()
                     self.update_replication(True, False)
         print(f"[*] end act...")
 
     def reverse_notify(self, node: 'ChordNodeReference'):
         print(f"[*] Node {node.id} reversed notified me, acting...")
         self.succ = node
+        self.ring_changed()
         print(f"[*] end act...")
 
             
@@ -179,6 +399,7 @@ class ChordNode:
         self.succ = node
         self.pred = node
         self.predpred = self.ref
+        self.ring_changed()
         # Update replication with new successor
         self.update_replication(delegate_data=True, case_2=True)
 
@@ -188,6 +409,7 @@ class ChordNode:
     # Check predecessor method to periodically verify if the predecessor is alive
     def check_predecessor(self):
         while True:
+            self.scheduler.wait('check_predecessor')
             print("[*] Checking predecesor...")
             try:
                 if self.pred and not self.pred.check_node():
@@ -202,12 +424,15 @@ class ChordNode:
                         self.pred = self.find_pred(self.predpred.id)
                         self.predpred = self.pred.pred
                         two_in_a_row = True
+                    # Once the new predecessor is set, views resolved from here on use it
+                    self.ring_changed()
 
 
                     if self.pred.id == self.id:
                         self.succ = self.ref
                         self.pred = None
                         self.predpred = None
+                        self.ring_changed()
                         if two_in_a_row: 
                             self.update_replication(False, False, True, assume_predpred=self.ip)
                         else:
@@ -226,42 +451,64 @@ class ChordNode:
             except Exception as e:
                 self.pred = None
                 self.succ = self.ref
-
-            time.sleep(10)
-            pass
+                self.ring_changed()
 
 
 
 
-    def request_handler(self, conn: socket, addr, data: list):
+    def request_handler(self, conn: socket, frame: Frame):
         data_resp = None
-        option = int(data[0])
+        option = frame.op
+        data = frame.payload.decode('utf-8').split(',')
 
 
         if option == FIND_PREDECESSOR:
-            target_id = int(data[1])
+            target_id = int(data[0])
             data_resp = self.find_pred(target_id)
 
         elif option == LOOKUP:
-            target_id = int(data[1])
-            data_resp = self.lookup(target_id)
+            target_id = int(data[0])
+            owner, hops = self.lookup_hops(target_id)
+            send_frame(conn, OK, f'{owner.id},{owner.ip},{hops}', frame.req_id)
+            return
+
+        elif option == LOOKUP_MANY:
+            target_ids = [int(id) for id in data if id]
+            owners = self.lookup_many(target_ids)
+            send_frame(conn, OK, ','.join(owners[id].ip for id in target_ids), frame.req_id)
+            return
+
+        elif option == GOSSIP:
+            self.ring_view.merge(frame.payload.decode('utf-8'))
+            send_frame(conn, OK, self.ring_view.digest(), frame.req_id)
+            return
+
+        elif option == CLOSEST_PRECEDING_FINGER:
+            target_id = int(data[0])
+            node, final = self.closest_preceding_finger(target_id)
+            send_frame(conn, OK, f'{node.id},{node.ip},{int(final)}', frame.req_id)
+            return
 
         elif option == GET_SUCCESSOR:
-            data_resp = self.succ if self.succ else self.ref
+            # The rest of the successor list is piggybacked after the successor
+            succ = self.succ if self.succ else self.ref
+            following = ''.join(f',{node.ip}' for node in self.succ_list[1:] if succ.id != self.id)
+            send_frame(conn, OK, f'{succ.id},{succ.ip}{following}', frame.req_id)
+            return
 
         elif option == GET_PREDECESSOR:
             data_resp = self.pred if self.pred else self.ref
 
         elif option == NOTIFY:
-            ip = data[2]
+            ip = data[1]
             self.notify(ChordNodeReference(ip, self.chord_port))
 
         elif option == REVERSE_NOTIFY:
-            ip = data[2]
+            ip = data[1]
             self.reverse_notify(ChordNodeReference(ip, self.chord_port))
 
         elif option == NOT_ALONE_NOTIFY:
-            ip = data[2]
+            ip = data[1]
             self.not_alone_notify(ChordNodeReference(ip, self.chord_port))
 
         elif option == CHECK_NODE:
@@ -274,25 +521,14 @@ class ChordNode:
 
 
         # Send response
-        if data_resp:
-            response = f'{data_resp.id},{data_resp.ip}'.encode('utf-8')
-            conn.sendall(response)
-        conn.close()
+        response = f'{data_resp.id},{data_resp.ip}' if data_resp else ''
+        send_frame(conn, OK, response, frame.req_id)
 
 
 
     # Start server method to handle incoming requests
     def start_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.chord_port))
-            s.listen(10)
-
-            while True:
-                conn, addr = s.accept()
-                data = conn.recv(1024).decode('utf-8').split(',')
-
-                threading.Thread(target=self.request_handler, args=(conn, addr, data)).start()
+        self.runtime.serve(self.ip, self.chord_port, self.request_handler, nested_ops=CHORD_NESTED_OPS)
 
 
 
@@ -314,13 +550,12 @@ class ChordNode:
             if option == DISCOVER:
                 sender_ip = data[1]
                 sender_port = int(data[2])
-                response = f'{ENTRY_POINT},{self.ip}'
 
 
             # Send response
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                     s.connect((sender_ip, sender_port))
-                    s.sendall(response.encode('utf-8'))
+                    send_frame(s, ENTRY_POINT, self.ip)
             except Exception as e:
                 pass
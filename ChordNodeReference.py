@@ -1,7 +1,11 @@
-import json
 import socket
+from contextlib import contextmanager
 from const import *
 from utils import *
+from framing import *
+from codec import *
+from connection_pool import pool
+from failure_detector import detector
 
 class ChordNodeReference:
     def __init__(self, ip: str, chord_port: int = DEFAULT_NODE_PORT, data_port: int = DEFAULT_DATA_PORT):
@@ -10,34 +14,41 @@ class ChordNodeReference:
         self.chord_port = chord_port
         self.data_port = data_port
 
-    # Internal method to send data to the referenced node (this node)
-    def _send_chord_data(self, op: int, data: str = None) -> bytes:
+    # Internal method to send a request frame to the referenced node and wait its response
+    def _send_request(self, port: int, op: int, data: str = None, timeout: float = None, idempotent: bool = False) -> bytes:
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.ip, self.chord_port))
-                s.sendall(f'{op},{data}'.encode('utf-8'))
-                return s.recv(1024)
+            frame = pool.request(self.ip, port, op, data if data is not None else '', timeout, idempotent=idempotent)
+            return frame.payload
         except Exception as e:
             # print(f"Error sending data: {e}")
             return b''
 
+    # Internal method to send data to the referenced node (this node)
+    def _send_chord_data(self, op: int, data: str = None, timeout: float = None, idempotent: bool = False) -> bytes:
+        return self._send_request(self.chord_port, op, data, timeout, idempotent)
+
 
     # Method to find the predecessor of a given id
     def find_predecessor(self, id: int) -> 'ChordNodeReference':
-        response = self._send_chord_data(FIND_PREDECESSOR, str(id)).decode('utf-8').split(',')
+        response = self._send_chord_data(FIND_PREDECESSOR, str(id), idempotent=True).decode('utf-8').split(',')
         ip = response[1]
         return ChordNodeReference(ip, self.chord_port)
 
     # Property to get the successor of the current node
     @property
     def succ(self) -> 'ChordNodeReference':
-        response = self._send_chord_data(GET_SUCCESSOR).decode('utf-8').split(',')
+        response = self._send_chord_data(GET_SUCCESSOR, idempotent=True).decode('utf-8').split(',')
         return ChordNodeReference(response[1], self.chord_port)
 
+    # Method to get the successor list of the current node, its successor first
+    def successors(self) -> list['ChordNodeReference']:
+        response = self._send_chord_data(GET_SUCCESSOR, idempotent=True).decode('utf-8').split(',')
+        return [ChordNodeReference(ip, self.chord_port) for ip in response[1:] if ip]
+
     # Property to get the predecessor of the current node
     @property
     def pred(self) -> 'ChordNodeReference':
-        response = self._send_chord_data(GET_PREDECESSOR).decode('utf-8').split(',')
+        response = self._send_chord_data(GET_PREDECESSOR, idempotent=True).decode('utf-8').split(',')
         return ChordNodeReference(response[1], self.chord_port)
 
     # Method to notify the current node about another node
@@ -50,130 +61,150 @@ class ChordNodeReference:
     def not_alone_notify(self, node: 'ChordNodeReference'):
         self._send_chord_data(NOT_ALONE_NOTIFY, f'{node.id},{node.ip}')
 
-    # Method to check if the predecessor is alive
+    # Method to check if the node is alive, it is only probed if the failure detector is not sure
     def check_node(self) -> bool:
-        response = self._send_chord_data(CHECK_NODE)
+        return detector.check(self.ip, self.probe)
+
+    # Method to ask the node if it is alive
+    def probe(self) -> bool:
+        response = self._send_chord_data(CHECK_NODE, timeout=DEFAULT_PROBE_TIMEOUT, idempotent=True)
         if response != b'' and len(response.decode('utf-8')) > 0:
             # Node provide a response
             return True
+        # Drop idle connections to a node that does not answer
+        pool.close_peer(self.ip)
         return False
     
     def get_leader(self) -> str:
-        leader = self._send_chord_data(GET_LEADER).decode('utf-8').split(',')[1]
+        leader = self._send_chord_data(GET_LEADER, idempotent=True).decode('utf-8').split(',')[1]
         return leader
     
     def lookup(self, id: int):
-        response = self._send_chord_data(LOOKUP, str(id)).decode('utf-8').split(',')
-        return ChordNodeReference(response[1], self.chord_port)
+        owner, _ = self.lookup_hops(id)
+        return owner
+
+    def lookup_hops(self, id: int) -> tuple['ChordNodeReference', int]:
+        """Returns the owner of id and the number of hops the referenced node took to find it"""
+        response = self._send_chord_data(LOOKUP, str(id), idempotent=True).decode('utf-8').split(',')
+        hops = int(response[2]) if len(response) > 2 else 0
+        return ChordNodeReference(response[1], self.chord_port), hops
+
+    def lookup_many(self, ids: list[int]) -> dict[int, 'ChordNodeReference']:
+        """Returns the owner of every id the referenced node could resolve"""
+        response = self._send_chord_data(LOOKUP_MANY, ','.join(str(id) for id in ids), idempotent=True).decode('utf-8')
+        if not response:
+            return {}
+        return {id: ChordNodeReference(ip, self.chord_port) for id, ip in zip(ids, response.split(','))}
+
+    def gossip(self, digest: str) -> str:
+        """Sends the membership digest of this node, returns the one of the referenced node"""
+        return self._send_chord_data(GOSSIP, digest).decode('utf-8')
+
+    def closest_preceding_finger(self, id: int) -> tuple['ChordNodeReference', bool]:
+        """Returns the closest node preceding id known by the referenced node, final if it is the owner of id"""
+        response = self._send_chord_data(CLOSEST_PRECEDING_FINGER, str(id), idempotent=True).decode('utf-8')
+        if not response:
+            raise ConnectionError(f"{self.ip} did not answer")
+        _, ip, final = response.split(',')
+        return ChordNodeReference(ip, self.chord_port), final == '1'
     
 
 
 
     # ========================== Data Node ==============================
 
-    # Internal method to send data to the referenced node (this node)
-    def _send_data_data(self, op: int, data: str = None) -> bytes:
+    # Internal method to send a request to the data server of the referenced node, fields are encoded as negotiated with it
+    def _send_data_data(self, op: int, *fields: str, idempotent: bool = False) -> Frame:
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.ip, self.data_port))
-                s.sendall(f'{op},{data}'.encode('utf-8'))
-                return s.recv(1024)
+            flags = pool.flags(self.ip, self.data_port)
+            return pool.request(self.ip, self.data_port, op, pack_fields(list(fields), flags, ','), flags=flags, idempotent=idempotent)
         except Exception as e:
             # print(f"Error sending data: {e}")
-            return b''
+            return Frame(OK, 0, 0, b'')
     
 
     def insert_tag(self, tag: str) -> str:
         """Inserts a tag in system, if tag already exists, throw no error (works from any node)"""
-        response = self._send_data_data(INSERT_TAG, tag).decode('utf-8')
+        response = self._send_data_data(INSERT_TAG, tag).payload.decode('utf-8')
         return response
 
     def delete_tag(self, tag: str) -> str:
         """Deletes a tag from system, if tag does not exists, throw no error (works from any node)"""
-        response = self._send_data_data(DELETE_TAG, tag).decode('utf-8')
+        response = self._send_data_data(DELETE_TAG, tag).payload.decode('utf-8')
         return response
     
     def append_file(self, tag: str, file_name: str):
         """Appends file name to tag (works from any node)"""
-        response = self._send_data_data(APPEND_FILE, f"{tag},{file_name}").decode('utf-8')
+        response = self._send_data_data(APPEND_FILE, tag, file_name).payload.decode('utf-8')
         return response
     
     def remove_file(self, tag: str, file_name: str):
         """Removes file name from tag (works from any node)"""
-        response = self._send_data_data(REMOVE_FILE, f"{tag},{file_name}").decode('utf-8')
+        response = self._send_data_data(REMOVE_FILE, tag, file_name).payload.decode('utf-8')
         return response
     
     def retrieve_tag(self, tag: str) -> list[str]:
         """Retrieves files list from given tag (only works from owner node)"""
-        json_str_data = self._send_data_data(RETRIEVE_TAG, tag).decode('utf-8')
-        json_data = json.loads(json_str_data)
-        return json_data['data']
+        response = self._send_data_data(RETRIEVE_TAG, tag, idempotent=True)
+        return unpack_list(response.payload, response.flags)
     
     
     
     def insert_file(self, file_name: str) -> str:
         """Inserts a file name in system, if already exists, throw no error (works from any node)"""
-        response = self._send_data_data(INSERT_FILE, file_name).decode('utf-8')
+        response = self._send_data_data(INSERT_FILE, file_name).payload.decode('utf-8')
         return response
 
     def delete_file(self, file_name: str) -> str:
         """Deletes a file name from system, if does not exists, throw no error (works from any node)"""
-        response = self._send_data_data(DELETE_FILE, file_name).decode('utf-8')
+        response = self._send_data_data(DELETE_FILE, file_name).payload.decode('utf-8')
         return response
     
     def append_tag(self, file_name: str, tag: str):
         """Appends tag to file (works from any node)"""
-        response = self._send_data_data(APPEND_TAG, f"{file_name},{tag}").decode('utf-8')
+        response = self._send_data_data(APPEND_TAG, file_name, tag).payload.decode('utf-8')
         return response
     
     def remove_tag(self, file_name: str, tag: str):
         """Removes tag from file (works from any node)"""
-        response = self._send_data_data(REMOVE_TAG, f"{file_name},{tag}").decode('utf-8')
+        response = self._send_data_data(REMOVE_TAG, file_name, tag).payload.decode('utf-8')
         return response
 
     def retrieve_file(self, file_name: str) -> list[str]:
         """Retrieves tags list from given file name (only works from owner node)"""
-        json_str_data = self._send_data_data(RETRIEVE_FILE, file_name).decode('utf-8')
-        json_data = json.loads(json_str_data)
-        return json_data['data']
+        response = self._send_data_data(RETRIEVE_FILE, file_name, idempotent=True)
+        return unpack_list(response.payload, response.flags)
     
     def owns_file(self, file_name: str):
         """Returns '1' if node owns file name, else '0' (only works from owner node)"""
-        response = self._send_data_data(OWNS_FILE, file_name).decode('utf-8')
+        response = self._send_data_data(OWNS_FILE, file_name, idempotent=True).payload.decode('utf-8')
         return response == "1"
 
 
 
     # Must be called from owner node
-    def insert_bin(self, file_name: str, bin: bytes):
-        """Inserts binary file in system (works from any node)"""
-        response = send_bin(f"{INSERT_BIN}", file_name, bin, self.ip, self.data_port, end_msg=True)
+    def insert_bin(self, file_name: str, file_path: str):
+        """Inserts binary file stored at file_path in system (works from any node)"""
+        response = send_bin(INSERT_BIN, file_name, file_path, self.ip, self.data_port)
         return response
     
     def delete_bin(self, file_name: str):
         """Deletes binary file from system (works from any node)"""
-        response = self._send_data_data(f"{DELETE_BIN}", file_name)
+        response = self._send_data_data(DELETE_BIN, file_name).payload
         return response
 
-    def retrieve_bin(self, file_name: str):
-        """Retrieves file binary content"""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.ip, self.data_port))
-
-            s.sendall(f"{RETRIEVE_BIN},{file_name}".encode('utf-8'))
-
-            file_bin = b''
-            end_file = f"{END_FILE}".encode('utf-8')
-            while True:
-                fragment = s.recv(1024)
-                if end_file in fragment:
-                    file_bin += fragment.split(end_file)[0]
-                    break
-                else:
-                    file_bin += fragment
-                    
-            s.close()
-            return file_bin
+    @contextmanager
+    def stream_bin(self, file_name: str):
+        """Yields (sock, length), the file binary content must be read from sock before leaving"""
+        flags = pool.flags(self.ip, self.data_port)
+        with pool.connection(self.ip, self.data_port) as s:
+            send_frame(s, RETRIEVE_BIN, pack_fields([file_name], flags, ','), flags=flags)
+
+            op, _, _, length = recv_header(s)
+            if op == BUSY:
+                raise BusyError(f"{self.ip} is busy")
+
+            yield s, length
 
     # ====================================================================
 
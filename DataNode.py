@@ -1,14 +1,22 @@
+import os
+import queue
 import socket
+import tempfile
 import threading
 from const import *
 from utils import *
+from framing import *
+from codec import *
 from logger import Logger
 from database import Database
 from ChordNode import ChordNode
+from runtime import NodeRuntime
+from leader_election import LeaderElection
+from vnodes import host_of
 
 class DataNode(ChordNode):
-    def __init__(self, ip: str):
-        super().__init__(ip, update_replication=self.update_replication)
+    def __init__(self, ip: str, runtime: NodeRuntime = None, election: LeaderElection = None, warm: bool = DEFAULT_WARM_RESTART):
+        super().__init__(ip, update_replication=self.update_replication, runtime=runtime, election=election)
         self.logger = Logger(self)
         # self.ip
         # self.id
@@ -18,40 +26,54 @@ class DataNode(ChordNode):
         # self.pred
         # self.m
         self.data_port = DEFAULT_DATA_PORT
-        self.database = Database(ip)
+        self.database = Database(ip, runtime=self.runtime, warm=warm, replica_targets=self.replica_targets, replica_sources=self.replica_sources)
+        # Replica targets seen on the last stabilization round
+        self.last_replica_targets = (None, None)
+        # Replica targets resolved in a ring epoch, (epoch, targets), writes reuse them until the ring changes
+        self.cached_replica_targets = None
 
-        threading.Thread(target=self.start_data_server, daemon=True).start()
+        self.start_data_server()
         
 
 
 
     ####################### Functions to use from upper layer ############################
+    def owners(self, keys: list[str]) -> dict:
+        """Returns the owner of every tag or file name in keys, resolved in one routing pass.
+        They stay in the lookup cache, so the handlers called next for these keys do not route again"""
+        ids = {key: getShaRepr(key) for key in keys}
+        owners = self.lookup_many(list(ids.values()))
+        return {key: owners[id] for key, id in ids.items()}
+
     def tag_query(self, tags: list[str]) -> list[str]:
         """Return all files name that contain all given tags"""
         all_files_list: list[list[str]] = []
+        owners = self.owners(tags)
         for tag in tags:
-            tag_hash = getShaRepr(tag)
-            owner = self.lookup(tag_hash)
+            owner = owners[tag]
             files_list = owner.retrieve_tag(tag)
             all_files_list.append(files_list)
 
         if all_files_list == []: return []
 
-        # Intersect all lists
-        intersection = list(set.intersection(*map(set, all_files_list)))
-        return intersection
+        # Intersect all lists, starting from the shortest one and keeping its order
+        all_files_list.sort(key=len)
+        common = set(all_files_list[0])
+        for files_list in all_files_list[1:]:
+            common.intersection_update(files_list)
+            if not common: return []
+        return [file_name for file_name in all_files_list[0] if file_name in common]
 
-    def copy(self, file_name: str, bin: bytes, tags: list[str]) -> bool:
+    def copy(self, file_name: str, file_path: str, tags: list[str]) -> bool:
         """Copy a file to the system, returns False if value already exists"""
-        file_name_hash = getShaRepr(file_name)
-        file_owner = self.lookup(file_name_hash)
+        file_owner = self.owners([file_name, *tags])[file_name]
 
         # Check already exist file error
         if file_owner.owns_file(file_name):
             return False, f"A file named {file_name} already exists in the system"
 
         # Copy binary file
-        file_owner.insert_bin(file_name, bin)
+        file_owner.insert_bin(file_name, file_path)
         
         # Copy file name and tags
         self.handle_insert_file(file_name)
@@ -97,10 +119,9 @@ class DataNode(ChordNode):
     
     def add_tags(self, file_name: str, tags: list[str]) -> bool:
         """Adds tags to given file name"""
-        file_name_hash = getShaRepr(file_name)
-        file_owner = self.lookup(file_name_hash)
+        file_owner = self.owners([file_name, *tags])[file_name]
 
-        current_file_tags = self.inspect(file_name)
+        current_file_tags = set(self.inspect(file_name))
         for tag in tags:
             if tag in current_file_tags:
                 return False, f"tag ({tag}) already exists in this file"
@@ -116,10 +137,9 @@ class DataNode(ChordNode):
         return True, ""
 
     def delete_tags(self, file_name: str, tags: list[str]):
-        file_name_hash = getShaRepr(file_name)
-        file_owner = self.lookup(file_name_hash)
+        file_owner = self.owners([file_name, *tags])[file_name]
 
-        current_file_tags = self.inspect(file_name)
+        current_file_tags = set(self.inspect(file_name))
         for tag in tags:
             if tag not in current_file_tags:
                 return False, f"tag ({tag}) is not associated to this file"
@@ -136,13 +156,60 @@ class DataNode(ChordNode):
 
         return True, ""
     
-    def download(self, file_name: str) -> bytes:
-        """Returns the binary content of given file name"""
-        file_name_hash = getShaRepr(file_name)
-        file_owner = self.lookup(file_name_hash)
-
-        bin = file_owner.retrieve_bin(file_name)
-        return bin
+    def download_stream(self, files_names: list[str], window: int = DEFAULT_PREFETCH_WINDOW):
+        """Yields (file_name, length, chunks) for every file, chunks must be consumed before the next file.
+        A producer thread fetches from the owners up to window chunks ahead of the consumer"""
+        items = queue.Queue(maxsize=window)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def producer():
+            try:
+                owners = self.owners(files_names)
+                for file_name in files_names:
+                    file_owner = owners[file_name]
+                    with file_owner.stream_bin(file_name) as (s, length):
+                        if not put((file_name, length)):
+                            return
+                        for chunk in iter_payload(s, length):
+                            if not put(chunk):
+                                # Leaving mid payload, the connection must not go back to the pool
+                                raise ConnectionAbortedError("Download cancelled")
+                put(None)
+            except Exception as e:
+                put(e)
+
+        def get():
+            item = items.get()
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        def chunks(length: int):
+            remaining = length
+            while remaining > 0:
+                chunk = get()
+                remaining -= len(chunk)
+                yield chunk
+
+        threading.Thread(target=producer, daemon=True).start()
+        try:
+            while True:
+                item = get()
+                if item is None:
+                    return
+                file_name, length = item
+                yield file_name, length, chunks(length)
+        finally:
+            stop.set()
     ######################################################################################
 
 
@@ -153,7 +220,10 @@ class DataNode(ChordNode):
     def update_replication(self, delegate_data: bool = False, pull_data: bool = True, assume_data: bool = False, is_pred: bool = True, case_2: bool = False, assume_predpred: str = None):
         
         if delegate_data:
-            self.database.delegate_data(self.pred.ip, self.succ.ip, self.pred.ip, case_2)
+            # My previous predecessor bounds the range i answered for until the new one joined
+            old_pred_ip = self.predpred.ip if self.predpred else None
+            succ_ip, pred_ip = self.replica_targets()
+            self.database.delegate_data(self.pred.ip, succ_ip, pred_ip, case_2, old_pred_ip)
 
         if pull_data:
             if is_pred:
@@ -162,109 +232,166 @@ class DataNode(ChordNode):
                 self.database.pull_replication(self.succ.ip, False)
 
         if assume_data:
-            succ_ip = self.succ.ip
-            pred_ip = self.pred.ip if self.pred else None
+            succ_ip, pred_ip = self.replica_targets()
             # print(self.succ)
             # print(self.pred)
             # print(f"Se llama a asumir con succ: {succ_ip} y pred: {pred_ip}")
             self.database.assume_data(succ_ip, pred_ip, assume_predpred)
 
 
+    # Method to get the nodes that keep my replicas, my first successor and predecessor on another host.
+    # Virtual nodes of a host fail together, so siblings are skipped unless the ring has no other host within reach.
+    # Predecessors are walked remotely, so the result is kept for the ring epoch unless fresh is asked
+    def replica_targets(self, fresh: bool = False) -> tuple[str, str]:
+        epoch = self.lookup_cache.epoch
+        cached = self.cached_replica_targets
+        if not fresh and cached and cached[0] == epoch:
+            return cached[1]
+
+        host = host_of(self.ip)
+        succ_ip = next((node.ip for node in [self.succ] + self.succ_list if host_of(node.ip) != host), self.succ.ip)
+
+        pred_ip = self.pred.ip if self.pred else None
+        node = self.pred
+        try:
+            for _ in range(DEFAULT_SUCCESSOR_LIST):
+                if node is None or node.id == self.id:
+                    break
+                if host_of(node.ip) != host:
+                    pred_ip = node.ip
+                    break
+                node = (self.predpred if node is self.pred else None) or node.pred
+        except Exception:
+            # A sibling is not answering, keep my predecessor until the next round
+            pass
+        self.cached_replica_targets = (epoch, (succ_ip, pred_ip))
+        return succ_ip, pred_ip
+
+    # Method to get the nodes whose replicas i keep on one side, as (start, owner) ranges in ring order.
+    # Those are the run of nodes of one other host right before (or after) me, start is None when there is only one
+    def replica_sources(self, is_pred: bool) -> list[tuple[str, str]]:
+        host = host_of(self.ip)
+        neighbour = self.pred if is_pred else self.succ
+        if neighbour is None or neighbour.id == self.id:
+            return []
+        if host_of(neighbour.ip) == host:
+            # My neighbour replicates on another host, only a ring of one host falls back to me
+            return [(None, neighbour.ip)]
+
+        if not is_pred:
+            run = []
+            for node in [self.succ] + self.succ_list[1:]:
+                if host_of(node.ip) != host_of(neighbour.ip) or len(run) == DEFAULT_SUCCESSOR_LIST:
+                    break
+                run.append(node.ip)
+            if len(run) == 1:
+                return [(None, run[0])]
+            return list(zip([self.ip] + run[:-1], run))
+
+        run = [neighbour]
+        try:
+            start = self.predpred if self.predpred else neighbour.pred
+            while host_of(start.ip) == host_of(neighbour.ip) and start.id != self.id and len(run) < DEFAULT_SUCCESSOR_LIST:
+                run.append(start)
+                start = start.pred
+        except Exception:
+            # The run can not be walked now, pull from my predecessor alone
+            return [(None, neighbour.ip)]
+        if len(run) == 1:
+            return [(None, neighbour.ip)]
+        run.reverse()
+        return list(zip([start.ip] + [node.ip for node in run[:-1]], [node.ip for node in run]))
+
+    # Method to rebuild the successor list, telling the nodes that keep my replicas now when they are not
+    # my neighbours, those are told by the changes of membership
+    def refresh_successors(self):
+        super().refresh_successors()
+        # The successor list and the predecessors of my predecessor change without a new epoch
+        targets = self.replica_targets(fresh=True)
+        if targets == self.last_replica_targets:
+            return
+        self.last_replica_targets = targets
+        succ_ip, pred_ip = targets
+        if succ_ip != self.succ.ip:
+            self.database.send_fetch_notification(succ_ip)
+        if pred_ip and self.pred and pred_ip != self.pred.ip:
+            self.database.send_fetch_notification(pred_ip, False)
+
+
 
 
 
    
 
-    def request_data_handler(self, conn: socket.socket, addr, data: list):
+    def request_data_handler(self, conn: socket.socket, frame: Frame):
         response = None
-        option = int(data[0])
+        option = frame.op
+        data = unpack_fields(frame.payload, frame.flags, ',')
 
         # Switch operation
         if option == INSERT_TAG:
-            response = self.handle_insert_tag(data[1])
+            response = self.handle_insert_tag(data[0])
             
         elif option == DELETE_TAG:
-            response = self.handle_delete_tag(data[1])
+            response = self.handle_delete_tag(data[0])
 
         elif option == APPEND_FILE:
-            response = self.handle_append_file(data[1], data[2])
+            response = self.handle_append_file(data[0], data[1])
 
         elif option == REMOVE_FILE:
-            response = self.handle_remove_file(data[1], data[2])
+            response = self.handle_remove_file(data[0], data[1])
 
         elif option == RETRIEVE_TAG:
-            response = self.handle_retrieve_tag(data[1])
+            response = pack_list(self.handle_retrieve_tag(data[0]), frame.flags)
             
 
 
         elif option == INSERT_FILE:
-            response = self.handle_insert_file(data[1])
+            response = self.handle_insert_file(data[0])
             
         elif option == DELETE_FILE:
-            response = self.handle_delete_file(data[1])
+            response = self.handle_delete_file(data[0])
 
         elif option == APPEND_TAG:
-            response = self.handle_append_tag(data[1], data[2])
+            response = self.handle_append_tag(data[0], data[1])
 
         elif option == REMOVE_TAG:
-            response = self.handle_remove_tag(data[1], data[2])
+            response = self.handle_remove_tag(data[0], data[1])
 
         elif option == RETRIEVE_FILE:
-            response = self.handle_retrieve_file(data[1])
+            response = pack_list(self.handle_retrieve_file(data[0]), frame.flags)
 
         elif option == OWNS_FILE:
-            owns_file = self.database.owns_file(data[1])
+            owns_file = self.database.owns_file(data[0])
             response = "1" if owns_file else "0"
 
 
         elif option == INSERT_BIN:
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            conn.sendall(f"{OK}".encode('utf-8'))
+            file_name = data[0]
+            send_ack(conn, frame.req_id)
 
-            bin = b''
-            end_file = f"{END_FILE}".encode('utf-8')
-            while True:
-                fragment = conn.recv(1024)
-                if end_file in fragment:
-                    bin += fragment.split(end_file)[0]
-                    break
-                bin += fragment
+            _, _, _, length = recv_header(conn)
 
-            response = self.handle_insert_bin(file_name, bin)
-            conn.sendall(response.encode('utf-8'))
+            response = self.handle_insert_bin(file_name, conn, length)
 
 
         elif option == DELETE_BIN:
-            response = self.handle_delete_bin(data[1])
+            response = self.handle_delete_bin(data[0])
 
 
         elif option == RETRIEVE_BIN:
-            file_name = data[1]
-            file_bin = self.database.retrieve_bin(file_name)
-
-            conn.sendall(file_bin)
-            conn.sendall(f"{END_FILE}".encode('utf-8'))
+            file_name = data[0]
+            self.database.send_bin(conn, file_name, frame.req_id)
+            return
 
 
 
-        if response:
-            response = response.encode('utf-8')
-            conn.sendall(response)
-        conn.close()
+        # Responses are never compressed, only the encoding of the request is echoed
+        send_frame(conn, OK, response if response else b'', frame.req_id, frame.flags & FLAG_CODEC)
 
     
     def start_data_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.data_port))
-            s.listen(10)
-
-            while True:
-                conn, addr = s.accept()
-                data = conn.recv(1024).decode('utf-8').split(',')
-
-                threading.Thread(target=self.request_data_handler, args=(conn, addr, data)).start()
+        self.runtime.serve(self.ip, self.data_port, self.request_data_handler)
 
 
 
@@ -280,7 +407,7 @@ class DataNode(ChordNode):
             if self.database.owns_tag(tag):
                 return "OK,Tag already exists"
             else:
-                self.database.store_tag(tag, self.succ.ip, self.pred.ip if self.pred else None)
+                self.database.store_tag(tag, *self.replica_targets())
         # I am not owner, foward
         else:
             response = owner.insert_tag(tag)
@@ -294,7 +421,7 @@ class DataNode(ChordNode):
             if not self.database.owns_tag(tag):
                 return "OK,Key does not exists"
             else:
-                self.database.delete_tag(tag, self.succ.ip, self.pred.ip if self.pred else None)
+                self.database.delete_tag(tag, *self.replica_targets())
                 return "OK,Data deleted"
         # I am not owner
         else:
@@ -306,7 +433,7 @@ class DataNode(ChordNode):
         owner = self.lookup(tag_hash)
         # I am owner
         if owner.id == self.id:
-            self.database.append_file(tag, file_name, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.append_file(tag, file_name, *self.replica_targets())
             return "OK,Data appended"
         # I am not owner
         else:
@@ -319,7 +446,7 @@ class DataNode(ChordNode):
 
         # I am owner
         if owner.id == self.id:
-            self.database.remove_file(tag, file_name, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.remove_file(tag, file_name, *self.replica_targets())
             return "OK,Data removed"
         # I am not owner
         else:
@@ -339,7 +466,7 @@ class DataNode(ChordNode):
             if self.database.owns_file(file_name):
                 return "OK,File already exists"
             else:
-                self.database.store_file(file_name, self.succ.ip, self.pred.ip if self.pred else None)
+                self.database.store_file(file_name, *self.replica_targets())
                 return "OK,Data inserted"
         # I am not owner, foward
         else:
@@ -354,7 +481,7 @@ class DataNode(ChordNode):
             if not self.database.owns_file(file_name):
                 return "OK,Key does not exists"
             else:
-                self.database.delete_file(file_name, self.succ.ip, self.pred.ip if self.pred else None)
+                self.database.delete_file(file_name, *self.replica_targets())
                 return "OK,Data deleted"
         # I am not owner
         else:
@@ -366,7 +493,7 @@ class DataNode(ChordNode):
         owner = self.lookup(file_name_hash)
         # I am owner
         if owner.id == self.id:
-            self.database.append_tag(file_name, tag, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.append_tag(file_name, tag, *self.replica_targets())
             return "OK,Data appended"
         # I am not owner
         else:
@@ -379,7 +506,7 @@ class DataNode(ChordNode):
 
         # I am owner
         if owner.id == self.id:
-            self.database.remove_tag(file_name, tag, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.remove_tag(file_name, tag, *self.replica_targets())
             return "OK,Data removed"
         # I am not owner
         else:
@@ -390,17 +517,23 @@ class DataNode(ChordNode):
         return self.database.retrieve_file(file_name)
         
 
-    def handle_insert_bin(self, file_name: str, bin: bytes):
+    def handle_insert_bin(self, file_name: str, sock: socket.socket, length: int):
         file_name_hash = getShaRepr(file_name)
         owner = self.lookup(file_name_hash)
 
         # I am owner
         if owner.id == self.id:
-            self.database.store_bin(file_name, bin, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.store_bin(file_name, sock, length, *self.replica_targets())
             return "OK,Binary file inserted"
         # I am not owner
         else:
-            response = owner.insert_bin(file_name, bin)
+            fd, spool_path = tempfile.mkstemp(prefix='bin-')
+            os.close(fd)
+            try:
+                recv_bin_file(sock, length, spool_path)
+                response = owner.insert_bin(file_name, spool_path)
+            finally:
+                os.remove(spool_path)
             return response
         
     def handle_delete_bin(self, file_name: str):
@@ -409,7 +542,7 @@ class DataNode(ChordNode):
 
         # I am owner
         if owner.id == self.id:
-            self.database.delete_bin(file_name, self.succ.ip, self.pred.ip if self.pred else None)
+            self.database.delete_bin(file_name, *self.replica_targets())
             return "OK,Binary file deleted"
         # I am not owner
         else:
@@ -4,21 +4,36 @@ import sys
 import socket
 import threading
 import ipaddress
+import tempfile
 import time
 from const import *
+from framing import *
+from utils import recv_bin_file
+from codec import pack_map
+from connection_pool import pool
 from leader import Leader
 from DataNode import DataNode
 from ChordNodeReference import ChordNodeReference
 from self_discovery import SelfDiscovery
+from vnodes import vnode_name
 
 
 class QueryNode(DataNode):
-    def __init__(self, ip: str):
-        super().__init__(ip)
+    def __init__(self, ip: str, vnodes: int = DEFAULT_VNODES, warm: bool = DEFAULT_WARM_RESTART):
+        super().__init__(ip, warm=warm)
 
-        Leader(ip, self.tag_query)
+        Leader(ip, self.tag_query, runtime=self.runtime)
 
-        threading.Thread(target=self.start_query_server, daemon=True).start()
+        self.start_query_server()
+
+        # Extra virtual nodes of this host, each one owns its own ranges of the ring and replicates them
+        self.vnodes = [DataNode(vnode_name(ip, k), runtime=self.runtime, election=self.election, warm=warm) for k in range(1, vnodes)]
+
+
+    def join(self, node: ChordNodeReference = None):
+        super().join(node)
+        for vnode in self.vnodes:
+            vnode.join(node or self.ref)
 
 
 
@@ -50,29 +65,31 @@ class QueryNode(DataNode):
         leader_port = DEFAULT_LEADER_PORT
 
         # Send request
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((leader_ip, leader_port))
-            
+        flags = pool.flags(leader_ip, leader_port)
+        with pool.connection(leader_ip, leader_port) as s:
+
             # Send data
-            packed_permission_request = self._pack_permission_request(tags, files_names, query_tags)
-            s.sendall(packed_permission_request)
+            packed_permission_request = self._pack_permission_request(tags, files_names, query_tags, flags)
+            send_frame(s, REQUEST_PERMISSION, packed_permission_request, flags=flags)
 
             # Wait permission
-            permission = s.recv(1024).decode('utf-8')
-            if permission != f"{OK}":
-                raise Exception(f"No permision was send, leader sent: {permission}")
+            permission = recv_frame(s)
+            if permission.op == BUSY:
+                raise BusyError("Leader is busy")
+            if permission.op != OK:
+                raise Exception(f"No permision was send, leader sent: {permission.payload}")
             
             # Invoke callback function
             callback()
 
             # Send END of operation
-            s.sendall(f"{END}".encode('utf-8'))
+            send_frame(s, END)
 
         return True
             
 
 
-    def _query_add(self, files_names: list[str], files_bins: list[bytes], tags: list[str]):
+    def _query_add(self, files_names: list[str], files_paths: list[str], tags: list[str]):
         # ['failed']: A list of files name that failed to insert
         # ['succeded']: A list of files name that succeded
         # ['failed_msg']: A list of fail messages associated with failed index in ['failed']
@@ -84,11 +101,14 @@ class QueryNode(DataNode):
         response['msg'] = "Action completed"
 
         def callback_func():
+            # Resolve every owner at once, each copy then finds them in the lookup cache
+            self.owners([*files_names, *tags])
+
             # Copy every file into system
             for i in range(len(files_names)):
                 file_name = files_names[i]
-                file_bin = files_bins[i]
-                success, fail_msg = self.copy(file_name, file_bin, tags)
+                file_path = files_paths[i]
+                success, fail_msg = self.copy(file_name, file_path, tags)
                 if not success:
                     response['failed'].append(file_name)
                     response['failed_msg'].append(fail_msg)
@@ -204,17 +224,24 @@ class QueryNode(DataNode):
         return response
 
 
-    def _query_download(self, query_tags: list[str]):
+    def _query_download(self, query_tags: list[str], client_socket: socket.socket):
+        # Files are relayed from their owners to the client while the permission is held,
+        # the next file is fetched while the current one is still being sent
         response: dict = {}
         response['files_name'] = []
-        response['bins'] = []
 
         def callback_func():
             files_to_download = self.tag_query(query_tags)
-            for file_name in files_to_download:
+            for file_name, length, chunks in self.download_stream(files_to_download):
+                send_data(client_socket, file_name)
+                recv_ack(client_socket)
+
+                send_header(client_socket, DATA, length)
+                for chunk in chunks:
+                    client_socket.sendall(chunk)
+                recv_ack(client_socket)
+
                 response['files_name'].append(file_name)
-                bin = self.download(file_name)
-                response['bins'].append(bin)
 
         success = self._request_with_permission([], [], query_tags, callback=callback_func)
         if not success:
@@ -257,144 +284,135 @@ class QueryNode(DataNode):
 
     # Server
     def start_query_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, DEFAULT_QUERY_PORT))
-            s.listen(10)
-            
-            while True:
-                client_socket, client_address = s.accept()
-
-                threading.Thread(target=self.handle_request, args=(client_socket, client_address), daemon=True).start()
+        self.runtime.serve(self.ip, DEFAULT_QUERY_PORT, self.handle_request)
 
                 
 
-    def handle_request(self, client_socket: socket.socket, client_addr):
-        with client_socket:
-            # Receive operation
-            operation = client_socket.recv(1024).decode('utf-8')
-            
-            print(f"[*] {client_addr[0]} requested {operation}")
+    def handle_request(self, client_socket: socket.socket, frame: Frame):
+        # Receive operation
+        operation = frame.payload.decode('utf-8')
+        
+        print(f"[*] {client_socket.getpeername()[0]} requested {operation}")
+
+        # Send ACK if operation is correct
+        if operation in {'add', 'delete', 'list', 'add-tags', 'delete-tags', 'download', 'inspect-tag', 'inspect-file'}:
+            send_ack(client_socket)
+        else:
+            send_data(client_socket, f"Unrecognized operation: {operation}")
+            return
+        
+        try:
+            response = self._serve_operation(operation, client_socket)
+        except BusyError:
+            # The leader or an owner stayed busy, the client may try again later
+            send_frame(client_socket, BUSY)
+            return
+        if response is None:
+            return
+
+        response_str = json.dumps(response)
+        send_data(client_socket, response_str)
 
-            # Send ACK if operation is correct
-            if operation in {'add', 'delete', 'list', 'add-tags', 'delete-tags', 'download', 'inspect-tag', 'inspect-file'}:
-                client_socket.sendall(f"{OK}".encode('utf-8'))
-            else:
-                client_socket.sendall(f"Unrecognized operation: {operation}".encode('utf-8'))
-                return
-            
-            response = {}
 
-            if operation == 'add':
-                files_names = []
-                files_bins = []
+    # Method to serve the exchange of an operation with the client, returns its response or None if it already answered
+    def _serve_operation(self, operation: str, client_socket: socket.socket) -> dict:
+        response = {}
 
+        if operation == 'add':
+            files_names = []
+            files_paths = []    # Uploads are spooled to temp files until they are copied into the system
+
+            try:
                 while True:
-                    file_name = client_socket.recv(1024).decode('utf-8')
-                    if file_name == f"{END}":
+                    frame = recv_frame(client_socket)
+                    if frame.op == END:
                         break
+                    file_name = frame.payload.decode('utf-8')
                     
                     # Send file name received ACK
-                    client_socket.sendall(f"{OK}".encode('utf-8'))
-
-                    file_bin = b''
-                    end_file = f"{END_FILE}".encode('utf-8')
-                    while True:
-                        fragment = client_socket.recv(1024)
-                        if end_file in fragment:
-                            file_bin += fragment.split(end_file)[0]
-                            break
-                        else:
-                            file_bin += fragment
+                    send_ack(client_socket)
+
+                    fd, file_path = tempfile.mkstemp(prefix='upload-')
+                    os.close(fd)
+                    files_paths.append(file_path)
+
+                    _, _, _, length = recv_header(client_socket)
+                    recv_bin_file(client_socket, length, file_path)
                     
                     # Send file bin received ACK
-                    client_socket.sendall(f"{OK}".encode('utf-8'))
+                    send_ack(client_socket)
 
                     files_names.append(file_name)
-                    files_bins.append(file_bin)
-
-                client_socket.sendall(f"{OK}".encode('utf-8'))
-
-                tags = client_socket.recv(1024).decode('utf-8').split(';')
-
-                response = self._query_add(files_names, files_bins, tags)
-
-
-            elif operation == 'delete':
-                query_tags = client_socket.recv(1024).decode('utf-8').split(';')
-                response = self._query_delete(query_tags)
-            
 
-            elif operation == 'list':
-                query_tags = client_socket.recv(1024).decode('utf-8').split(';')
-                response = self._query_list(query_tags)
+                send_ack(client_socket)
 
+                tags = recv_data(client_socket).decode('utf-8').split(';')
 
-            elif operation == 'add-tags':
-                query_tags = client_socket.recv(1024).decode('utf-8').split(';')
-                client_socket.sendall(f"{OK}".encode('utf-8'))
+                response = self._query_add(files_names, files_paths, tags)
+            finally:
+                for file_path in files_paths:
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
 
-                tags = client_socket.recv(1024).decode('utf-8').split(';')
 
-                response = self._query_add_tags(query_tags, tags)
+        elif operation == 'delete':
+            query_tags = recv_data(client_socket).decode('utf-8').split(';')
+            response = self._query_delete(query_tags)
+        
 
+        elif operation == 'list':
+            query_tags = recv_data(client_socket).decode('utf-8').split(';')
+            response = self._query_list(query_tags)
 
-            elif operation == 'delete-tags':
-                query_tags = client_socket.recv(1024).decode('utf-8').split(';')
-                client_socket.sendall(f"{OK}".encode('utf-8'))
 
-                tags = client_socket.recv(1024).decode('utf-8').split(';')
+        elif operation == 'add-tags':
+            query_tags = recv_data(client_socket).decode('utf-8').split(';')
+            send_ack(client_socket)
 
-                response = self._query_delete_tags(query_tags, tags)
-            
+            tags = recv_data(client_socket).decode('utf-8').split(';')
 
-            elif operation == 'download':
-                query_tags = client_socket.recv(1024).decode('utf-8').split(';')
-                file_resp = self._query_download(query_tags)
-                file_names = file_resp['files_name']
-                file_bins = file_resp['bins']
+            response = self._query_add_tags(query_tags, tags)
 
-                for i in range(len(file_names)):
-                    client_socket.sendall(file_names[i].encode('utf-8'))
 
-                    ack = client_socket.recv(1024).decode('utf-8')
-                    if ack != f"{OK}": raise Exception("Negative ACK")
+        elif operation == 'delete-tags':
+            query_tags = recv_data(client_socket).decode('utf-8').split(';')
+            send_ack(client_socket)
 
-                    client_socket.sendall(file_bins[i])
-                    client_socket.sendall(f"{END_FILE}".encode('utf-8'))
+            tags = recv_data(client_socket).decode('utf-8').split(';')
 
-                    ack = client_socket.recv(1024).decode('utf-8')
-                    if ack != f"{OK}": raise Exception("Negative ACK")
+            response = self._query_delete_tags(query_tags, tags)
+        
 
-                client_socket.sendall(f"{END}".encode('utf-8'))
+        elif operation == 'download':
+            query_tags = recv_data(client_socket).decode('utf-8').split(';')
+            self._query_download(query_tags, client_socket)
 
-                # Wait for OK
-                ack = client_socket.recv(1024).decode('utf-8')
-                if ack != f"{OK}": raise Exception("Negative ACK")
-                
-                return
+            send_frame(client_socket, END)
 
+            # Wait for OK
+            recv_ack(client_socket)
+            
+            return None
 
-            elif operation == 'inspect-tag':
-                tag = client_socket.recv(1024).decode('utf-8')
-                response = self._query_inspect_tag(tag)
 
+        elif operation == 'inspect-tag':
+            tag = recv_data(client_socket).decode('utf-8')
+            response = self._query_inspect_tag(tag)
 
-            elif operation == 'inspect-file':
-                file_name = client_socket.recv(1024).decode('utf-8')
-                response = self._query_inspect_file(file_name)
 
+        elif operation == 'inspect-file':
+            file_name = recv_data(client_socket).decode('utf-8')
+            response = self._query_inspect_file(file_name)
 
-            response_str = json.dumps(response)
-            client_socket.sendall(str(response_str).encode('utf-8'))
+        return response
 
 
-    def _pack_permission_request(self, tags: list[str], files_names: list[str], query_tags: list[str]) -> bytes:
+    def _pack_permission_request(self, tags: list[str], files_names: list[str], query_tags: list[str], flags: int) -> bytes:
         data = {}
         data['tags'] = tags
         data['files'] = files_names
         data['query_tags'] = query_tags
-        return json.dumps(data).encode('utf-8')
+        return pack_map(data, flags)
 
 
 
@@ -403,12 +421,25 @@ if __name__ == "__main__":
     # Get current IP
     ip = socket.gethostbyname(socket.gethostname())
 
+    # Number of virtual nodes, give more to hosts with more storage and cpu
+    vnodes = DEFAULT_VNODES
+    if "--vnodes" in sys.argv:
+        i = sys.argv.index("--vnodes")
+        vnodes = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # Reuse the data left by the previous run of this node
+    warm = DEFAULT_WARM_RESTART
+    if "--warm" in sys.argv:
+        warm = True
+        sys.argv.remove("--warm")
+
 
     # First node case
     if len(sys.argv) == 1:
 
         # Create node
-        node = QueryNode(ip)
+        node = QueryNode(ip, vnodes, warm)
         print(f"[IP]: {ip}")
         node.join()
 
@@ -430,7 +461,7 @@ if __name__ == "__main__":
                     raise Exception(f"{target_ip} cannot be interpreted as an IP address")
 
             # Create node
-            node = QueryNode(ip)
+            node = QueryNode(ip, vnodes, warm)
             print(f"[IP]: {ip}")
 
             node.join(ChordNodeReference(target_ip))
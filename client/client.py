@@ -3,6 +3,7 @@ import sys
 import json
 import time
 import socket
+import struct
 import threading
 import ipaddress
 
@@ -20,7 +21,54 @@ class bcolors:
 RESOURCES_PATH = "resources/"
 OK = 0
 END = 100
-END_FILE = 200
+DATA = 50
+BUSY = 51
+
+# Frame header: opcode, flags, request id and payload length
+HEADER = struct.Struct('!HHIQ')
+CHUNK_SIZE = 64 * 1024
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], min(n - received, CHUNK_SIZE))
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return bytes(buffer)
+
+def send_frame(sock: socket.socket, op: int, payload: bytes | str = b''):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    sock.sendall(HEADER.pack(op, 0, 0, len(payload)))
+    if payload:
+        sock.sendall(payload)
+
+def recv_frame(sock: socket.socket) -> tuple[int, bytes]:
+    op, _, _, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return op, recv_exact(sock, length) if length else b''
+
+def send_data(sock: socket.socket, payload: bytes | str):
+    send_frame(sock, DATA, payload)
+
+class NodeBusyError(Exception):
+    pass
+
+def recv_data(sock: socket.socket) -> bytes:
+    op, payload = recv_frame(sock)
+    if op == BUSY: raise NodeBusyError("Node busy")
+    return payload
+
+def send_ack(sock: socket.socket):
+    send_frame(sock, OK)
+
+def recv_ack(sock: socket.socket):
+    op, _ = recv_frame(sock)
+    if op == BUSY: raise NodeBusyError("Node busy")
+    if op != OK: raise Exception("Negative ACK")
 
 
 
@@ -79,11 +127,10 @@ class SelfDiscovery:
                 if addr[0] == self.ip:
                     continue
 
-                data = conn.recv(1024).decode('utf-8').split(',')
-                option = int(data[0])
+                option, payload = recv_frame(conn)
 
                 if option == ENTRY_POINT:
-                    self.target_ip = data[1]
+                    self.target_ip = payload.decode('utf-8')
                     conn.close()
                     s.close()
                     break
@@ -170,7 +217,7 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     continue
 
                 files_name = params[0].split(';')
-                files_bin, correct = self.load_bins(files_name)
+                files_path, correct = self.load_paths(files_name)
 
                 if not correct: continue
 
@@ -182,40 +229,35 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('add'.encode('utf-8'))
+                        send_data(s, 'add')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send each file
                         for i in range(len(files_name)):
                             # Send name
-                            s.sendall(files_name[i].encode('utf-8'))
+                            send_data(s, files_name[i])
 
                             # Wait for OK
-                            ack = s.recv(1024).decode('utf-8')
-                            if ack != f"{OK}": raise Exception("Negative ACK")
+                            recv_ack(s)
 
-                            # Send bin and END_FILE
-                            s.sendall(files_bin[i])
-                            s.sendall(f"{END_FILE}".encode('utf-8'))
+                            # Send bin
+                            self.send_file(s, files_path[i])
 
                             # Wait for OK
-                            ack = s.recv(1024).decode('utf-8')
-                            if ack != f"{OK}": raise Exception("Negative ACK")
+                            recv_ack(s)
 
-                        s.sendall(f"{END}".encode('utf-8'))
+                        send_frame(s, END)
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send tags
-                        s.sendall(tags.encode('utf-8'))
+                        send_data(s, tags)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_results(response)
@@ -223,6 +265,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -239,17 +283,16 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('delete'.encode('utf-8'))
+                        send_data(s, 'delete')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send query tags
-                        s.sendall(tags_query.encode('utf-8'))
+                        send_data(s, tags_query)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_results(response)
@@ -257,6 +300,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -273,17 +318,16 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('list'.encode('utf-8'))
+                        send_data(s, 'list')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send query tags
-                        s.sendall(tags_query.encode('utf-8'))
+                        send_data(s, tags_query)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_list(response)
@@ -291,6 +335,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -308,24 +354,22 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('add-tags'.encode('utf-8'))
+                        send_data(s, 'add-tags')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send query tags
-                        s.sendall(tags_query.encode('utf-8'))
+                        send_data(s, tags_query)
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send tags
-                        s.sendall(tags.encode('utf-8'))
+                        send_data(s, tags)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_results(response)
@@ -333,6 +377,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -350,24 +396,22 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('delete-tags'.encode('utf-8'))
+                        send_data(s, 'delete-tags')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send query tags
-                        s.sendall(tags_query.encode('utf-8'))
+                        send_data(s, tags_query)
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send tags
-                        s.sendall(tags.encode('utf-8'))
+                        send_data(s, tags)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_results(response)
@@ -375,6 +419,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -392,48 +438,41 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         print("Downloading...")
 
                         # Send operation
-                        s.sendall('download'.encode('utf-8'))
+                        send_data(s, 'download')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send query tags
-                        s.sendall(tags_query.encode('utf-8'))
+                        send_data(s, tags_query)
 
                         # Wait response
                         while True:
-                            file_name = s.recv(1024).decode('utf-8')
-                            if file_name == f"{END}":
+                            op, payload = recv_frame(s)
+                            if op == END:
                                 break
+                            if op == BUSY: raise NodeBusyError("Node busy")
+                            file_name = payload.decode('utf-8')
                         
                             # Send file name received ACK
-                            s.sendall(f"{OK}".encode('utf-8'))
-
-                            file_content = b''
-                            end_file = f"{END_FILE}".encode('utf-8')
-                            while True:
-                                fragment = s.recv(1024)
-                                if end_file in fragment:
-                                    file_content += fragment.split(end_file)[0]
-                                    break
-                                else:
-                                    file_content += fragment
-                        
-                            # Send file bin received ACK
-                            s.sendall(f"{OK}".encode('utf-8'))
+                            send_ack(s)
 
                             #Guardar archivos en txt 
-                            self.save_file(file_name, file_content)
+                            self.save_file(file_name, s)
+
+                            # Send file bin received ACK
+                            send_ack(s)
 
 
                         print(f"{bcolors.OKGREEN}Download completed{bcolors.ENDC}")
-                        s.sendall(f"{OK}".encode('utf-8'))
+                        send_ack(s)
                         s.close()
                 except Exception as e:
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -454,17 +493,16 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('inspect-tag'.encode('utf-8'))
+                        send_data(s, 'inspect-tag')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send tag
-                        s.sendall(tag.encode('utf-8'))
+                        send_data(s, tag)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_tag_file_relationship(response, 'files_by_tag')
@@ -472,6 +510,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -492,17 +532,16 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                         s.connect((self.target_ip, self.target_port))
 
                         # Send operation
-                        s.sendall('inspect-file'.encode('utf-8'))
+                        send_data(s, 'inspect-file')
 
                         # Wait for OK
-                        ack = s.recv(1024).decode('utf-8')
-                        if ack != f"{OK}": raise Exception("Negative ACK")
+                        recv_ack(s)
 
                         # Send tag
-                        s.sendall(file_name.encode('utf-8'))
+                        send_data(s, file_name)
 
                         # Wait response
-                        response = s.recv(1024).decode('utf-8')
+                        response = recv_data(s).decode('utf-8')
                         response = json.loads(response)
                         s.close()
                         self.show_tag_file_relationship(response, 'tags_by_file')
@@ -510,6 +549,8 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
                     if isinstance(e, ConnectionRefusedError):
                         self.reconnect(user_input_str)
                         continue
+                    elif isinstance(e, NodeBusyError):
+                        self.display_error("The node is busy, try again later.")
                     else:
                         self.display_error("The operation could not be completed successfully.")
 
@@ -530,27 +571,22 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
     def display_error(self, msg: str):
         print(bcolors.FAIL + msg + bcolors.ENDC)
 
-    def load_bins(self, names: list[str]) -> tuple[list[bytes], bool]:
-        bins: list[bytes] = []
-
+    def load_paths(self, names: list[str]) -> tuple[list[str], bool]:
         # Check files existency
         for file_name in names:
             if not os.path.isfile(RESOURCES_PATH + file_name):
                 self.display_error(f"{file_name} file not found")
                 return [], False
 
-        for file_name in names:
-            content = []
-            with open(RESOURCES_PATH + file_name, 'rb') as file:
-                while True:
-                    data = file.read(1024)
-                    if not data:
-                        break
-                    content.append(data)
-                bin_content = b''.join(content)
-                bins.append(bin_content)
-
-        return bins, True
+        return [RESOURCES_PATH + file_name for file_name in names], True
+
+    def send_file(self, s: socket.socket, file_path: str):
+        # Send the file as a data frame straight from disk
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            s.sendall(HEADER.pack(DATA, 0, 0, size))
+            if size:
+                s.sendfile(file, 0, size)
 
     def show_list(self, data: dict):
         msg: str = data['msg']
@@ -576,13 +612,24 @@ example {bcolors.ENDC} <tag-list> {bcolors.OKBLUE} as {bcolors.ENDC} red;blue
             print(f"{bcolors.FAIL}{failed[i]}{bcolors.ENDC} \n  Reason: {failed_msg[i]}")
 
 
-    def save_file(self, file_name: str, content: bytes):
+    def save_file(self, file_name: str, s: socket.socket):
         downloads_folder = os.path.join(os.path.dirname(__file__), 'downloads')
         
         file_path = os.path.join(downloads_folder, file_name)
         
+        # Write the data frame payload as it arrives
+        op, _, _, length = HEADER.unpack(recv_exact(s, HEADER.size))
+        if op == BUSY: raise NodeBusyError("Node busy")
         with open(file_path, 'wb') as file:
-            file.write(content)
+            buffer = bytearray(min(length, CHUNK_SIZE) or 1)
+            view = memoryview(buffer)
+            remaining = length
+            while remaining > 0:
+                count = s.recv_into(view, min(remaining, len(buffer)))
+                if count == 0:
+                    raise ConnectionError("Connection closed by peer")
+                file.write(view[:count])
+                remaining -= count
 
 
     def show_tag_file_relationship(self, data: dict, mode: str):
@@ -0,0 +1,138 @@
+import json
+import struct
+from const import DEFAULT_COMPRESSION
+
+# Version of the binary encoding spoken by this node, version 0 is the text encoding (JSON and joined strings)
+CODEC_VERSION = 1
+
+# Header flag marking a payload encoded with the binary codec
+FLAG_CODEC = 0x1
+
+# Header flag marking a zlib compressed data frame. On a request it tells the
+# server the sender takes compressed frames for the rest of the conversation
+FLAG_ZLIB = 0x2
+
+# Optional features offered to peers, as header flags
+FEATURES = FLAG_ZLIB if DEFAULT_COMPRESSION else 0
+
+_U32 = struct.Struct('!I')
+_HELLO = struct.Struct('!HH')     # Codec version, features
+
+
+# ============================ Binary codec ============================
+# Strings are utf-8 prefixed by their length, lists and maps are prefixed by their count
+
+def _put_str(parts: list, s: str):
+    data = s.encode('utf-8')
+    parts.append(_U32.pack(len(data)))
+    parts.append(data)
+
+def _get_str(view: memoryview, offset: int) -> tuple[str, int]:
+    (length,) = _U32.unpack_from(view, offset)
+    offset += _U32.size
+    end = offset + length
+    if end > len(view):
+        raise ValueError("Truncated string")
+    return str(view[offset:end], 'utf-8'), end
+
+def _put_list(parts: list, items: list[str]):
+    parts.append(_U32.pack(len(items)))
+    for item in items:
+        _put_str(parts, item)
+
+def _get_list(view: memoryview, offset: int) -> tuple[list[str], int]:
+    (count,) = _U32.unpack_from(view, offset)
+    offset += _U32.size
+    items = []
+    for _ in range(count):
+        item, offset = _get_str(view, offset)
+        items.append(item)
+    return items, offset
+
+
+def encode_list(items: list[str]) -> bytes:
+    parts = []
+    _put_list(parts, items)
+    return b''.join(parts)
+
+def decode_list(data: bytes) -> list[str]:
+    if not data:
+        return []   # Requests that open a conversation carry no fields
+    items, _ = _get_list(memoryview(data), 0)
+    return items
+
+def encode_map(data: dict[str, list[str]]) -> bytes:
+    """Encodes a map from string to list of strings, like the tags and files maps"""
+    parts = [_U32.pack(len(data))]
+    for k, v in data.items():
+        _put_str(parts, k)
+        _put_list(parts, v)
+    return b''.join(parts)
+
+def decode_map(data: bytes) -> dict[str, list[str]]:
+    view = memoryview(data)
+    (count,) = _U32.unpack_from(view, 0)
+    offset = _U32.size
+    result = {}
+    for _ in range(count):
+        k, offset = _get_str(view, offset)
+        result[k], offset = _get_list(view, offset)
+    return result
+
+
+
+# ========================= Encoding by flags =========================
+# The text encoding is kept for peers that did not negotiate the codec
+
+def pack_fields(fields: list[str], flags: int, sep: str) -> bytes:
+    """Encodes the fields of a small operation, sep joins them in the text encoding"""
+    if flags & FLAG_CODEC:
+        return encode_list(fields)
+    return sep.join(fields).encode('utf-8')
+
+def unpack_fields(payload: bytes, flags: int, sep: str) -> list[str]:
+    if flags & FLAG_CODEC:
+        return decode_list(payload)
+    return payload.decode('utf-8').split(sep)
+
+def pack_list(items: list[str], flags: int) -> bytes:
+    if flags & FLAG_CODEC:
+        return encode_list(items)
+    return json.dumps({'data': items}).encode('utf-8')
+
+def unpack_list(payload: bytes, flags: int) -> list[str]:
+    if flags & FLAG_CODEC:
+        return decode_list(payload)
+    return json.loads(payload.decode('utf-8'))['data']
+
+def pack_map(data: dict[str, list[str]], flags: int) -> bytes:
+    if flags & FLAG_CODEC:
+        return encode_map(data)
+    return json.dumps(data).encode('utf-8')
+
+def unpack_map(payload: bytes, flags: int) -> dict[str, list[str]]:
+    if flags & FLAG_CODEC:
+        return decode_map(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+
+# ============================ Negotiation ============================
+
+def _parse_hello(payload: bytes) -> tuple[int, int]:
+    if len(payload) == _HELLO.size:
+        return _HELLO.unpack(payload)
+    return 0, 0
+
+def hello_payload(version: int = CODEC_VERSION, features: int = FEATURES) -> bytes:
+    return _HELLO.pack(version, features)
+
+def hello_reply(payload: bytes) -> bytes:
+    """Answers a HELLO with the highest version and the features both sides speak"""
+    peer_version, peer_features = _parse_hello(payload)
+    return _HELLO.pack(min(peer_version, CODEC_VERSION), peer_features & FEATURES)
+
+def hello_flags(payload: bytes) -> int:
+    """Returns the header flags to use with a peer given its HELLO reply"""
+    version, features = _parse_hello(payload)
+    return (FLAG_CODEC if version >= 1 else 0) | (features & FEATURES)
@@ -0,0 +1,125 @@
+import os
+import time
+import zlib
+import socket
+from const import *
+from framing import *
+from codec import FLAG_ZLIB
+
+
+class TransferStats:
+    """Bytes before and after compression, and CPU time spent on it, during one transfer"""
+
+    def __init__(self):
+        self.raw = 0
+        self.wire = 0
+        self.cpu = 0.0
+
+    def add(self, raw: int, wire: int, cpu: float = 0.0):
+        self.raw += raw
+        self.wire += wire
+        self.cpu += cpu
+
+    def report(self, label: str):
+        if self.raw < DEFAULT_COMPRESS_THRESHOLD:
+            return
+        ratio = self.raw / self.wire if self.wire else 0
+        print(f"[🗜] {label}: {self.raw} bytes, {self.wire} on the wire (ratio {ratio:.2f}), {self.cpu * 1000:.1f} ms CPU")
+
+
+# Function to check if a payload or file is worth compressing
+def should_compress(size: int, file_name: str = None) -> bool:
+    if size < DEFAULT_COMPRESS_THRESHOLD:
+        return False
+    if file_name and os.path.splitext(file_name)[1].lower() in DEFAULT_COMPRESS_SKIP:
+        return False
+    return True
+
+
+# Function to send a data frame, compressed if the conversation negotiated it and it pays off
+def send_payload(sock: socket.socket, payload: bytes, flags: int, stats: TransferStats = None, req_id: int = 0):
+    stats = stats or TransferStats()
+    if flags & FLAG_ZLIB and should_compress(len(payload)):
+        start = time.thread_time()
+        compressed = zlib.compress(payload, DEFAULT_COMPRESS_LEVEL)
+        cpu = time.thread_time() - start
+        if len(compressed) < len(payload):
+            stats.add(len(payload), len(compressed), cpu)
+            send_frame(sock, DATA, compressed, req_id, FLAG_ZLIB)
+            return
+        stats.add(0, 0, cpu)
+
+    stats.add(len(payload), len(payload))
+    send_frame(sock, DATA, payload, req_id)
+
+
+# Function to receive a data frame payload, decompressing it if needed
+def recv_payload(sock: socket.socket, stats: TransferStats = None) -> bytes:
+    stats = stats or TransferStats()
+    frame = recv_frame(sock)
+    if frame.op == BUSY:
+        raise BusyError("Peer is busy")
+    if not frame.flags & FLAG_ZLIB:
+        stats.add(len(frame.payload), len(frame.payload))
+        return frame.payload
+
+    start = time.thread_time()
+    payload = zlib.decompress(frame.payload)
+    stats.add(len(payload), len(frame.payload), time.thread_time() - start)
+    return payload
+
+
+# Function to stream a file as compressed data frames, an empty flagged frame opens them and an END frame closes them
+def send_compressed_file(sock: socket.socket, file_path: str, stats: TransferStats = None) -> int:
+    """Returns the uncompressed size of the file"""
+    stats = stats or TransferStats()
+    compressor = zlib.compressobj(DEFAULT_COMPRESS_LEVEL)
+    raw = wire = 0
+    cpu = 0.0
+
+    send_header(sock, DATA, 0, flags=FLAG_ZLIB)
+    with open(file_path, 'rb') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            start = time.thread_time()
+            compressed = compressor.compress(chunk) if chunk else compressor.flush()
+            cpu += time.thread_time() - start
+
+            raw += len(chunk)
+            if compressed:
+                send_frame(sock, DATA, compressed)
+                wire += len(compressed)
+            if not chunk:
+                break
+    send_frame(sock, END)
+
+    stats.add(raw, wire, cpu)
+    return raw
+
+
+# Function to receive a file sent by send_compressed_file, once its opening frame was read
+def recv_compressed_to(sock: socket.socket, file, stats: TransferStats = None) -> int:
+    """Writes the decompressed content to file, returns its size"""
+    stats = stats or TransferStats()
+    decompressor = zlib.decompressobj()
+    raw = wire = 0
+    cpu = 0.0
+
+    while True:
+        frame = recv_frame(sock)
+        if frame.op == END:
+            break
+        start = time.thread_time()
+        data = decompressor.decompress(frame.payload)
+        cpu += time.thread_time() - start
+
+        file.write(data)
+        raw += len(data)
+        wire += len(frame.payload)
+
+    data = decompressor.flush()
+    file.write(data)
+    raw += len(data)
+
+    stats.add(raw, wire, cpu)
+    return raw
@@ -0,0 +1,263 @@
+import time
+import select
+import socket
+import threading
+from contextlib import contextmanager
+from const import *
+from framing import *
+from codec import hello_payload, hello_flags
+from failure_detector import detector
+from vnodes import endpoint
+
+
+class ConnectionPool:
+    """Long lived connections to peers, keyed by (ip, port) and shared by every reference.
+
+    A connection carries one request at a time: it is taken from the pool for a
+    request and given back when the response arrives, so threads talking to the
+    same peer reuse the same few sockets instead of connecting for every call."""
+
+    def __init__(self, max_connections: int = DEFAULT_POOL_SIZE, max_idle_per_peer: int = DEFAULT_POOL_IDLE_PER_PEER, idle_timeout: float = DEFAULT_POOL_IDLE_TIMEOUT, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, busy_retries: int = DEFAULT_BUSY_RETRIES, busy_backoff: float = DEFAULT_BUSY_BACKOFF):
+        self.max_connections = max_connections
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+
+        self.lock = threading.Lock()
+        self.idle: dict[tuple[str, int], list[tuple[socket.socket, float]]] = {}
+        self.peer_flags: dict[tuple[str, int], int] = {}   # Header flags negotiated with each peer
+        self.open_count = 0     # Pooled sockets currently open, idle or in use
+
+        # Counters
+        self.connects = 0
+        self.reuses = 0
+        self.evictions = 0
+        self.busy = 0
+
+
+    def _is_alive(self, sock: socket.socket) -> bool:
+        """An idle socket must not be readable, if it is the peer closed it or sent garbage"""
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def _close(self, sock: socket.socket):
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _evict_expired(self, now: float):
+        """Closes idle sockets older than idle_timeout (must hold lock)"""
+        for address in list(self.idle.keys()):
+            alive = []
+            for sock, last_used in self.idle[address]:
+                if now - last_used > self.idle_timeout:
+                    self._close(sock)
+                    self.open_count -= 1
+                    self.evictions += 1
+                else:
+                    alive.append((sock, last_used))
+            if alive:
+                self.idle[address] = alive
+            else:
+                del self.idle[address]
+
+    def _evict_oldest(self) -> bool:
+        """Closes the least recently used idle socket of any peer (must hold lock)"""
+        oldest = None
+        for address, entries in self.idle.items():
+            for i, (_, last_used) in enumerate(entries):
+                if oldest is None or last_used < oldest[2]:
+                    oldest = (address, i, last_used)
+        if oldest is None:
+            return False
+
+        address, i, _ = oldest
+        sock, _ = self.idle[address].pop(i)
+        if not self.idle[address]:
+            del self.idle[address]
+        self._close(sock)
+        self.open_count -= 1
+        self.evictions += 1
+        return True
+
+
+    def acquire(self, address: tuple[str, int]) -> tuple[socket.socket, bool, bool]:
+        """Returns (sock, reused, pooled) for address, connecting if there is no idle socket.
+        The ip of address is a node name, virtual nodes are reached on their shifted ports"""
+        with self.lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+
+            entries = self.idle.get(address, [])
+            while entries:
+                sock, _ = entries.pop()
+                if not entries:
+                    self.idle.pop(address, None)
+                if self._is_alive(sock):
+                    self.reuses += 1
+                    return sock, True, True
+                # Broken socket
+                self._close(sock)
+                self.open_count -= 1
+                self.evictions += 1
+
+            pooled = self.open_count < self.max_connections or self._evict_oldest()
+            if pooled:
+                self.open_count += 1
+
+        try:
+            sock = socket.create_connection(endpoint(*address), timeout=self.connect_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            flags = self._negotiate(sock)
+            sock.settimeout(None)
+        except Exception:
+            if pooled:
+                with self.lock:
+                    self.open_count -= 1
+            raise
+
+        with self.lock:
+            self.connects += 1
+            self.peer_flags[address] = flags
+        return sock, False, pooled
+
+    def _negotiate(self, sock: socket.socket) -> int:
+        """Agrees with the peer the encoding of the connection, returns the header flags to use"""
+        req_id = next_request_id()
+        try:
+            send_frame(sock, HELLO, hello_payload(), req_id)
+            reply = recv_frame(sock)
+        except Exception:
+            self._close(sock)
+            raise
+        if reply.op != HELLO or reply.req_id != req_id:
+            return 0
+        return hello_flags(reply.payload)
+
+    def flags(self, ip: str, port: int) -> int:
+        """Returns the header flags negotiated with a peer, connecting to it if it was never contacted"""
+        address = (ip, port)
+        with self.lock:
+            if address in self.peer_flags:
+                return self.peer_flags[address]
+        sock, _, pooled = self.acquire(address)
+        self.release(address, sock, pooled)
+        with self.lock:
+            return self.peer_flags.get(address, 0)
+
+    def release(self, address: tuple[str, int], sock: socket.socket, pooled: bool = True):
+        """Gives a healthy socket back to the pool"""
+        if not pooled:
+            self._close(sock)
+            return
+
+        with self.lock:
+            entries = self.idle.setdefault(address, [])
+            if len(entries) < self.max_idle_per_peer:
+                entries.append((sock, time.monotonic()))
+                return
+            self.open_count -= 1
+        self._close(sock)
+
+    def discard(self, sock: socket.socket, pooled: bool = True):
+        """Closes a socket that is broken or left in an unknown protocol state"""
+        self._close(sock)
+        if pooled:
+            with self.lock:
+                self.open_count -= 1
+
+    def close_peer(self, ip: str):
+        """Closes every idle socket to the given peer ip"""
+        with self.lock:
+            for address in [a for a in self.idle if a[0] == ip]:
+                for sock, _ in self.idle.pop(address):
+                    self._close(sock)
+                    self.open_count -= 1
+                    self.evictions += 1
+
+
+    @contextmanager
+    def connection(self, ip: str, port: int, timeout: float = None):
+        """Yields a pooled socket for a whole conversation, it goes back to the pool only if no error happened"""
+        address = (ip, port)
+        sock, _, pooled = self.acquire(address)
+        try:
+            sock.settimeout(timeout)
+            yield sock
+        except BaseException:
+            self.discard(sock, pooled)
+            raise
+        sock.settimeout(None)
+        self.release(address, sock, pooled)
+
+    def request(self, ip: str, port: int, op: int, payload: bytes | str = b'', timeout: float = None, flags: int = 0, idempotent: bool = False) -> Frame:
+        """Sends one request frame and returns its response frame, a BUSY peer is retried with backoff.
+        Every response and every failure is reported to the failure detector.
+        A request that broke a reused socket after being written may have run on the peer, it is
+        only sent again on a fresh socket if the caller marks it idempotent (read only)"""
+        address = (ip, port)
+        attempt = 0
+        busy_retries = 0
+        while True:
+            try:
+                sock, reused, pooled = self.acquire(address)
+            except (ConnectionError, OSError):
+                detector.failed(ip)
+                raise
+            sent = False
+            try:
+                sock.settimeout(timeout)
+                req_id = next_request_id()
+                send_frame(sock, op, payload, req_id, flags)
+                sent = True
+                frame = recv_frame(sock)
+                if frame.req_id != req_id:
+                    raise ConnectionError(f"Unexpected response id {frame.req_id}")
+                sock.settimeout(None)
+            except (ConnectionError, OSError) as e:
+                self.discard(sock, pooled)
+                # A reused socket may have been closed by the peer while idle, retry once on a fresh one
+                if reused and attempt == 0 and not isinstance(e, socket.timeout) and (not sent or idempotent):
+                    attempt += 1
+                    continue
+                detector.failed(ip)
+                raise
+            except BaseException:
+                self.discard(sock, pooled)
+                raise
+
+            self.release(address, sock, pooled)
+            detector.heard(ip)
+            if frame.op != BUSY:
+                return frame
+
+            with self.lock:
+                self.busy += 1
+            if busy_retries == self.busy_retries:
+                raise BusyError(f"{ip}:{port} is busy")
+            time.sleep(self.busy_backoff * 2 ** busy_retries)
+            busy_retries += 1
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'open': self.open_count,
+                'idle': sum(len(v) for v in self.idle.values()),
+                'peers': len(self.idle),
+                'connects': self.connects,
+                'reuses': self.reuses,
+                'evictions': self.evictions,
+                'busy': self.busy,
+            }
+
+
+
+# Pool shared by every reference in this process
+pool = ConnectionPool()
@@ -6,6 +6,87 @@ DEFAULT_BROADCAST_PORT = 8255
 DEFAULT_DB_PORT = 8888
 DEFAULT_LEADER_PORT = 8999
 
+# Connection pool
+DEFAULT_POOL_SIZE = 64              # Max pooled sockets open at once
+DEFAULT_POOL_IDLE_PER_PEER = 4      # Max idle sockets kept per (ip, port)
+DEFAULT_POOL_IDLE_TIMEOUT = 60      # Seconds before an idle socket is closed
+DEFAULT_CONNECT_TIMEOUT = 3         # Seconds to establish a connection
+DEFAULT_PROBE_TIMEOUT = 3           # Seconds to wait a CHECK_NODE response
+
+# Node runtime
+DEFAULT_BACKLOG = 512               # Pending connections queued by each listening port
+DEFAULT_PORT_WORKERS = 16           # Threads running request handlers of each port
+DEFAULT_PORT_QUEUE = 128            # Requests waiting for a worker before replying BUSY
+DEFAULT_NESTED_WORKERS = 32         # Threads running the handlers of each port that wait on other nodes
+DEFAULT_NESTED_QUEUE = 0            # Of those waiting for a thread, they could be what the running ones wait for
+DEFAULT_LEADER_WORKERS = 256        # Client operations holding or waiting for a permission of the leader at once
+DEFAULT_BUSY_RETRIES = 3            # Times a BUSY request is retried before giving up
+DEFAULT_BUSY_BACKOFF = 0.1          # Seconds before the first retry, doubled every time
+
+# Downloads
+DEFAULT_PREFETCH_WINDOW = 16        # Chunks fetched from owners ahead of the client
+
+# Bulk transfers
+DEFAULT_BULK_WINDOW = 8             # Files sent by send_bins before waiting for their acks
+
+# Compression of replication and delegation streams
+DEFAULT_COMPRESSION = True          # Offer zlib to peers when negotiating a connection
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_THRESHOLD = 1024   # Payloads and bins smaller than this are sent as they are
+DEFAULT_COMPRESS_SKIP = {           # Extensions of files that are already compressed
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.ogg', '.flac', '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.odt',
+}
+
+# Virtual nodes
+DEFAULT_VNODES = 1                  # Virtual nodes run by each physical node, its weight on the ring
+DEFAULT_VNODE_PORT_STEP = 10        # Ports of the k-th virtual node are the base ports plus k times this
+
+# Owner lookups
+DEFAULT_LOOKUP_CACHE_SIZE = 4096    # Resolved key ids kept by each node
+DEFAULT_LOOKUP_CACHE_TTL = 30       # Seconds a resolved owner is trusted
+DEFAULT_ITERATIVE_LOOKUP = True     # Drive lookups from the origin instead of forwarding them hop by hop
+DEFAULT_LOOKUP_MAX_HOPS = 32        # Hops an iterative lookup may take before falling back to the recursive one
+DEFAULT_SUCCESSOR_LIST = 3          # Successors tracked by each node to fail over to when the first one dies
+
+# One hop lookups through the full membership view
+DEFAULT_ONE_HOP = True              # Resolve owners from the membership view when it can be trusted
+DEFAULT_ONE_HOP_MAX = 64            # Members above which lookups go back to finger routing
+DEFAULT_MEMBERSHIP_EXPIRE = 90      # Seconds without a heartbeat increase before a member is dropped
+DEFAULT_MEMBERSHIP_STALE = 45       # Seconds without gossip after which the view is not trusted, gossip runs every stabilize round
+
+# Failure detection
+DEFAULT_PHI_THRESHOLD = 1           # Suspicion under which a peer is trusted without probing it
+DEFAULT_PHI_WINDOW = 100            # Gaps between responses kept per peer
+DEFAULT_PHI_MIN_INTERVAL = 0.5      # Seconds, lower bound of the mean gap so chatty peers are not probed constantly
+DEFAULT_SUSPECT_RETRY = 5           # Seconds a peer that failed a request is taken as dead before probing it again
+
+# Maintenance intervals, they back off from min to max while the ring is stable
+DEFAULT_MAINTENANCE_MIN = 1         # Seconds between stabilize, predecessor and leader checks after churn
+DEFAULT_MAINTENANCE_MAX = 15        # Seconds between them once the ring is stable
+DEFAULT_LOG_REFRESH_MIN = 2
+DEFAULT_LOG_REFRESH_MAX = 16
+
+# Finger table maintenance
+DEFAULT_FIX_FINGERS_MIN = 2         # Seconds between finger table refreshes while the ring changes
+DEFAULT_FIX_FINGERS_MAX = 60        # Seconds between them once it is stable, the interval doubles every quiet refresh
+
+# Storage of the database tables
+DEFAULT_STORAGE_ENGINE = 'dict'     # 'dict' keeps the tables in memory behind the metadata log, 'sqlite' keeps them on disk
+DEFAULT_SQLITE_CACHE_KB = 8192      # Page cache of each sqlite database, bounds the memory of the 'sqlite' engine
+DEFAULT_WARM_RESTART = False        # Keep the tables and bins of the previous run on start instead of wiping them
+
+# Metadata log of the database, DEFAULT_WAL_FSYNC also sets the sync level of the 'sqlite' engine
+DEFAULT_WAL_FSYNC = 'interval'      # 'always' syncs every group commit, 'interval' every DEFAULT_WAL_FSYNC_INTERVAL, 'never' leaves it to the OS
+DEFAULT_WAL_FSYNC_INTERVAL = 1      # Seconds between syncs of the log under the 'interval' policy
+DEFAULT_WAL_SNAPSHOT_EVERY = 10000  # Records appended before the tables are snapshotted and the log truncated
+
+# Group commit of the storage engines, flush() is the barrier for callers that need durability
+DEFAULT_FLUSH_MAX_DELAY = 0.05      # Seconds a mutation may wait in memory before the flusher commits it
+DEFAULT_FLUSH_MAX_PENDING = 256     # Mutations waiting after which the flusher commits right away
+
 # Operation codes in ChordNode
 FIND_SUCCESSOR = 1
 FIND_PREDECESSOR = 2
@@ -15,6 +96,8 @@ NOTIFY = 5
 CHECK_NODE = 6
 CLOSEST_PRECEDING_FINGER = 7
 LOOKUP = 15
+LOOKUP_MANY = 16
+GOSSIP = 17
 STORE_KEY = 8
 RETRIEVE_KEY = 9
 NOT_ALONE_NOTIFY = 10
@@ -23,6 +106,9 @@ GET_LEADER = 12
 DISCOVER = 13
 ENTRY_POINT = 14
 
+# ChordNode ops whose handlers wait on requests to other nodes, they run in the nested workers of the port
+CHORD_NESTED_OPS = frozenset({FIND_PREDECESSOR, LOOKUP, LOOKUP_MANY, NOTIFY, NOT_ALONE_NOTIFY})
+
 # Operation codes in DataNode
 OK = 0
 INSERT_TAG = 1
@@ -43,7 +129,15 @@ INSERT_BIN = 13
 DELETE_BIN = 14
 RETRIEVE_BIN = 15
 END = 100
-END_FILE = 200
+
+# Payload frame inside a conversation
+DATA = 50
+
+# Reply to a request rejected because the node is overloaded
+BUSY = 51
+
+# Codec negotiation, first frame of a pooled connection on any port
+HELLO = 60
 
 FALSE = 0
 TRUE = 1
@@ -54,6 +148,15 @@ PULL_SUCC_REPLICA = 3
 PUSH_DATA = 4
 FETCH_REPLICA = 8
 
+# Database ops whose handlers wait on requests to other nodes
+DB_NESTED_OPS = frozenset({FETCH_REPLICA})
+
+# Operation codes in Leader
+REQUEST_PERMISSION = 1
+
+# Leader ops whose handlers wait on the requester until it ends its operation
+LEADER_NESTED_OPS = frozenset({REQUEST_PERMISSION})
+
 # Replicated predecesor
 REPLICATE_PRED_STORE_TAG = 11
 REPLICATE_PRED_APPEND_FILE = 12
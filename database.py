@@ -1,83 +1,75 @@
 import os
 import shutil
+import hashlib
+import time
 import socket
 import threading
-import json
 from const import *
 from utils import *
-from const import *
-from typing import Dict, List
+from framing import *
+from codec import *
+from compression import *
+from connection_pool import pool
+from typing import Callable, Collection, Mapping
+from runtime import NodeRuntime
+from vnodes import endpoint
+from storage import open_storage
 
 
 class Database:
-    def __init__(self, db_ip: str, db_port: str = DEFAULT_DB_PORT) -> None:
+    def __init__(self, db_ip: str, db_port: str = DEFAULT_DB_PORT, runtime: NodeRuntime = None, warm: bool = DEFAULT_WARM_RESTART,
+                 replica_targets: Callable[[], tuple[str, str]] = None, replica_sources: Callable[[bool], list[tuple[str, str]]] = None) -> None:
         self.db_ip = db_ip
         self.db_port = db_port
+        self.runtime = runtime or NodeRuntime()
 
-        # For tags and correspondings file names
-        self.tags: Dict[str, List[str]] = {}
-        self.replicated_pred_tags: Dict[str, List[str]] = {}
-        self.replicated_succ_tags: Dict[str, List[str]] = {}
-        # For file names and correspondings tags
-        self.files: Dict[str, List[str]] = {}
-        self.replicated_pred_files: Dict[str, List[str]] = {}
-        self.replicated_succ_files: Dict[str, List[str]] = {}
+        # Views of the ring of the node, the nodes keeping my replicas and the (start, owner) ranges i keep replicas of.
+        # Without them my neighbours given to each operation are used
+        self.replica_targets = replica_targets
+        self.replica_sources = replica_sources
 
         # Paths
         self.dir_path = f"database/{self.db_ip}"
-        self.tags_path = f"{self.dir_path}/tags.json"
-        self.files_path = f"{self.dir_path}/files.json"
-        self.replicated_pred_tags_path = f"{self.dir_path}/replicated_pred_tags.json"
-        self.replicated_succ_tags_path = f"{self.dir_path}/replicated_succ_tags.json"
-        self.replicated_pred_files_path = f"{self.dir_path}/replicated_pred_files.json"
-        self.replicated_succ_files_path = f"{self.dir_path}/replicated_succ_files.json"
         self.bins_path = f"{self.dir_path}/bins"
         self.replicated_pred_bins_path = f"{self.dir_path}/replicated_pred_bins"
         self.replicated_succ_bins_path = f"{self.dir_path}/replicated_succ_bins"
 
+        if not os.path.exists(self.dir_path):
+            os.makedirs(self.dir_path)
+
+        # Tables are read through these views, every mutation goes through self.storage.apply
+        self.storage = open_storage(self.dir_path)
+        # For tags and correspondings file names
+        self.tags: Mapping[str, Collection[str]] = self.storage.table('tags')
+        self.replicated_pred_tags: Mapping[str, Collection[str]] = self.storage.table('replicated_pred_tags')
+        self.replicated_succ_tags: Mapping[str, Collection[str]] = self.storage.table('replicated_succ_tags')
+        # For file names and correspondings tags
+        self.files: Mapping[str, Collection[str]] = self.storage.table('files')
+        self.replicated_pred_files: Mapping[str, Collection[str]] = self.storage.table('replicated_pred_files')
+        self.replicated_succ_files: Mapping[str, Collection[str]] = self.storage.table('replicated_succ_files')
+
+        # Hashes of bins already compared with other nodes, path -> ((size, mtime), sha1)
+        self.bin_hashes: dict[str, tuple[tuple[int, int], str]] = {}
+
+        # Whether my tables were left by a previous run and the ring did not reconcile them yet
+        self.rejoining = False
+
         # Prepare storage
-        self.set_up_storage()
+        self.set_up_storage(warm)
 
-        threading.Thread(target=self._recv, daemon=True).start()
+        self._recv()
 
 
 
-    def set_up_storage(self):
+    def set_up_storage(self, warm: bool = False):
         print("[💾] Setting up storage...")
 
-        # Create all empty files if they dont exist
-        if not os.path.exists(self.dir_path):            
-            os.makedirs(self.dir_path)
+        if warm:
+            self.load_storage()
+            return
 
-        if os.path.isfile(self.tags_path):
-            os.remove(self.tags_path)
-        with open(self.tags_path, 'w') as json_file:
-            json.dump(self.tags, json_file, indent=4)
-        
-        if os.path.isfile(self.files_path):
-            os.remove(self.files_path)
-        with open(self.files_path, 'w') as json_file:
-            json.dump(self.files, json_file, indent=4)
-
-        if os.path.isfile(self.replicated_pred_tags_path):
-            os.remove(self.replicated_pred_tags_path)
-        with open(self.replicated_pred_tags_path, 'w') as json_file:
-            json.dump(self.replicated_pred_tags, json_file, indent=4)
-
-        if os.path.isfile(self.replicated_succ_tags_path):
-            os.remove(self.replicated_succ_tags_path)
-        with open(self.replicated_succ_tags_path, 'w') as json_file:
-            json.dump(self.replicated_succ_tags, json_file, indent=4)
-        
-        if os.path.isfile(self.replicated_pred_files_path):  
-            os.remove(self.replicated_pred_files_path)
-        with open(self.replicated_pred_files_path, 'w') as json_file:
-            json.dump(self.replicated_pred_files, json_file, indent=4)
-
-        if os.path.isfile(self.replicated_succ_files_path):  
-            os.remove(self.replicated_succ_files_path)
-        with open(self.replicated_succ_files_path, 'w') as json_file:
-            json.dump(self.replicated_succ_files, json_file, indent=4)
+        # Start over with empty tables
+        self.storage.reset()
 
         if os.path.exists(self.bins_path):
             shutil.rmtree(self.bins_path)
@@ -93,34 +85,32 @@ class Database:
 
         print("[💾] Successfull set up")
 
+    # Method to reuse the tables and bins left by a previous run, the ring sends only what changed since then
+    def load_storage(self):
+        self.storage.load()
 
+        for files_table, bins_path in [('files', self.bins_path),
+                                       ('replicated_pred_files', self.replicated_pred_bins_path),
+                                       ('replicated_succ_files', self.replicated_succ_bins_path)]:
+            if not os.path.exists(bins_path):
+                os.makedirs(bins_path)
+            files = self.storage.table(files_table)
 
-    ################################ Savers ###################################
-    def save_tags(self):
-        with open(self.tags_path, 'w') as json_file:
-            json.dump(self.tags, json_file, indent=4)
-    
-    def save_files(self):
-        with open(self.files_path, 'w') as json_file:
-            json.dump(self.files, json_file, indent=4)
-
-    def save_replicated_pred_tags(self):
-        with open(self.replicated_pred_tags_path, 'w') as json_file:
-            json.dump(self.replicated_pred_tags, json_file, indent=4)
-
-    def save_replicated_succ_tags(self):
-        with open(self.replicated_succ_tags_path, 'w') as json_file:
-            json.dump(self.replicated_succ_tags, json_file, indent=4)
+            # Files whose bin was lost are pulled again, bins of no file are garbage
+            missing = [k for k in files if not os.path.isfile(f"{bins_path}/{k}")]
+            with self.storage.batch():
+                for k in missing:
+                    self.storage.apply(files_table, 'del', k)
+            orphans = [k for k in os.listdir(bins_path) if k not in files]
+            for k in orphans:
+                os.remove(f"{bins_path}/{k}")
+            print(f"[💾] {len(files)} files kept in {files_table}, {len(missing)} without bin dropped, {len(orphans)} orphan bins removed")
 
-    def save_replicated_pred_files(self):
-        with open(self.replicated_pred_files_path, 'w') as json_file:
-            json.dump(self.replicated_pred_files, json_file, indent=4)
+        # Until my successor hands my range back, none of it is trusted
+        self.rejoining = bool(self.tags or self.files)
+        print(f"[💾] Warm start with {len(self.tags)} tags and {len(self.files)} files")
 
-    def save_replicated_succ_files(self):
-        with open(self.replicated_succ_files_path, 'w') as json_file:
-            json.dump(self.replicated_succ_files, json_file, indent=4)
 
-    
 
     ################################# REQUEST FUNCTIONS ####################################
     # TAGS
@@ -132,63 +122,51 @@ class Database:
 
     def store_tag(self, tag: str, successor_ip: str, predecesor_ip: str = None):
         """Adds tag key to storage with empty list"""
-        self.tags[tag] = []
-        op = f"{REPLICATE_PRED_STORE_TAG}"
-        msg = tag
-        send_2(op, msg, successor_ip, self.db_port)      # Replicate pred 
+        self.storage.apply('tags', 'put', tag, [])
+        op = REPLICATE_PRED_STORE_TAG
+        msg = [tag]
+        send_op(op, msg, successor_ip, self.db_port)      # Replicate pred 
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_STORE_TAG}"
-            msg = tag
-            send_2(op, msg, predecesor_ip, self.db_port)      # Replicate succ
-        self.save_tags()
+            op = REPLICATE_SUCC_STORE_TAG
+            msg = [tag]
+            send_op(op, msg, predecesor_ip, self.db_port)      # Replicate succ
 
     def append_file(self, tag: str, file_name: str, successor_ip: str, predecesor_ip: str = None):
         """Appends file name to given tag storage"""
-        self.tags[tag].append(file_name)
-        op = f"{REPLICATE_PRED_APPEND_FILE}"
-        msg = f"{tag};{file_name}"
-        send_2(op, msg, successor_ip, self.db_port)      # Replicate pred
+        self.storage.apply('tags', 'add', tag, file_name)
+        op = REPLICATE_PRED_APPEND_FILE
+        msg = [tag, file_name]
+        send_op(op, msg, successor_ip, self.db_port)      # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_APPEND_FILE}"
-            msg = f"{tag};{file_name}"
-            send_2(op, msg, predecesor_ip, self.db_port)      # Replicate succ
-        self.save_tags()
+            op = REPLICATE_SUCC_APPEND_FILE
+            msg = [tag, file_name]
+            send_op(op, msg, predecesor_ip, self.db_port)      # Replicate succ
     
     def delete_tag(self, tag: str, successor_ip: str, predecesor_ip: str = None):
         """Deletes tag key from storage"""
-        del self.tags[tag]
-        op = f"{REPLICATE_PRED_DELETE_TAG}"
-        msg = tag
-        send_2(op, msg, successor_ip, self.db_port)      # Replicate pred
+        self.storage.apply('tags', 'del', tag)
+        op = REPLICATE_PRED_DELETE_TAG
+        msg = [tag]
+        send_op(op, msg, successor_ip, self.db_port)      # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_DELETE_TAG}"
-            msg = tag
-            send_2(op, msg, predecesor_ip, self.db_port)      # Replicate succ
-        self.save_tags()
+            op = REPLICATE_SUCC_DELETE_TAG
+            msg = [tag]
+            send_op(op, msg, predecesor_ip, self.db_port)      # Replicate succ
 
     def remove_file(self, tag: str, file_name: str, successor_ip: str, predecesor_ip: str = None):
         """Removes file name from given tag storage"""
-        self.tags[tag].remove(file_name)
-        if len(self.tags[tag]) == 0:
-            del self.tags[tag]
-        op = f"{REPLICATE_PRED_REMOVE_FILE}"
-        msg = f"{tag};{file_name}"
-        send_2(op, msg, successor_ip, self.db_port)      # Replicate pred
+        self.storage.apply('tags', 'discard', tag, file_name)
+        op = REPLICATE_PRED_REMOVE_FILE
+        msg = [tag, file_name]
+        send_op(op, msg, successor_ip, self.db_port)      # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_REMOVE_FILE}"
-            msg = f"{tag};{file_name}"
-            send_2(op, msg, predecesor_ip, self.db_port)      # Replicate succ
-        self.save_tags()
+            op = REPLICATE_SUCC_REMOVE_FILE
+            msg = [tag, file_name]
+            send_op(op, msg, predecesor_ip, self.db_port)      # Replicate succ
 
-    def retrieve_tag(self, tag: str) -> str:
+    def retrieve_tag(self, tag: str) -> list[str]:
         """Retrieve list of files name associated with given tag"""
-        data = {}
-        if tag in self.tags:
-            value = self.tags[tag]
-            data["data"] = value
-        else:
-            data["data"] = []
-        return json.dumps(data)
+        return list(self.tags.get(tag, ()))
     
     ########################
     # FILES
@@ -200,102 +178,98 @@ class Database:
 
     def store_file(self, file_name: str, successor_ip: str, predecesor_ip: str = None):
         """Adds file name key to storage with empty list"""
-        self.files[file_name] = []
-        op = f"{REPLICATE_PRED_STORE_FILE}"
-        msg = file_name
-        send_2(op, msg, successor_ip, self.db_port)       # Replicate pred
+        self.storage.apply('files', 'put', file_name, [])
+        op = REPLICATE_PRED_STORE_FILE
+        msg = [file_name]
+        send_op(op, msg, successor_ip, self.db_port)       # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_STORE_FILE}"
-            msg = file_name
-            send_2(op, msg, predecesor_ip, self.db_port)       # Replicate succ
-        self.save_files()
+            op = REPLICATE_SUCC_STORE_FILE
+            msg = [file_name]
+            send_op(op, msg, predecesor_ip, self.db_port)       # Replicate succ
 
     def append_tag(self, file_name: str, tag: str, successor_ip: str, predecesor_ip: str = None):
         """Appends tag to given file name storage"""
-        self.files[file_name].append(tag)
-        op = f"{REPLICATE_PRED_APPEND_TAG}"
-        msg = f"{file_name};{tag}"
-        send_2(op, msg, successor_ip, self.db_port)       # Replicate pred
+        self.storage.apply('files', 'add', file_name, tag)
+        op = REPLICATE_PRED_APPEND_TAG
+        msg = [file_name, tag]
+        send_op(op, msg, successor_ip, self.db_port)       # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_APPEND_TAG}"
-            msg = f"{file_name};{tag}"
-            send_2(op, msg, predecesor_ip, self.db_port)       # Replicate succ
-        self.save_files()
+            op = REPLICATE_SUCC_APPEND_TAG
+            msg = [file_name, tag]
+            send_op(op, msg, predecesor_ip, self.db_port)       # Replicate succ
 
     def delete_file(self, file_name: str, successor_ip: str, predecesor_ip: str = None):
         """Deletes file name key from storage"""
-        del self.files[file_name]
-        op = f"{REPLICATE_PRED_DELETE_FILE}"
-        msg = file_name
-        send_2(op, msg, successor_ip, self.db_port)       # Replicate pred
+        self.storage.apply('files', 'del', file_name)
+        op = REPLICATE_PRED_DELETE_FILE
+        msg = [file_name]
+        send_op(op, msg, successor_ip, self.db_port)       # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_DELETE_FILE}"
-            msg = file_name
-            send_2(op, msg, predecesor_ip, self.db_port)       # Replicate succ
-        self.save_files()
+            op = REPLICATE_SUCC_DELETE_FILE
+            msg = [file_name]
+            send_op(op, msg, predecesor_ip, self.db_port)       # Replicate succ
 
     def remove_tag(self, file_name: str, tag: str, successor_ip: str, predecesor_ip: str = None):
         """Removes tag from given file name storage"""
-        self.files[file_name].remove(tag)
-        op = f"{REPLICATE_PRED_REMOVE_TAG}"
-        msg = f"{file_name};{tag}"
-        send_2(op, msg, successor_ip, self.db_port)       # Replicate pred
+        self.storage.apply('files', 'rm', file_name, tag)
+        op = REPLICATE_PRED_REMOVE_TAG
+        msg = [file_name, tag]
+        send_op(op, msg, successor_ip, self.db_port)       # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_REMOVE_TAG}"
-            msg = f"{file_name};{tag}"
-            send_2(op, msg, predecesor_ip, self.db_port)       # Replicate succ
-        self.save_files()
+            op = REPLICATE_SUCC_REMOVE_TAG
+            msg = [file_name, tag]
+            send_op(op, msg, predecesor_ip, self.db_port)       # Replicate succ
 
-    def retrieve_file(self, file_name: str) -> str:
+    def retrieve_file(self, file_name: str) -> list[str]:
         """Retrieve list of tags associated with given file name"""
-        data = {}
-        if file_name in self.files:
-            value = self.files[file_name]
-            data["data"] = value
-        else:
-            data["data"] = []
-        return json.dumps(data)
+        return list(self.files.get(file_name, ()))
     
     #######################
     # BINS
-    def store_bin(self, file_name: str, bin: bytes, successor_ip: str, predecesor_ip: str = None):
-        """Stores file content"""
-        file_path = f"{self.bins_path}/{file_name}"
-        with open(file_path, 'wb') as file:
-            file.write(bin)
-
-        op = f"{REPLICATE_PRED_STORE_BIN}"
-        send_bin(op, file_name, bin, successor_ip, self.db_port)    # Replicate pred
+    def store_bin(self, file_name: str, sock: socket.socket, length: int, successor_ip: str, predecesor_ip: str = None):
+        """Stores file content read from sock, replicas receive every chunk as it arrives"""
+        replicas = [(REPLICATE_PRED_STORE_BIN, successor_ip)]          # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_STORE_BIN}"
-            send_bin(op, file_name, bin, predecesor_ip, self.db_port)    # Replicate succ
+            replicas.append((REPLICATE_SUCC_STORE_BIN, predecesor_ip))  # Replicate succ
+
+        senders: list[BinSender] = []
+        for op, ip in replicas:
+            try:
+                senders.append(BinSender(op, file_name, length, ip, self.db_port))
+            except Exception:
+                print(f"[*] {ip} is dead")
+
+        file_path = f"{self.bins_path}/{file_name}"
+        try:
+            recv_bin_file(sock, length, file_path, senders)
+        except BaseException:
+            for sender in senders:
+                sender.abort()
+            raise
+
+        for sender in senders:
+            try:
+                sender.close()
+            except Exception:
+                print(f"[*] {sender.ip} is dead")
 
     def delete_bin(self, file_name: str, successor_ip: str, predecesor_ip: str = None):
         """Deletes file content"""
         file_path = f"{self.bins_path}/{file_name}"
         os.remove(file_path)
 
-        op = f"{REPLICATE_PRED_DELETE_BIN}"
-        msg = file_name
-        send_2(op, msg, successor_ip, self.db_port)                 # Replicate pred
+        op = REPLICATE_PRED_DELETE_BIN
+        msg = [file_name]
+        send_op(op, msg, successor_ip, self.db_port)                 # Replicate pred
         if predecesor_ip:
-            op = f"{REPLICATE_SUCC_DELETE_BIN}"
-            msg = file_name
-            send_2(op, msg, predecesor_ip, self.db_port)                 # Replicate succ
+            op = REPLICATE_SUCC_DELETE_BIN
+            msg = [file_name]
+            send_op(op, msg, predecesor_ip, self.db_port)                 # Replicate succ
 
-    def retrieve_bin(self, file_name: str) -> bytes:
+    def send_bin(self, sock: socket.socket, file_name: str, req_id: int = 0) -> int:
+        """Sends file content as the payload of an OK frame straight from disk"""
         file_path = f"{self.bins_path}/{file_name}"
-        
-        content = []
-        with open(file_path, 'rb') as file:
-            while True:
-                fragment = file.read(1024)
-                if not fragment:
-                    break
-                content.append(fragment)
-            bin = b''.join(content)
-
-        return bin
+        return send_file_frame(sock, OK, file_path, req_id)
     
     ############################################################################################
 
@@ -305,74 +279,56 @@ class Database:
     # Function to assume data from old failed owner
     def assume_data(self, successor_ip: str, new_predecessor_ip: str = None, assume_predpred: str = None):
         print(f"[📥] Assuming predecesor data")
+        # Assumed keys are owned as well, a later delegation must not drop them
+        self.rejoining = False
 
         # Assume replicated tags
-        self.tags.update(self.replicated_pred_tags)
-        print(f"[📥] {len(self.replicated_pred_tags.items())} tags assumed from predecesor")
-        self.replicated_pred_tags = {}
-        self.save_tags()
-        self.save_replicated_pred_tags()
-
-        # Assume replicated bins
-        for k, _ in self.replicated_pred_files.items():
-            # Read bin
+        print(f"[📥] {len(self.replicated_pred_tags)} tags assumed from predecesor")
+        with self.storage.batch():
+            self.storage.apply('tags', 'merge', value=self.replicated_pred_tags)
+            self.storage.apply('replicated_pred_tags', 'reset', value={})
+
+        # Assume replicated bins, moved within the node directory without copying them
+        for k, _ in list(self.replicated_pred_files.items()):
             file_path = f"{self.replicated_pred_bins_path}/{k}"
-            content = []
-            with open(file_path, 'rb') as file:
-                while True:
-                    data = file.read(1024)
-                    if not data:
-                        break
-                    content.append(data)
-                content = b''.join(content)
-
-            # Write bin
-            new_file_path = f"{self.bins_path}/{k}"
-            with open(new_file_path, 'wb') as file:
-                file.write(content)
-
-            # Delete replicated bin
-            os.remove(file_path)
+            self.bin_hashes.pop(file_path, None)
+            os.replace(file_path, f"{self.bins_path}/{k}")
 
         # Assume replicated files
-        self.files.update(self.replicated_pred_files)
-        print(f"[📥] {len(self.replicated_pred_files.items())} files assumed from predecesor")
-        self.replicated_pred_files = {}
-        self.save_files()
-        self.save_replicated_pred_files()
+        print(f"[📥] {len(self.replicated_pred_files)} files assumed from predecesor")
+        with self.storage.batch():
+            self.storage.apply('files', 'merge', value=self.replicated_pred_files)
+            self.storage.apply('replicated_pred_files', 'reset', value={})
 
 
 
         # Assume predpred data
         if assume_predpred:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((assume_predpred, self.db_port))
-
-                # Ask for replicated data
-                s.sendall(f"{PULL_SUCC_REPLICA}".encode('utf-8'))
+            stats = TransferStats()
 
+            # Ask for replicated data
+            s, flags = self.open_conversation(assume_predpred, PULL_SUCC_REPLICA)
+            with s:
                 # Receive tags
-                tags_json_str = s.recv(1024).decode('utf-8')
-                tags_data = json.loads(tags_json_str)
+                tags_data = unpack_map(recv_payload(s, stats), flags)
 
-                s.sendall(f"{OK}".encode('utf-8'))
+                send_ack(s)
 
                 # Receive files
-                files_json_str = s.recv(1024).decode('utf-8')
-                files_data = json.loads(files_json_str)
+                files_data = unpack_map(recv_payload(s, stats), flags)
 
-                s.sendall(f"{OK}".encode('utf-8'))
+                send_ack(s)
                 
                 # Receive and write bins
-                recv_write_bins(s, self.bins_path)
+                recv_write_bins(s, self.bins_path, stats)
+                stats.report(f"Pulled successor replicas from {assume_predpred}")
 
                 # Overwrite replicated tags and files
-                self.tags.update(tags_data)
-                self.files.update(files_data)
+                with self.storage.batch():
+                    self.storage.apply('tags', 'merge', value=tags_data)
+                    self.storage.apply('files', 'merge', value=files_data)
                 print(tags_data)
                 print(files_data)
-                self.save_tags()
-                self.save_files()
 
                 print(f"[📥] {len(tags_data.items())} tags assumed from predpred")
                 print(f"[📥] {len(files_data.items())} files assumed from predpred")
@@ -396,7 +352,9 @@ class Database:
 
 
     # Function to delegate data to the new incoming owner
-    def delegate_data(self, new_owner_ip: str, successor_ip: str, predecessor_ip: str, case_2: bool):
+    def delegate_data(self, new_owner_ip: str, successor_ip: str, predecessor_ip: str, case_2: bool, old_pred_ip: str = None):
+        if new_owner_ip == self.db_ip:
+            return
         print(f"[📤] Delegating data to {new_owner_ip}")
         i_t = 0
         i_f = 0
@@ -404,68 +362,76 @@ class Database:
         new_owner_id = getShaRepr(new_owner_ip)
         my_id = getShaRepr(self.db_ip)
 
+        # Taken from snapshots of the tables, writers keep changing them meanwhile
         tags_to_delegate = {}
-        for k, v in self.tags.items():
+        for k, v in self.export(self.tags).items():
             tag_hash = getShaRepr(k)
             if not inbetween(tag_hash, new_owner_id, my_id):
                 tags_to_delegate[k] = v
                 i_t+=1
 
         files_to_delegate = {}
-        for k, v in self.files.items():
+        for k, v in self.export(self.files).items():
             file_name_hash = getShaRepr(k)
             if not inbetween(file_name_hash, new_owner_id, my_id):
                 files_to_delegate[k] = v
                 i_f+=1
 
         # Send corresponding data to new owner
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((new_owner_ip, self.db_port))
-            s.sendall(f"{PUSH_DATA}".encode('utf-8'))
-            
-            ack = s.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+        stats = TransferStats()
+        s, flags = self.open_conversation(new_owner_ip, PUSH_DATA)
+        with s:
+            # Receive what the new owner already has, a restarted node may keep most of it
+            tags_digest = unpack_map(recv_payload(s, stats), flags)
+            send_ack(s)
+            files_digest = unpack_map(recv_payload(s, stats), flags)
+            rejoining = recv_data(s) == b"1"
+            # It must only drop keys of the range I answered for until it joined, (old predecessor, new owner],
+            # that I do not have anymore. Any other key it holds is owned or replicated for someone else,
+            # unless it is rejoining after a restart: its whole owned tables are then stale and diffed with mine
+            old_pred_id = getShaRepr(old_pred_ip) if old_pred_ip else None
+            handed_over = lambda k: old_pred_id is not None and inbetween(getShaRepr(k), old_pred_id, new_owner_id)
+            scope = None if rejoining else handed_over
+            tags_changed, tags_dropped = self.diff(tags_to_delegate, tags_digest, scope=scope)
+            files_changed, files_dropped = self.diff(files_to_delegate, files_digest, self.bins_path, scope)
 
             # Send tags
-            tags_json_str = json.dumps(tags_to_delegate)
-            s.sendall(tags_json_str.encode('utf-8'))
-
-            ack = s.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            send_payload(s, pack_map(tags_changed, flags), flags, stats)
+            recv_ack(s)
 
             # Send files
-            files_json_str = json.dumps(files_to_delegate)
-            s.sendall(files_json_str.encode('utf-8'))
+            send_payload(s, pack_map(files_changed, flags), flags, stats)
+            recv_ack(s)
 
-            ack = s.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            # Send keys it must drop
+            send_payload(s, pack_map({'tags': tags_dropped, 'files': files_dropped}, flags), flags, stats)
+            recv_ack(s)
             
             # Send bins
-            send_bins(s, files_to_delegate, self.bins_path)
+            send_bins(s, files_changed, self.bins_path, flags=flags, stats=stats)
+            stats.report(f"Delegated data to {new_owner_ip}")
             
             # Send ip
-            
-            s.sendall(f"{self.db_ip};{"1" if case_2 else "0"}".encode('utf-8'))
+            case_2_str = "1" if case_2 else "0"
+            send_data(s, pack_fields([self.db_ip, case_2_str], flags, ';'))
+
+            # Wait until the new owner has the data on disk before dropping my copy
+            recv_ack(s)
             s.close()
 
-        print(f"[📤] {i_t} tags delegated")
-        print(f"[📤] {i_f} files delegated")
+        print(f"[📤] {i_t} tags delegated, {len(tags_changed)} sent")
+        print(f"[📤] {i_f} files delegated, {len(files_changed)} sent")
 
         # Delete not corresponding data
-        for k, v in tags_to_delegate.items():
-            del self.tags[k]
-        for k, v in files_to_delegate.items():
-            del self.files[k]
+        with self.storage.batch():
+            for k, v in tags_to_delegate.items():
+                self.storage.apply('tags', 'del', k)
+            for k, v in files_to_delegate.items():
+                self.storage.apply('files', 'del', k)
         for k, _ in files_to_delegate.items():
             file_path = f"{self.bins_path}/{k}"
             os.remove(file_path)
 
-        self.save_tags()
-        self.save_files()
-
         # Let know my successor i have new data
         self.send_fetch_notification(successor_ip)
 
@@ -474,98 +440,156 @@ class Database:
 
 
 
-    # Function to pull all data from node's predecessor and store it in replication dict
+    # Function to pull all data from node's predecessor (or successor) and store it in its replication tables.
+    # When i keep replicas of several nodes of one host on this side, all of them are pulled, each one only
+    # dropping keys of its own range or of no range at all
     def pull_replication(self, owner_ip: str, is_pred: bool = True):
-
-        if is_pred:
-            print(f"[📩] I pulled replication from {owner_ip}, con ispred True")
-
-            # Delete current replicates
-            for k, _ in self.replicated_pred_files.items():
-                os.remove(f"{self.replicated_pred_bins_path}/{k}")
-            self.replicated_pred_tags = {}
-            self.replicated_pred_files = {}
+        sources = self.replica_sources(is_pred) if self.replica_sources else []
+        if len(sources) <= 1:
+            self.pull_replica(sources[0][1] if sources else owner_ip, is_pred)
+            return
+
+        first_id, last_id = getShaRepr(sources[0][0]), getShaRepr(sources[-1][1])
+        for start_ip, source_ip in sources:
+            start_id, source_id = getShaRepr(start_ip), getShaRepr(source_ip)
+            scope = lambda k: inbetween(getShaRepr(k), start_id, source_id) or not inbetween(getShaRepr(k), first_id, last_id)
+            self.pull_replica(source_ip, is_pred, scope)
+
+    # Function to pull the data of one node into my replication tables, scope limits the keys it may drop
+    def pull_replica(self, owner_ip: str, is_pred: bool = True, scope: Callable[[str], bool] = None):
+        print(f"[📩] I pulled replication from {owner_ip}, con ispred {is_pred}")
+
+        side = 'pred' if is_pred else 'succ'
+        tags_table, files_table = f"replicated_{side}_tags", f"replicated_{side}_files"
+        bins_path = self.replicated_pred_bins_path if is_pred else self.replicated_succ_bins_path
+
+        # Get actual owner data, only what differs from my current replicas
+        stats = TransferStats()
+
+        # Ask for replication
+        s, flags = self.open_conversation(owner_ip, PULL_REPLICATION)
+        with s:
+            # Send what I already have
+            tags_digest = self.digest(self.storage.table(tags_table))
+            files_digest = self.digest(self.storage.table(files_table), bins_path)
+            if scope:
+                tags_digest = {k: v for k, v in tags_digest.items() if scope(k)}
+                files_digest = {k: v for k, v in files_digest.items() if scope(k)}
+            send_payload(s, pack_map(tags_digest, flags), flags, stats)
+            recv_ack(s)
+            send_payload(s, pack_map(files_digest, flags), flags, stats)
+
+            # Receive tags
+            tags_data = unpack_map(recv_payload(s, stats), flags)
+
+            send_ack(s)
+
+            # Receive files
+            files_data = unpack_map(recv_payload(s, stats), flags)
+
+            send_ack(s)
+
+            # Receive keys to drop
+            dropped = unpack_map(recv_payload(s, stats), flags)
+
+            send_ack(s)
             
-            # Get actual predecesor replicas
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((owner_ip, self.db_port))
+            # Receive and write bins
+            recv_write_bins(s, bins_path, stats)
+            stats.report(f"Pulled replication from {owner_ip}")
 
-                # Ask for replication
-                s.sendall(f"{PULL_REPLICATION}".encode('utf-8'))
+            # Bring replicated tags and files in line with the owner
+            self.apply_diff(tags_table, files_table, bins_path, tags_data, files_data, dropped)
 
-                # Receive tags
-                tags_json_str = s.recv(1024).decode('utf-8')
-                tags_data = json.loads(tags_json_str)
+            s.close()
 
-                s.sendall(f"{OK}".encode('utf-8'))
 
-                # Receive files
-                files_json_str = s.recv(1024).decode('utf-8')
-                files_data = json.loads(files_json_str)
 
-                s.sendall(f"{OK}".encode('utf-8'))
-                
-                # Receive and write bins
-                recv_write_bins(s, self.replicated_pred_bins_path)
+    # Method to get the hash of a bin, cached until the file is rewritten
+    def bin_hash(self, file_path: str) -> str:
+        if not os.path.isfile(file_path):
+            return ''
+        stat = os.stat(file_path)
+        cached = self.bin_hashes.get(file_path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return cached[1]
+        sha = hashlib.sha1()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+        self.bin_hashes[file_path] = ((stat.st_size, stat.st_mtime_ns), sha.hexdigest())
+        return sha.hexdigest()
+
+    # Method to copy a table with its posting lists as plain lists, as it is sent to peers
+    def export(self, table: Mapping[str, Collection[str]]) -> dict[str, list[str]]:
+        return {k: list(v) for k, v in list(table.items())}
+
+    # Method to get the digest of a table, key -> [hash of its list] plus the hash of its bin if bins_path is given
+    def digest(self, table: Mapping[str, Collection[str]], bins_path: str = None) -> dict[str, list[str]]:
+        result = {}
+        for k, v in self.export(table).items():
+            result[k] = [list_hash(v), self.bin_hash(f"{bins_path}/{k}")] if bins_path else [list_hash(v)]
+        return result
+
+    # Method to get the entries that differ from a peer digest, and the keys of the digest in scope that are not entries
+    def diff(self, entries: dict[str, list[str]], digest: dict[str, list[str]], bins_path: str = None, scope: Callable[[str], bool] = None) -> tuple[dict, list[str]]:
+        changed = {}
+        for k, v in entries.items():
+            theirs = digest.get(k)
+            if theirs is None or theirs[0] != list_hash(v) or (bins_path and theirs[1] != self.bin_hash(f"{bins_path}/{k}")):
+                changed[k] = v
+        dropped = [k for k in digest if k not in entries and (scope is None or scope(k))]
+        return changed, dropped
+
+    # Method to apply the changed entries and dropped keys sent by a peer to a pair of tables and their bins
+    def apply_diff(self, tags_table: str, files_table: str, bins_path: str, tags: dict, files: dict, dropped: dict):
+        with self.storage.batch():
+            self.storage.apply(tags_table, 'merge', value=tags)
+            self.storage.apply(files_table, 'merge', value=files)
+            for k in dropped['tags']:
+                self.storage.apply(tags_table, 'del', k)
+            for k in dropped['files']:
+                self.storage.apply(files_table, 'del', k)
+        for k in dropped['files']:
+            file_path = f"{bins_path}/{k}"
+            self.bin_hashes.pop(file_path, None)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        print(f"[📥] {len(tags)} tags and {len(files)} files updated, {len(dropped['tags'])} tags and {len(dropped['files'])} files dropped")
+
+    # Method to wait until every mutation applied so far is on disk, writes are otherwise committed in groups
+    def flush(self):
+        self.storage.flush()
 
-                # Overwrite replicated tags and files
-                self.replicated_pred_tags = tags_data
-                self.replicated_pred_files = files_data
 
-                self.save_replicated_pred_tags()
-                self.save_replicated_pred_files()
+    
 
+    # Method to open a conversation with the database of a peer, its first ack tells the peer admitted it
+    def open_conversation(self, ip: str, op: int) -> tuple[socket.socket, int]:
+        """Returns the connected socket and the flags negotiated with the peer, a busy peer is retried with backoff"""
+        flags = pool.flags(ip, self.db_port)
+        for attempt in range(DEFAULT_BUSY_RETRIES + 1):
+            s = socket.create_connection(endpoint(ip, self.db_port), timeout=DEFAULT_CONNECT_TIMEOUT)
+            s.settimeout(None)
+            try:
+                send_frame(s, op, flags=flags)
+                recv_ack(s)
+                return s, flags
+            except BusyError:
                 s.close()
-
-        else:
-            print(f"[📩] I pulled replication from {owner_ip}, con ispred False")
-
-            # Delete current replicates
-            for k, _ in self.replicated_succ_files.items():
-                os.remove(f"{self.replicated_succ_bins_path}/{k}")
-            self.replicated_succ_tags = {}
-            self.replicated_succ_files = {}
-            
-            # Get actual predecesor replicas
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((owner_ip, self.db_port))
-
-                # Ask for replication
-                s.sendall(f"{PULL_REPLICATION}".encode('utf-8'))
-
-                # Receive tags
-                tags_json_str = s.recv(1024).decode('utf-8')
-                tags_data = json.loads(tags_json_str)
-
-                s.sendall(f"{OK}".encode('utf-8'))
-
-                # Receive files
-                files_json_str = s.recv(1024).decode('utf-8')
-                files_data = json.loads(files_json_str)
-
-                s.sendall(f"{OK}".encode('utf-8'))
-                
-                # Receive and write bins
-                recv_write_bins(s, self.replicated_succ_bins_path)
-
-                # Overwrite replicated tags and files
-                self.replicated_succ_tags = tags_data
-                self.replicated_succ_files = files_data
-
-                self.save_replicated_succ_tags()
-                self.save_replicated_succ_files()
-
+                if attempt == DEFAULT_BUSY_RETRIES:
+                    print(f"[*] {ip} stayed busy, operation {op} given up")
+                    raise
+                print(f"[*] {ip} is busy, retrying operation {op}")
+                time.sleep(DEFAULT_BUSY_BACKOFF * 2 ** attempt)
+            except BaseException:
                 s.close()
-
-        # print(f"[📩] I pulled replication from {owner_ip}")
-
-
-    
+                raise
 
     # Function to notify my replications listeners, that my data has changed
     def send_fetch_notification(self, target_ip: str, is_pred: bool = True):
         is_pred_str = "1" if is_pred else "0"
-        threading.Thread(target=send_2, args=(f"{FETCH_REPLICA}", f"{self.db_ip};{is_pred_str}", target_ip, self.db_port), daemon=True).start()
+        threading.Thread(target=send_op, args=(FETCH_REPLICA, [self.db_ip, is_pred_str], target_ip, self.db_port), daemon=True).start()
 
     ########################################################################################
 
@@ -574,288 +598,251 @@ class Database:
 
 
     def _recv(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((self.db_ip, self.db_port))
-        sock.listen(10)
+        self.runtime.serve(self.db_ip, self.db_port, self._handle_recv, nested_ops=DB_NESTED_OPS)
 
-        while True:
-            conn, _ = sock.accept()
-            data = conn.recv(1024).decode('utf-8')
-            threading.Thread(target=self._handle_recv, args=(conn, data)).start()
 
-
-    def _handle_recv(self, conn: socket.socket, data: str):
+    def _handle_recv(self, conn: socket.socket, frame: Frame):
+        op = frame.op
+        fields = unpack_fields(frame.payload, frame.flags, ';')
 
         # PRED
-        if data == f"{REPLICATE_PRED_STORE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            tag = conn.recv(1024).decode('utf-8')
-            self.replicated_pred_tags[tag] = []
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_tags()
-
-        elif data == f"{REPLICATE_PRED_APPEND_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            tag, file_name = data[0], data[1]
-            self.replicated_pred_tags[tag].append(file_name)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_tags()
-
-        elif data == f"{REPLICATE_PRED_DELETE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            tag = conn.recv(1024).decode('utf-8')
-            del self.replicated_pred_tags[tag]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_tags()
-
-        elif data == f"{REPLICATE_PRED_REMOVE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            tag, file_name = data[0], data[1]
-            self.replicated_pred_tags[tag].remove(file_name)
-            if len(self.replicated_pred_tags[tag]) == 0:
-                del self.replicated_pred_tags[tag]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_tags()
+        if op == REPLICATE_PRED_STORE_TAG:
+            tag = fields[0]
+            self.storage.apply('replicated_pred_tags', 'put', tag, [])
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_APPEND_FILE:
+            tag, file_name = fields
+            self.storage.apply('replicated_pred_tags', 'add', tag, file_name)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_DELETE_TAG:
+            tag = fields[0]
+            self.storage.apply('replicated_pred_tags', 'del', tag)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_REMOVE_FILE:
+            tag, file_name = fields
+            self.storage.apply('replicated_pred_tags', 'discard', tag, file_name)
+            send_ack(conn, frame.req_id)
 
 
         
-        elif data == f"{REPLICATE_PRED_STORE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            self.replicated_pred_files[file_name] = []
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_files()
-
-        elif data == f"{REPLICATE_PRED_APPEND_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            file_name, tag = data[0], data[1]
-            self.replicated_pred_files[file_name].append(tag)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_files()
-
-        elif data == f"{REPLICATE_PRED_DELETE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            del self.replicated_pred_files[file_name]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_files()
-
-        elif data == f"{REPLICATE_PRED_REMOVE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            file_name, tag = data[0], data[1]
-            self.replicated_pred_files[file_name].remove(tag)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_pred_files()
+        elif op == REPLICATE_PRED_STORE_FILE:
+            file_name = fields[0]
+            self.storage.apply('replicated_pred_files', 'put', file_name, [])
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_APPEND_TAG:
+            file_name, tag = fields
+            self.storage.apply('replicated_pred_files', 'add', file_name, tag)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_DELETE_FILE:
+            file_name = fields[0]
+            self.storage.apply('replicated_pred_files', 'del', file_name)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_REMOVE_TAG:
+            file_name, tag = fields
+            self.storage.apply('replicated_pred_files', 'rm', file_name, tag)
+            send_ack(conn, frame.req_id)
 
 
         
-        elif data == f"{REPLICATE_PRED_STORE_BIN}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            conn.sendall(f"{OK}".encode('utf-8'))
-            bin = conn.recv(1024)
-            with open(f"{self.replicated_pred_bins_path}/{file_name}", 'wb') as file:
-                file.write(bin)
-            conn.sendall(f"{OK}".encode('utf-8'))
-
-        elif data == f"{REPLICATE_PRED_DELETE_BIN}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
+        elif op == REPLICATE_PRED_STORE_BIN:
+            file_name = fields[0]
+            send_ack(conn, frame.req_id)
+            _, _, _, length = recv_header(conn)
+            recv_bin_file(conn, length, f"{self.replicated_pred_bins_path}/{file_name}")
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_PRED_DELETE_BIN:
+            file_name = fields[0]
             file_path = f"{self.replicated_pred_bins_path}/{file_name}"
             os.remove(file_path)
-            conn.sendall(f"{OK}".encode('utf-8'))
+            send_ack(conn, frame.req_id)
 
 
 
 
         # SUCC
-        elif data == f"{REPLICATE_SUCC_STORE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            tag = conn.recv(1024).decode('utf-8')
-            self.replicated_succ_tags[tag] = []
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_tags()
-
-        elif data == f"{REPLICATE_SUCC_APPEND_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            tag, file_name = data[0], data[1]
-            self.replicated_succ_tags[tag].append(file_name)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_tags()
-
-        elif data == f"{REPLICATE_SUCC_DELETE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            tag = conn.recv(1024).decode('utf-8')
-            del self.replicated_succ_tags[tag]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_tags()
-
-        elif data == f"{REPLICATE_SUCC_REMOVE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            tag, file_name = data[0], data[1]
-            self.replicated_succ_tags[tag].remove(file_name)
-            if len(self.replicated_succ_tags[tag]) == 0:
-                del self.replicated_succ_tags[tag]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_tags()
+        elif op == REPLICATE_SUCC_STORE_TAG:
+            tag = fields[0]
+            self.storage.apply('replicated_succ_tags', 'put', tag, [])
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_APPEND_FILE:
+            tag, file_name = fields
+            self.storage.apply('replicated_succ_tags', 'add', tag, file_name)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_DELETE_TAG:
+            tag = fields[0]
+            self.storage.apply('replicated_succ_tags', 'del', tag)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_REMOVE_FILE:
+            tag, file_name = fields
+            self.storage.apply('replicated_succ_tags', 'discard', tag, file_name)
+            send_ack(conn, frame.req_id)
 
 
         
-        elif data == f"{REPLICATE_SUCC_STORE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            self.replicated_succ_files[file_name] = []
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_files()
-
-        elif data == f"{REPLICATE_SUCC_APPEND_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            file_name, tag = data[0], data[1]
-            self.replicated_succ_files[file_name].append(tag)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_files()
-
-        elif data == f"{REPLICATE_SUCC_DELETE_FILE}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            del self.replicated_succ_files[file_name]
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_files()
-
-        elif data == f"{REPLICATE_SUCC_REMOVE_TAG}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            data = conn.recv(1024).decode('utf-8').split(';')
-            file_name, tag = data[0], data[1]
-            self.replicated_succ_files[file_name].remove(tag)
-            conn.sendall(f"{OK}".encode('utf-8'))
-            self.save_replicated_succ_files()
+        elif op == REPLICATE_SUCC_STORE_FILE:
+            file_name = fields[0]
+            self.storage.apply('replicated_succ_files', 'put', file_name, [])
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_APPEND_TAG:
+            file_name, tag = fields
+            self.storage.apply('replicated_succ_files', 'add', file_name, tag)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_DELETE_FILE:
+            file_name = fields[0]
+            self.storage.apply('replicated_succ_files', 'del', file_name)
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_REMOVE_TAG:
+            file_name, tag = fields
+            self.storage.apply('replicated_succ_files', 'rm', file_name, tag)
+            send_ack(conn, frame.req_id)
 
 
         
-        elif data == f"{REPLICATE_SUCC_STORE_BIN}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
-            conn.sendall(f"{OK}".encode('utf-8'))
-            bin = conn.recv(1024)
-            with open(f"{self.replicated_succ_bins_path}/{file_name}", 'wb') as file:
-                file.write(bin)
-            conn.sendall(f"{OK}".encode('utf-8'))
-
-        elif data == f"{REPLICATE_SUCC_DELETE_BIN}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-            file_name = conn.recv(1024).decode('utf-8')
+        elif op == REPLICATE_SUCC_STORE_BIN:
+            file_name = fields[0]
+            send_ack(conn, frame.req_id)
+            _, _, _, length = recv_header(conn)
+            recv_bin_file(conn, length, f"{self.replicated_succ_bins_path}/{file_name}")
+            send_ack(conn, frame.req_id)
+
+        elif op == REPLICATE_SUCC_DELETE_BIN:
+            file_name = fields[0]
             file_path = f"{self.replicated_succ_bins_path}/{file_name}"
             os.remove(file_path)
-            conn.sendall(f"{OK}".encode('utf-8'))
+            send_ack(conn, frame.req_id)
+
 
 
 
 
 
+        elif op == PUSH_DATA:
+            stats = TransferStats()
+            send_ack(conn, frame.req_id)
 
-        elif data == f"{PUSH_DATA}":
-            conn.sendall(f"{OK}".encode('utf-8'))
+            # Send what I already have, only what differs is delegated
+            send_payload(conn, pack_map(self.digest(self.tags), frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
+            send_payload(conn, pack_map(self.digest(self.files, self.bins_path), frame.flags), frame.flags, stats, frame.req_id)
+            # Tell whether my tables are left by a previous run, all of them are diffed then
+            send_data(conn, "1" if self.rejoining else "0", frame.req_id)
 
-            # Receive and update tags
-            tags_json_str = conn.recv(1024).decode('utf-8')
-            new_tags = json.loads(tags_json_str)
-            self.tags.update(new_tags)
-            self.save_tags()
+            # Receive tags
+            new_tags = unpack_map(recv_payload(conn, stats), frame.flags)
 
-            conn.sendall(f"{OK}".encode('utf-8'))
+            send_ack(conn, frame.req_id)
 
-            # Receive and update files
-            files_json_str = conn.recv(1024).decode('utf-8')
-            new_files = json.loads(files_json_str)
-            self.files.update(new_files)
-            self.save_files()
+            # Receive files
+            new_files = unpack_map(recv_payload(conn, stats), frame.flags)
 
-            conn.sendall(f"{OK}".encode('utf-8'))
+            send_ack(conn, frame.req_id)
+
+            # Receive keys to drop
+            dropped = unpack_map(recv_payload(conn, stats), frame.flags)
+
+            send_ack(conn, frame.req_id)
 
             # Receive and write bins
-            recv_write_bins(conn, self.bins_path)
+            recv_write_bins(conn, self.bins_path, stats)
+            self.apply_diff('tags', 'files', self.bins_path, new_tags, new_files, dropped)
+            self.rejoining = False
+            stats.report("Received delegated data")
             
             # Send IP
-            ip, is_pred = conn.recv(1024).decode('utf-8').split(";")
-
-            # Let my sucessor know i have new data
-            self.send_fetch_notification(ip)
+            ip, is_pred = unpack_fields(recv_data(conn), frame.flags, ';')
+
+            # The sender drops its copy once i acknowledge it, so it must be on disk first
+            self.flush()
+            send_ack(conn, frame.req_id)
+
+            # Let the nodes keeping my replicas know i have new data
+            if self.replica_targets:
+                succ_ip, pred_ip = self.replica_targets()
+                self.send_fetch_notification(succ_ip)
+                if pred_ip:
+                    self.send_fetch_notification(pred_ip, False)
+            else:
+                # Let my sucessor know i have new data
+                self.send_fetch_notification(ip)
 
-            # Let my predecessor know i have new data
-            if is_pred == "1":
-                self.send_fetch_notification(ip, False)
+                # Let my predecessor know i have new data
+                if is_pred == "1":
+                    self.send_fetch_notification(ip, False)
         
 
-        # Send all my stored data
-        elif data == f"{PULL_REPLICATION}":
-            # Send tags
-            tags_json_str = json.dumps(self.tags)
-            conn.sendall(tags_json_str.encode('utf-8'))
+        # Send my stored data that differs from the replicas of the requester
+        elif op == PULL_REPLICATION:
+            stats = TransferStats()
+            send_ack(conn, frame.req_id)
+            tags, files = self.export(self.tags), self.export(self.files)
 
-            ack = conn.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            # Receive what the requester already has
+            tags_digest = unpack_map(recv_payload(conn, stats), frame.flags)
+            send_ack(conn, frame.req_id)
+            files_digest = unpack_map(recv_payload(conn, stats), frame.flags)
+            tags_changed, tags_dropped = self.diff(tags, tags_digest)
+            files_changed, files_dropped = self.diff(files, files_digest, self.bins_path)
+
+            # Send tags
+            send_payload(conn, pack_map(tags_changed, frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
 
             # Send files
-            files_json_str = json.dumps(self.files)
-            conn.sendall(files_json_str.encode('utf-8'))
+            send_payload(conn, pack_map(files_changed, frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
 
-            ack = conn.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            # Send keys to drop
+            send_payload(conn, pack_map({'tags': tags_dropped, 'files': files_dropped}, frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
             
             # Send bins
-            send_bins(conn, self.files, self.bins_path)
+            send_bins(conn, files_changed, self.bins_path, flags=frame.flags, stats=stats)
+            stats.report("Sent replication")
 
 
 
         # Send all my stored successor replicas
-        elif data == f"{PULL_SUCC_REPLICA}":
+        elif op == PULL_SUCC_REPLICA:
+            stats = TransferStats()
+            send_ack(conn, frame.req_id)
+            tags, files = self.export(self.replicated_succ_tags), self.export(self.replicated_succ_files)
             # Send tags
-            tags_json_str = json.dumps(self.replicated_succ_tags)
-            conn.sendall(tags_json_str.encode('utf-8'))
-
-            ack = conn.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            send_payload(conn, pack_map(tags, frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
 
             # Send files
-            files_json_str = json.dumps(self.replicated_succ_files)
-            conn.sendall(files_json_str.encode('utf-8'))
-
-            ack = conn.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+            send_payload(conn, pack_map(files, frame.flags), frame.flags, stats, frame.req_id)
+            recv_ack(conn)
             
             # Send bins
-            send_bins(conn, self.replicated_succ_files, self.replicated_succ_bins_path)
+            send_bins(conn, files, self.replicated_succ_bins_path, flags=frame.flags, stats=stats)
+            stats.report("Sent successor replicas")
 
     
 
         # Pull data to replicate
-        elif data == f"{FETCH_REPLICA}":
-            conn.sendall(f"{OK}".encode('utf-8'))
-
-            ip, is_pred = conn.recv(1024).decode('utf-8').split(';')
+        elif op == FETCH_REPLICA:
+            ip, is_pred = fields
             
             if is_pred == "1":
                 self.pull_replication(ip, True)
             else:
                 self.pull_replication(ip, False)
 
-            conn.sendall(f"{OK}".encode('utf-8'))
-
-
-
-        conn.close()
+            send_ack(conn, frame.req_id)
 
     
 
@@ -0,0 +1,109 @@
+import math
+import time
+import threading
+from collections import deque
+from const import *
+
+
+class PeerState:
+    """Arrival history of one peer"""
+
+    def __init__(self):
+        self.intervals: deque[float] = deque(maxlen=DEFAULT_PHI_WINDOW)
+        self.last_heard: float = None
+        self.failed_at: float = None
+
+
+class FailureDetector:
+    """Phi accrual failure detector fed by every request to a peer.
+
+    Each response counts as a heartbeat of the peer. Suspicion (phi) grows with the
+    time since the last one, relative to the usual gap between them. While phi is
+    under threshold the peer is trusted without dialing it, above it the peer is
+    probed. A failed request marks it down for retry_after seconds, after that it is
+    probed until a response clears it."""
+
+    def __init__(self, threshold: float = DEFAULT_PHI_THRESHOLD, retry_after: float = DEFAULT_SUSPECT_RETRY):
+        self.threshold = threshold
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.peers: dict[str, PeerState] = {}
+        self.listeners = []     # Called with the ip of every peer that starts failing
+
+        # Counters
+        self.trusted = 0
+        self.suspected = 0
+        self.probes = 0
+
+    def heard(self, ip: str):
+        """Records a response from ip"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.peers.setdefault(ip, PeerState())
+            if state.last_heard is not None:
+                state.intervals.append(now - state.last_heard)
+            state.last_heard = now
+            state.failed_at = None
+
+    def failed(self, ip: str):
+        """Records a request to ip that could not connect or got no response"""
+        with self.lock:
+            state = self.peers.setdefault(ip, PeerState())
+            newly_failed = state.failed_at is None
+            state.failed_at = time.monotonic()
+        if newly_failed:
+            for listener in self.listeners:
+                listener(ip)
+
+    def add_listener(self, callback):
+        """Registers callback(ip) to be told when a peer starts failing"""
+        self.listeners.append(callback)
+
+    def suspects(self, ip: str) -> bool:
+        """Returns whether a request to ip failed lately, without probing it"""
+        with self.lock:
+            state = self.peers.get(ip)
+            return state is not None and state.failed_at is not None and time.monotonic() - state.failed_at < self.retry_after
+
+    def phi(self, ip: str) -> float:
+        with self.lock:
+            return self._phi(self.peers.get(ip), time.monotonic())
+
+    def _phi(self, state: PeerState, now: float) -> float:
+        """Suspicion level of a peer (must hold lock), gaps between heartbeats are taken as exponential"""
+        if state is None or state.last_heard is None:
+            return math.inf
+        mean = sum(state.intervals) / len(state.intervals) if state.intervals else DEFAULT_PHI_MIN_INTERVAL
+        mean = max(mean, DEFAULT_PHI_MIN_INTERVAL)
+        return (now - state.last_heard) / (mean * math.log(10))
+
+    def check(self, ip: str, probe) -> bool:
+        """Returns whether ip is alive, calling probe() only when the history of ip is not conclusive"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.peers.get(ip)
+            failed = state is not None and state.failed_at is not None
+            if failed and now - state.failed_at < self.retry_after:
+                self.suspected += 1
+                return False
+            if not failed and self._phi(state, now) < self.threshold:
+                self.trusted += 1
+                return True
+            self.probes += 1
+        return probe()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'trusted': self.trusted,
+                'suspected': self.suspected,
+                'probes': self.probes,
+                'phi': {ip: round(self._phi(state, now), 2) for ip, state in self.peers.items()},
+            }
+
+
+
+# Detector shared by every reference in this process
+detector = FailureDetector()
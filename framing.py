@@ -0,0 +1,134 @@
+import os
+import socket
+import struct
+import itertools
+from collections import namedtuple
+from const import OK, DATA, BUSY
+
+# Frame header: opcode, flags, request id and payload length
+HEADER = struct.Struct('!HHIQ')
+
+# Size of the pieces used to read and write large payloads
+CHUNK_SIZE = 64 * 1024
+
+Frame = namedtuple('Frame', ['op', 'flags', 'req_id', 'payload'])
+
+
+class BusyError(Exception):
+    """The peer rejected the request because all its workers are taken"""
+
+_request_ids = itertools.count(1)
+
+
+# Function to get a new request id for an outgoing request
+def next_request_id() -> int:
+    return next(_request_ids) & 0xFFFFFFFF
+
+
+# Function to read exactly n bytes from a socket
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    """Reads exactly n bytes, raises ConnectionError if the peer closes before"""
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], min(n - received, CHUNK_SIZE))
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return bytes(buffer)
+
+
+# Function to send a frame header, the payload must be sent right after it
+def send_header(sock: socket.socket, op: int, length: int, req_id: int = 0, flags: int = 0):
+    sock.sendall(HEADER.pack(op, flags, req_id, length))
+
+
+# Function to receive a frame header
+def recv_header(sock: socket.socket) -> tuple[int, int, int, int]:
+    """Returns (op, flags, req_id, length) of the next frame"""
+    return HEADER.unpack(recv_exact(sock, HEADER.size))
+
+
+# Function to send a whole frame
+def send_frame(sock: socket.socket, op: int, payload: bytes | str = b'', req_id: int = 0, flags: int = 0):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+
+    header = HEADER.pack(op, flags, req_id, len(payload))
+    if len(payload) <= CHUNK_SIZE:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+# Function to receive a whole frame
+def recv_frame(sock: socket.socket) -> Frame:
+    op, flags, req_id, length = recv_header(sock)
+    payload = recv_exact(sock, length) if length else b''
+    return Frame(op, flags, req_id, payload)
+
+
+# Function to receive a frame payload in chunks, handing each one to write
+def recv_payload_to(sock: socket.socket, length: int, write) -> int:
+    """Passes length bytes from sock to write without holding the payload in memory.
+    Chunks are views of a reused buffer, write must be done with them when it returns"""
+    buffer = bytearray(min(length, CHUNK_SIZE) or 1)
+    view = memoryview(buffer)
+    remaining = length
+    while remaining > 0:
+        count = sock.recv_into(view, min(remaining, len(buffer)))
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        write(view[:count])
+        remaining -= count
+    return length
+
+
+# Function to send a whole file as a frame payload, the kernel copies it to the socket without passing through Python
+def send_file_frame(sock: socket.socket, op: int, file_path: str, req_id: int = 0, flags: int = 0) -> int:
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        send_header(sock, op, size, req_id, flags)
+        if size:
+            sock.sendfile(file, 0, size)
+    return size
+
+
+# Function to iterate a frame payload in chunks of up to CHUNK_SIZE bytes
+def iter_payload(sock: socket.socket, length: int):
+    remaining = length
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        remaining -= len(chunk)
+        yield chunk
+
+
+# Function to send a data frame
+def send_data(sock: socket.socket, payload: bytes | str = b'', req_id: int = 0):
+    send_frame(sock, DATA, payload, req_id)
+
+
+# Function to receive a data frame payload
+def recv_data(sock: socket.socket) -> bytes:
+    frame = recv_frame(sock)
+    if frame.op == BUSY:
+        raise BusyError("Peer is busy")
+    return frame.payload
+
+
+# Function to send an OK ack
+def send_ack(sock: socket.socket, req_id: int = 0):
+    send_frame(sock, OK, b'', req_id)
+
+
+# Function to wait for an OK ack
+def recv_ack(sock: socket.socket):
+    frame = recv_frame(sock)
+    if frame.op == BUSY:
+        raise BusyError("Peer is busy")
+    if frame.op != OK:
+        raise Exception("ACK negativo")
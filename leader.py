@@ -1,8 +1,9 @@
-import json
 import socket
 import threading
-import time
 from const import *
+from framing import *
+from codec import unpack_map
+from runtime import NodeRuntime
 
 
 
@@ -29,7 +30,7 @@ class Resources:
 class RequestNode:
     def __init__(self, sock: socket.socket, tags: list[str], files: list[str], query_tags: list[str], qt_func, end_func) -> None:
         self.sock = sock
-        self.green_light = False
+        self.green_light = threading.Event()
 
         resource_tags = set(tags).union(set(query_tags))
         resource_files = set(qt_func(query_tags))
@@ -38,37 +39,39 @@ class RequestNode:
         self.end_func = end_func
 
     def set_green_light(self):
-        self.green_light = True
+        self.green_light.set()
 
     def start(self):
         # Wait green light
-        while not self.green_light:
-            time.sleep(0.5)
+        self.green_light.wait()
 
-        # Green light now
-        self.sock.sendall(f"{OK}".encode('utf-8'))
+        try:
+            # Green light now
+            send_ack(self.sock)
 
-        ack = self.sock.recv(1024).decode('utf-8')
-        if ack != f"{END}":
-            print("No OK confirmation from operation")
-
-        # Call end function to release resources
-        self.end_func(self)
+            ack = recv_frame(self.sock)
+            if ack.op != END:
+                print("No OK confirmation from operation")
+        finally:
+            # Call end function to release resources, also when the requester is gone
+            self.end_func(self)
 
         
 
 
 
 class Leader:
-    def __init__(self, ip: str, query_tag_function, port: int = DEFAULT_LEADER_PORT):
+    def __init__(self, ip: str, query_tag_function, port: int = DEFAULT_LEADER_PORT, runtime: NodeRuntime = None):
         self.ip = ip
+        self.runtime = runtime or NodeRuntime()
         self.port = port
         self.query_tag_func = query_tag_function
 
+        self.lock = threading.Lock()
         self.blocked_resources: Resources = Resources([], [])
         self.waiting_queue: list[RequestNode] = []
 
-        threading.Thread(target=self._start_leader_server, daemon=True).start()
+        self._start_leader_server()
 
     def block_resources(self, resources: Resources):
         self.blocked_resources.adopt(resources)
@@ -78,47 +81,47 @@ class Leader:
 
     # For new requests
     def join(self, node: RequestNode):
-        # Dont use blocked resources case
-        if not node.resources.use(self.blocked_resources):
-            self.block_resources(node.resources)
-            node.set_green_light()
+        with self.lock:
+            # Dont use blocked resources case
+            if not node.resources.use(self.blocked_resources):
+                self.block_resources(node.resources)
+                node.set_green_light()
 
-        # Use blocked resources case
-        else:
-            self.waiting_queue.append(node)
+            # Use blocked resources case
+            else:
+                self.waiting_queue.append(node)
 
 
     def end_function(self, node: RequestNode):
-        # Release node resources
-        self.release_resources(node.resources)
+        with self.lock:
+            # Release node resources
+            self.release_resources(node.resources)
 
-        # Dequeue node in case it is in the queue
-        if node in self.waiting_queue:
-            self.waiting_queue.remove(node)
+            # Dequeue node in case it is in the queue
+            if node in self.waiting_queue:
+                self.waiting_queue.remove(node)
 
-        # Check if a node in the queue can act now
-        for n in self.waiting_queue:
-            if not n.resources.use(self.blocked_resources):
-                self.block_resources(n.resources)
-                n.set_green_light()
+            # Check if a node in the queue can act now, it leaves the queue once it does
+            for n in list(self.waiting_queue):
+                if not n.resources.use(self.blocked_resources):
+                    self.block_resources(n.resources)
+                    self.waiting_queue.remove(n)
+                    n.set_green_light()
 
 
+    # Every permission keeps its handler until the requester sends END, they run in the nested workers of the port
     def _start_leader_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.ip, self.port))
-            s.listen(10)
-
-            while True:
-                conn, _ = s.accept()
-                json_str_data = conn.recv(1024).decode('utf-8')
+        self.runtime.serve(self.ip, self.port, self.request_leader_handler, nested_ops=LEADER_NESTED_OPS, nested_workers=DEFAULT_LEADER_WORKERS)
 
-                data = json.loads(json_str_data)
 
-                threading.Thread(target=self.request_leader_handler, args=(conn, data['tags'], data['files'], data['query_tags'])).start()
+    def request_leader_handler(self, sock: socket.socket, frame: Frame):
+        if frame.op != REQUEST_PERMISSION:
+            send_data(sock, f"Unrecognized operation: {frame.op}", frame.req_id)
+            return
 
+        data = unpack_map(frame.payload, frame.flags)
+        tags, files, query_tags = data['tags'], data['files'], data['query_tags']
 
-    def request_leader_handler(self, sock: socket.socket, tags: list[str], files: list[str], query_tags: list[str]):
         request_node = RequestNode(sock, tags, files, query_tags, self.query_tag_func, self.end_function)
         self.join(request_node)
         request_node.start() 
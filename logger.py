@@ -1,6 +1,8 @@
 import os
-import time
 import threading
+from const import *
+from connection_pool import pool
+from failure_detector import detector
 
 class Logger():
     def __init__(self, node):
@@ -12,6 +14,7 @@ class Logger():
             with open(self.filename, 'w') as file:
                 pass
 
+        self.node.scheduler.add('logger', DEFAULT_LOG_REFRESH_MIN, DEFAULT_LOG_REFRESH_MAX)
         threading.Thread(target=self.refresh, daemon=True).start()
 
     def format_data(self, list: dict):
@@ -26,7 +29,7 @@ class Logger():
     def refresh(self):
 
         while True:
-            time.sleep(2)
+            self.node.scheduler.wait('logger')
             with open(self.filename, 'w') as file:
                 id = str(self.node.id)
                 succ = str(self.node.succ).split(',')
@@ -43,9 +46,18 @@ class Logger():
 IPv4     : {self.node.ip}
 Id       : ({id[len(id)-3: len(id)]}) - {self.node.id} - {self.node.ip}
 Succ     : ({succ_id[len(succ_id)-3: len(succ_id)]}) - {succ_id} - {succ_ip}
+Succs    : {[node.ip for node in self.node.succ_list]}
 Pred     : ({pred_id[len(pred_id)-3: len(pred_id)]}) - {pred_id} - {pred_ip}
 PredPred : ({predpred_id[len(predpred_id)-3: len(predpred_id)]}) - {predpred_id} - {predpred_ip}
 Leader   : {lead}
+Pool     : {pool.stats()}
+Workers  : {self.node.runtime.stats()}
+Intervals: {self.node.scheduler.stats()}
+Liveness : {detector.stats()}
+Lookups  : {self.node.lookup_cache.stats()}
+Members  : {self.node.ring_view.stats()}
+Routing  : {self.node.routing.stats()}
+Storage  : {self.node.database.storage.stats()}
 
 ------------------------ Owned -------------------------
 🔖 Tags:
@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import OrderedDict
+from const import *
+
+
+class LookupCache:
+    """Bounded LRU of key id -> owner reference resolved by lookup.
+
+    Entries expire after ttl seconds and the whole cache is dropped whenever the
+    node sees the ring change. A hit that is still stale is harmless: requests
+    sent to a node that no longer owns the key are forwarded by it to the owner."""
+
+    def __init__(self, size: int = DEFAULT_LOOKUP_CACHE_SIZE, ttl: float = DEFAULT_LOOKUP_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[int, tuple[object, float]] = OrderedDict()
+        self.epoch = 0      # Incremented on every invalidation
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, id: int):
+        """Returns the cached owner of id, or None"""
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None:
+                self.misses += 1
+                return None
+            owner, expires = entry
+            if time.monotonic() > expires:
+                del self.entries[id]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return owner
+
+    def put(self, id: int, owner, epoch: int):
+        """Stores a resolved owner, unless the ring changed since the lookup started at epoch"""
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.entries[id] = (owner, time.monotonic() + self.ttl)
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+class RoutingStats:
+    """Hops taken by the lookups a node routed through the ring"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hops = 0
+        self.max_hops = 0
+
+    def add(self, hops: int):
+        with self.lock:
+            self.lookups += 1
+            self.hops += hops
+            self.max_hops = max(self.max_hops, hops)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'lookups': self.lookups,
+                'avg_hops': round(self.hops / self.lookups, 2) if self.lookups else 0,
+                'max_hops': self.max_hops,
+            }
@@ -0,0 +1,106 @@
+import time
+import bisect
+import threading
+from const import *
+from utils import getShaRepr
+
+
+class RingView:
+    """Full membership of the ring, spread by gossip, to find the owner of a key without routing.
+
+    Every member has a heartbeat that only it increments, a view keeps the highest one
+    heard of each member and drops those that stopped growing. Heartbeats start from the
+    wall clock, so a node that restarts supersedes the tombstone left by its old run."""
+
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.lock = threading.Lock()
+
+        self.heartbeats: dict[str, int] = {ip: int(time.time())}
+        self.updated: dict[str, float] = {ip: time.monotonic()}   # When the heartbeat of each member last grew here
+        self.removed: dict[str, int] = {}                         # Last heartbeat of members dropped from the view
+        self.ids: list[int] = [getShaRepr(ip)]                    # Member ids, sorted
+        self.by_id: dict[int, str] = {self.ids[0]: ip}
+
+        self.version = 0        # Incremented every time a member joins or leaves the view
+        self.last_merge: float = None
+
+    def beat(self):
+        with self.lock:
+            self.heartbeats[self.ip] += 1
+            self.updated[self.ip] = time.monotonic()
+
+    def digest(self) -> str:
+        with self.lock:
+            return ','.join(f'{ip}:{heartbeat}' for ip, heartbeat in self.heartbeats.items())
+
+    def merge(self, digest: str):
+        """Merges the view of another member given by its digest"""
+        now = time.monotonic()
+        with self.lock:
+            for entry in digest.split(','):
+                if not entry:
+                    continue
+                ip, heartbeat = entry.rsplit(':', 1)
+                heartbeat = int(heartbeat)
+                if heartbeat <= self.heartbeats.get(ip, self.removed.get(ip, -1)):
+                    continue
+                if ip not in self.heartbeats:
+                    self._add(ip)
+                self.heartbeats[ip] = heartbeat
+                self.updated[ip] = now
+            self._expire(now)
+            self.last_merge = now
+
+    def remove(self, ip: str):
+        with self.lock:
+            if ip in self.heartbeats and ip != self.ip:
+                self._remove(ip)
+
+    def _add(self, ip: str):
+        """Adds a member (must hold lock)"""
+        id = getShaRepr(ip)
+        bisect.insort(self.ids, id)
+        self.by_id[id] = ip
+        self.removed.pop(ip, None)
+        self.version += 1
+
+    def _remove(self, ip: str):
+        """Drops a member, remembering its heartbeat so old gossip does not bring it back (must hold lock)"""
+        id = getShaRepr(ip)
+        self.ids.pop(bisect.bisect_left(self.ids, id))
+        del self.by_id[id]
+        self.removed[ip] = self.heartbeats.pop(ip)
+        del self.updated[ip]
+        self.version += 1
+
+    def _expire(self, now: float):
+        """Drops the members whose heartbeat did not grow lately (must hold lock)"""
+        for ip in [ip for ip, updated in self.updated.items() if ip != self.ip and now - updated > DEFAULT_MEMBERSHIP_EXPIRE]:
+            self._remove(ip)
+
+    def owner(self, id: int, succ_id: int) -> str:
+        """Returns the ip of the owner of id, or None if the view cannot be trusted: it is too large,
+        it was not refreshed lately, or it disagrees with the successor known by the ring"""
+        with self.lock:
+            if len(self.ids) > DEFAULT_ONE_HOP_MAX or self.last_merge is None:
+                return None
+            if time.monotonic() - self.last_merge > DEFAULT_MEMBERSHIP_STALE:
+                return None
+            own_id = getShaRepr(self.ip)
+            next_id = self.ids[bisect.bisect_right(self.ids, own_id) % len(self.ids)]
+            if next_id != succ_id:
+                return None
+            return self.by_id[self.ids[bisect.bisect_left(self.ids, id) % len(self.ids)]]
+
+    def members(self) -> list[str]:
+        with self.lock:
+            return [ip for ip in self.heartbeats if ip != self.ip]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'members': len(self.ids),
+                'version': self.version,
+                'fresh': self.last_merge is not None and time.monotonic() - self.last_merge <= DEFAULT_MEMBERSHIP_STALE,
+            }
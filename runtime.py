@@ -0,0 +1,192 @@
+import socket
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from const import *
+from framing import *
+from codec import hello_reply
+from vnodes import endpoint
+
+
+class WorkerPool:
+    """Bounded pool of threads running request handlers.
+
+    At most workers handlers run at once and at most queue_size more requests
+    wait for a worker, a request arriving when both are full is rejected."""
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+        self.lock = threading.Lock()
+        self.pending = 0    # Admitted requests, waiting or running
+        self.running = 0
+
+        # Counters
+        self.served = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self.max_running = 0
+
+    def admit(self) -> bool:
+        """Takes a place for a new request, returns False if the pool is overloaded"""
+        with self.lock:
+            if self.pending >= self.workers + self.queue_size:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.max_queued = max(self.max_queued, self.pending - self.running)
+            return True
+
+    def run(self, handler, conn: socket.socket, frame: Frame):
+        """Runs an admitted request in a worker thread"""
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            handler(conn, frame)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.pending -= 1
+                self.served += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'running': self.running,
+                'queued': self.pending - self.running,
+                'max_running': self.max_running,
+                'max_queued': self.max_queued,
+                'served': self.served,
+                'rejected': self.rejected,
+            }
+
+
+class PortWorkers:
+    """Worker pools of one listening port.
+
+    Handlers of nested_ops wait on requests to other nodes, often to this same
+    port. Holding a worker of the port while they wait could deadlock nodes whose
+    workers all wait on each other, so they run in a second pool of their own.
+    It is bounded too and rejects what it can not run at once by default, a nested
+    request waiting in its queue could be the one its busy workers wait for."""
+
+    def __init__(self, port: int, workers: int = DEFAULT_PORT_WORKERS, queue_size: int = DEFAULT_PORT_QUEUE, nested_ops: set[int] = frozenset(),
+                 nested_workers: int = DEFAULT_NESTED_WORKERS, nested_queue: int = DEFAULT_NESTED_QUEUE):
+        self.port = port
+        self.nested_ops = nested_ops
+        self.pool = WorkerPool(f'port-{port}', workers, queue_size)
+        self.nested = WorkerPool(f'port-{port}-nested', nested_workers, nested_queue)
+
+    def pool_for(self, op: int) -> WorkerPool:
+        """Returns the pool the requests of op run in"""
+        return self.nested if op in self.nested_ops else self.pool
+
+    def stats(self) -> dict:
+        return {**self.pool.stats(), 'nested': self.nested.stats()}
+
+
+class NodeRuntime:
+    """One asyncio event loop serving every TCP port of the node.
+
+    The loop accepts connections and reads request frames without blocking a
+    thread per connection. Once a frame is complete its handler, which does
+    blocking disk and network I/O, runs in a worker pool of its port with the
+    connection in blocking mode; the loop resumes reading that connection when
+    it returns. A request that finds its port overloaded gets a BUSY reply."""
+
+    def __init__(self, backlog: int = DEFAULT_BACKLOG):
+        self.backlog = backlog
+        self.ports: dict[int, PortWorkers] = {}
+        self.tasks: set[asyncio.Task] = set()   # Keeps accept and connection tasks alive while they run
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+    def serve(self, ip: str, port: int, handler, workers: int = DEFAULT_PORT_WORKERS, queue_size: int = DEFAULT_PORT_QUEUE, nested_ops: set[int] = frozenset(),
+              nested_workers: int = DEFAULT_NESTED_WORKERS, nested_queue: int = DEFAULT_NESTED_QUEUE):
+        """Starts serving handler(conn, frame) on (ip, port), returns once the port is listening.
+        ip is a node name, a virtual node listens on the port shifted for it. nested_ops are the
+        ops whose handlers wait on other nodes, see PortWorkers"""
+        ip, port = endpoint(ip, port)
+        self.ports[port] = PortWorkers(port, workers, queue_size, nested_ops, nested_workers, nested_queue)
+        future = asyncio.run_coroutine_threadsafe(self._listen(ip, port, handler), self.loop)
+        future.result()
+
+    def stats(self) -> dict:
+        """Returns the worker pool stats of every port"""
+        return {port: workers.stats() for port, workers in self.ports.items()}
+
+    async def _listen(self, ip: str, port: int, handler):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((ip, port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        self._spawn(self._accept(sock, handler, self.ports[port]))
+
+    async def _accept(self, sock: socket.socket, handler, workers: PortWorkers):
+        while True:
+            try:
+                conn, _ = await self.loop.sock_accept(sock)
+            except OSError as e:
+                print(f"[*] Error accepting connection: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            conn.setblocking(False)
+            self._spawn(self._serve_connection(conn, handler, workers))
+
+    def _spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    async def _recv_exact(self, conn: socket.socket, n: int) -> bytes:
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        received = 0
+        while received < n:
+            count = await self.loop.sock_recv_into(conn, view[received:])
+            if count == 0:
+                raise ConnectionError("Connection closed by peer")
+            received += count
+        return bytes(buffer)
+
+    async def _recv_frame(self, conn: socket.socket) -> Frame:
+        op, flags, req_id, length = HEADER.unpack(await self._recv_exact(conn, HEADER.size))
+        payload = await self._recv_exact(conn, length) if length else b''
+        return Frame(op, flags, req_id, payload)
+
+    async def _serve_connection(self, conn: socket.socket, handler, workers: PortWorkers):
+        """Serves every request frame of a connection until the peer closes it"""
+        with conn:
+            while True:
+                try:
+                    frame = await self._recv_frame(conn)
+                    if frame.op == HELLO:
+                        reply = hello_reply(frame.payload)
+                        await self.loop.sock_sendall(conn, HEADER.pack(HELLO, 0, frame.req_id, len(reply)) + reply)
+                        continue
+                    pool = workers.pool_for(frame.op)
+                    if not pool.admit():
+                        await self.loop.sock_sendall(conn, HEADER.pack(BUSY, 0, frame.req_id, 0))
+                        continue
+                except (ConnectionError, OSError):
+                    return
+
+                # Handlers may keep talking over the connection, so it is handed over in blocking mode
+                conn.setblocking(True)
+                try:
+                    await self.loop.run_in_executor(pool.executor, pool.run, handler, conn, frame)
+                except Exception as e:
+                    print(f"[*] Error handling operation {frame.op}: {e}")
+                    return
+                conn.setblocking(False)
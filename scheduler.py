@@ -0,0 +1,74 @@
+import threading
+
+
+class MaintenanceTask:
+    """Interval of one periodic task"""
+
+    def __init__(self, min_interval: float, max_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.epoch = 0
+        self.waited = False
+        self.wake = threading.Event()
+
+
+class MaintenanceScheduler:
+    """Intervals of the periodic maintenance tasks of a node.
+
+    A task calls wait(name) before every round. Each wait doubles the interval of the
+    task up to its max while the ring is quiet, after a churn() (membership change or
+    failed probe) every task is woken at once and goes back to its min interval."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks: dict[str, MaintenanceTask] = {}
+        self.epoch = 0      # Incremented on every churn
+
+    def add(self, name: str, min_interval: float, max_interval: float):
+        with self.lock:
+            self.tasks[name] = MaintenanceTask(min_interval, max_interval)
+            self.tasks[name].epoch = self.epoch
+
+    def wait(self, name: str):
+        """Sleeps until the next round of the task is due"""
+        task = self.tasks[name]
+        with self.lock:
+            # Cleared under the lock before sleeping, a churn from now on cuts the sleep short
+            task.wake.clear()
+            if task.epoch != self.epoch:
+                # A churn signalled while the task was running its round, the next one is due at once
+                self._rewind(task)
+                return
+            if task.waited:
+                task.interval = min(task.interval * 2, task.max_interval)
+            task.waited = True
+            interval = task.interval
+        if task.wake.wait(interval):
+            with self.lock:
+                self._rewind(task)
+
+    def _rewind(self, task: MaintenanceTask):
+        """Brings a task that saw the last churn back to its min interval (must hold lock)"""
+        task.epoch = self.epoch
+        task.interval = task.min_interval
+        task.waited = False
+
+    def reset(self, name: str):
+        """Brings one task back to its min interval, for changes only it cares about"""
+        task = self.tasks[name]
+        with self.lock:
+            task.interval = task.min_interval
+            task.waited = False
+
+    def churn(self):
+        """Wakes every task and brings them back to their min interval"""
+        with self.lock:
+            self.epoch += 1
+            for task in self.tasks.values():
+                task.wake.set()
+
+    def stats(self) -> dict:
+        """Returns the current interval of every task, in seconds"""
+        with self.lock:
+            return {name: task.interval for name, task in self.tasks.items()}
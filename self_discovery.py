@@ -2,6 +2,7 @@ import threading
 import socket
 import time
 from const import *
+from framing import *
 
 SELF_DISC_SYMBOL = "🔎"
 
@@ -48,11 +49,10 @@ class SelfDiscovery:
                 if addr[0] == self.ip:
                     continue
 
-                data = conn.recv(1024).decode('utf-8').split(',')
-                option = int(data[0])
+                frame = recv_frame(conn)
 
-                if option == ENTRY_POINT:
-                    self.target_ip = data[1]
+                if frame.op == ENTRY_POINT:
+                    self.target_ip = frame.payload.decode('utf-8')
                     conn.close()
                     s.close()
                     break
@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+from collections.abc import Mapping
+from const import *
+from wal import MetadataLog
+
+# Tables of a database, each one maps a key (tag or file name) to its posting list, an
+# insertion ordered set of values
+TABLES = ('tags', 'files', 'replicated_pred_tags', 'replicated_succ_tags', 'replicated_pred_files', 'replicated_succ_files')
+
+# Mutations every engine applies, the same ones a MetadataLog records:
+#   put key value       Sets the posting list of key
+#   del key             Drops key
+#   add key value       Adds value to the posting list of key, if it is not there yet
+#   rm key value        Removes value from the posting list of key
+#   discard key value   Like rm, dropping key once its posting list is empty
+#   merge value         Sets the posting list of every key of the map value
+#   reset value         Replaces the whole table with the map value
+
+_SYNCHRONOUS = {'always': 'FULL', 'interval': 'NORMAL', 'never': 'OFF'}
+
+
+# Function to open the storage engine of a database directory
+def open_storage(dir_path: str, engine: str = DEFAULT_STORAGE_ENGINE):
+    if engine == 'dict':
+        return DictEngine(dir_path)
+    if engine == 'sqlite':
+        return SqliteEngine(dir_path)
+    raise ValueError(f"Unknown storage engine {engine}")
+
+
+class DictEngine:
+    """Tables kept in memory as dicts of PostingList, every mutation is persisted by a MetadataLog"""
+
+    def __init__(self, dir_path: str):
+        self.tables = {name: {} for name in TABLES}
+        self.log = MetadataLog(dir_path, self.tables)
+
+    def table(self, name: str) -> dict:
+        return self.tables[name]
+
+    def apply(self, table: str, op: str, key: str = None, value=None):
+        self.log.append(table, op, key, value)
+
+    def batch(self):
+        """Groups mutations, records of the log are already applied one by one"""
+        return nullcontext()
+
+    def flush(self):
+        self.log.flush()
+
+    def reset(self):
+        for table in self.tables.values():
+            table.clear()
+        self.log.reset()
+
+    def load(self):
+        self.log.load()
+
+    def stats(self) -> dict:
+        return {'engine': 'dict', **self.log.stats()}
+
+
+class SqliteTable(Mapping):
+    """Read only view of a table of a SqliteEngine, queried on every access"""
+
+    def __init__(self, engine: 'SqliteEngine', name: str):
+        self.engine = engine
+        self.name = name
+
+    def __getitem__(self, key: str) -> list[str]:
+        with self.engine.lock:
+            if not self.engine.db.execute(f"SELECT 1 FROM {self.name} WHERE key = ?", (key,)).fetchone():
+                raise KeyError(key)
+            rows = self.engine.db.execute(f"SELECT value FROM {self.name}_postings WHERE key = ? ORDER BY id", (key,))
+            return [value for (value,) in rows]
+
+    def __contains__(self, key) -> bool:
+        with self.engine.lock:
+            return self.engine.db.execute(f"SELECT 1 FROM {self.name} WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.engine.lock:
+            keys = [key for (key,) in self.engine.db.execute(f"SELECT key FROM {self.name} ORDER BY rowid")]
+        return iter(keys)
+
+    def __len__(self) -> int:
+        with self.engine.lock:
+            return self.engine.db.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def items(self) -> list[tuple[str, list[str]]]:
+        """Returns every key with its posting list in a single query"""
+        result: dict[str, list[str]] = {}
+        with self.engine.lock:
+            rows = self.engine.db.execute(
+                f"SELECT k.key, p.value FROM {self.name} k LEFT JOIN {self.name}_postings p ON p.key = k.key ORDER BY k.rowid, p.id")
+            for key, value in rows:
+                values = result.setdefault(key, [])
+                if value is not None:
+                    values.append(value)
+        return list(result.items())
+
+
+class SqliteEngine:
+    """Tables kept on disk in database.sqlite, so the memory of a node does not grow with its catalog.
+
+    Every table has a keys table (key -> rowid, in insertion order) and a postings table
+    indexed by key and by (key, value), the same layout serves tag -> files and file -> tags.
+    Postings keep their insertion order by id, and the (key, value) index keeps adding,
+    removing or looking up a value independent of the length of the posting list.
+
+    Mutations run in a transaction left open for the flusher, which commits it after
+    DEFAULT_FLUSH_MAX_DELAY seconds or DEFAULT_FLUSH_MAX_PENDING mutations, so a burst of
+    writes shares one commit. batch() is a savepoint inside it, its mutations are undone
+    together if the block fails. flush() commits and syncs right away."""
+
+    def __init__(self, dir_path: str):
+        self.path = f"{dir_path}/database.sqlite"
+        self.lock = threading.RLock()
+        self.depth = 0      # Nested batches of the thread holding the lock
+        self.open = False   # Transaction begun and not committed yet
+        self.pending = 0    # Mutations in the open transaction
+        self.wake = threading.Event()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(f"PRAGMA synchronous = {_SYNCHRONOUS[DEFAULT_WAL_FSYNC]}")
+        self.db.execute(f"PRAGMA cache_size = -{DEFAULT_SQLITE_CACHE_KB}")
+        for name in TABLES:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY)")
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {name}_postings (id INTEGER PRIMARY KEY, key TEXT NOT NULL, value TEXT NOT NULL)")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {name}_by_key ON {name}_postings (key)")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {name}_by_pair ON {name}_postings (key, value)")
+        self.tables = {name: SqliteTable(self, name) for name in TABLES}
+
+        # Counters
+        self.writes = 0
+        self.commits = 0
+
+        threading.Thread(target=self._flusher, daemon=True).start()
+
+    def table(self, name: str) -> SqliteTable:
+        return self.tables[name]
+
+    @contextmanager
+    def batch(self):
+        """Runs the mutations of the block as a whole, they are committed by the flusher"""
+        with self.lock:
+            if not self.open:
+                self.db.execute("BEGIN")
+                self.open = True
+            if self.depth == 0:
+                self.db.execute("SAVEPOINT batch")
+            self.depth += 1
+            try:
+                yield
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute("ROLLBACK TO batch")
+                    self.db.execute("RELEASE batch")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute("RELEASE batch")
+                self.pending += 1
+                if self.pending >= DEFAULT_FLUSH_MAX_PENDING:
+                    self.wake.set()
+
+    def flush(self):
+        """Commits every mutation applied so far, synced to disk unless the policy is 'never'"""
+        with self.lock:
+            self._commit()
+            if DEFAULT_WAL_FSYNC == 'interval':
+                # Under synchronous NORMAL commits are only synced by checkpoints
+                self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def _commit(self):
+        """Commits the open transaction (must hold lock, outside any batch)"""
+        if self.open and self.depth == 0:
+            self.db.execute("COMMIT")
+            self.open = False
+            self.pending = 0
+            self.commits += 1
+
+    def _flusher(self):
+        while True:
+            self.wake.wait(DEFAULT_FLUSH_MAX_DELAY)
+            self.wake.clear()
+            try:
+                with self.lock:
+                    self._commit()
+            except Exception as e:
+                print(f"[💾] Storage commit failed: {e}")
+
+    def apply(self, table: str, op: str, key: str = None, value=None):
+        with self.batch():
+            if op == 'put':
+                self._put(table, key, value)
+            elif op == 'del':
+                self._check(table, key)
+                self._del(table, key)
+            elif op == 'add':
+                self._check(table, key)
+                self.db.execute(
+                    f"INSERT INTO {table}_postings (key, value) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM {table}_postings WHERE key = ? AND value = ?)",
+                    (key, value, key, value))
+            elif op in ('rm', 'discard'):
+                self._check(table, key)
+                cursor = self.db.execute(
+                    f"DELETE FROM {table}_postings WHERE id = (SELECT id FROM {table}_postings WHERE key = ? AND value = ? ORDER BY id LIMIT 1)",
+                    (key, value))
+                if cursor.rowcount == 0:
+                    raise ValueError(f"{value} not in {table}[{key}]")
+                if op == 'discard' and not self.db.execute(f"SELECT 1 FROM {table}_postings WHERE key = ?", (key,)).fetchone():
+                    self.db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            elif op == 'merge':
+                for k, v in list(value.items()):
+                    self._put(table, k, v)
+            elif op == 'reset':
+                items = list(value.items())
+                self.db.execute(f"DELETE FROM {table}")
+                self.db.execute(f"DELETE FROM {table}_postings")
+                for k, v in items:
+                    self._put(table, k, v)
+            else:
+                raise ValueError(f"Unknown storage op {op}")
+            self.writes += 1
+
+    def _check(self, table: str, key: str):
+        """Raises KeyError if the table has no key, as the dicts of the other engine would (must hold lock)"""
+        if not self.db.execute(f"SELECT 1 FROM {table} WHERE key = ?", (key,)).fetchone():
+            raise KeyError(key)
+
+    def _put(self, table: str, key: str, values: list[str]):
+        """Sets the posting list of key (must hold lock)"""
+        self.db.execute(f"INSERT OR IGNORE INTO {table} (key) VALUES (?)", (key,))
+        self.db.execute(f"DELETE FROM {table}_postings WHERE key = ?", (key,))
+        self.db.executemany(f"INSERT INTO {table}_postings (key, value) VALUES (?, ?)", ((key, v) for v in dict.fromkeys(values)))
+
+    def _del(self, table: str, key: str):
+        """Drops key (must hold lock)"""
+        self.db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+        self.db.execute(f"DELETE FROM {table}_postings WHERE key = ?", (key,))
+
+    def reset(self):
+        with self.batch():
+            for name in TABLES:
+                self.db.execute(f"DELETE FROM {name}")
+                self.db.execute(f"DELETE FROM {name}_postings")
+
+    def load(self):
+        """Tables are read from disk on every access, there is nothing to load"""
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'engine': 'sqlite',
+                'writes': self.writes,
+                'pending': self.pending,
+                'commits': self.commits,
+                'size': os.path.getsize(self.path),
+            }
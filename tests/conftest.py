@@ -0,0 +1,15 @@
+import os
+import sys
+import socket
+import pytest
+
+# The modules of the node live at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def free_port() -> int:
+    """A port no socket of this host listens on"""
+    with socket.socket() as s:
+        s.bind(('0.0.0.0', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,52 @@
+import socket
+import threading
+import pytest
+from codec import *
+from compression import TransferStats, send_payload, recv_payload
+
+ENCODINGS = [0, FLAG_CODEC, FLAG_CODEC | FLAG_ZLIB]
+
+TAGS = {'blue': ['f1', 'f2'], 'rojo': ['año.txt'], 'empty': []}
+
+
+@pytest.mark.parametrize('flags', ENCODINGS)
+def test_messages_round_trip(flags):
+    assert unpack_fields(pack_fields(['blue', 'f1'], flags, ','), flags, ',') == ['blue', 'f1']
+    assert unpack_list(pack_list(['f1', 'año.txt', ''], flags), flags) == ['f1', 'año.txt', '']
+    assert unpack_list(pack_list([], flags), flags) == []
+    assert unpack_map(pack_map(TAGS, flags), flags) == TAGS
+
+
+def test_codec_keeps_separators_inside_fields():
+    fields = ['a,b', 'c;d']
+    assert unpack_fields(pack_fields(fields, FLAG_CODEC, ','), FLAG_CODEC, ',') == fields
+
+
+def test_truncated_codec_payload_is_rejected():
+    payload = pack_list(['blue', 'green'], FLAG_CODEC)
+    with pytest.raises(ValueError):
+        unpack_list(payload[:-2], FLAG_CODEC)
+
+
+def test_negotiation_falls_back_to_the_text_encoding():
+    assert hello_flags(hello_reply(hello_payload())) == FLAG_CODEC | FEATURES
+    # A node of version 0 sends no HELLO payload
+    assert hello_flags(hello_reply(b'')) == 0
+
+
+@pytest.mark.parametrize('flags', ENCODINGS)
+def test_payloads_round_trip_compressed_only_when_negotiated(flags):
+    data = {f"tag-{i}": ['f1', 'f2'] for i in range(2000)}
+    payload = pack_map(data, flags)
+    sent, received = TransferStats(), TransferStats()
+
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        threading.Thread(target=send_payload, args=(sender, payload, flags, sent), daemon=True).start()
+        assert unpack_map(recv_payload(receiver, received), flags) == data
+
+    assert sent.raw == received.raw == len(payload)
+    if flags & FLAG_ZLIB:
+        assert sent.wire < sent.raw
+    else:
+        assert sent.wire == sent.raw
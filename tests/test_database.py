@@ -0,0 +1,144 @@
+import os
+import threading
+import pytest
+from utils import getShaRepr, inbetween
+from runtime import NodeRuntime
+from database import Database
+
+SENDER = '127.0.0.21'
+NEW_OWNER = '127.0.0.22'
+NOBODY = '127.0.0.29'     # Successor and predecessor of the sender, nothing listens there
+
+
+# Function to find a name hashing in (start, end] of the ring, or outside it
+def key_in(start: str, end: str, inside: bool = True, prefix: str = 'tag') -> str:
+    for i in range(10000):
+        key = f"{prefix}-{i}"
+        if inbetween(getShaRepr(key), getShaRepr(start), getShaRepr(end)) == inside:
+            return key
+
+
+# Function to find a name whose id falls between the ids of two others, to stand for the old predecessor
+def name_between(start: str, end: str) -> str:
+    for i in range(1, 255):
+        name = f"127.0.1.{i}"
+        if inbetween(getShaRepr(name), getShaRepr(start), getShaRepr(end)):
+            return name
+
+
+@pytest.fixture
+def databases(tmp_path, monkeypatch, free_port):
+    monkeypatch.chdir(tmp_path)
+    sender = Database(SENDER, free_port, NodeRuntime())
+    new_owner = Database(NEW_OWNER, free_port, NodeRuntime())
+    return sender, new_owner
+
+
+def test_delegation_keeps_keys_outside_the_handed_over_range(databases):
+    sender, new_owner = databases
+
+    # The new owner joined between the old predecessor of the sender and the sender
+    old_pred = name_between(SENDER, NEW_OWNER)
+    handed = key_in(old_pred, NEW_OWNER, prefix='handed')
+    deleted = key_in(old_pred, NEW_OWNER, prefix='deleted')
+    unrelated = key_in(old_pred, SENDER, inside=False, prefix='unrelated')
+
+    sender.storage.apply('tags', 'put', handed, ['f1'])
+    # Left by a previous run of the new owner, deleted from the sender since then
+    new_owner.storage.apply('tags', 'put', deleted, ['f2'])
+    # Owned for another range of the ring
+    new_owner.storage.apply('tags', 'put', unrelated, ['f3'])
+
+    sender.delegate_data(NEW_OWNER, NOBODY, NOBODY, False, old_pred)
+
+    assert list(new_owner.tags[handed]) == ['f1']
+    assert deleted not in new_owner.tags
+    assert list(new_owner.tags[unrelated]) == ['f3']
+    assert handed not in sender.tags
+
+
+def test_rejoining_owner_reconciles_its_whole_tables(databases):
+    sender, new_owner = databases
+
+    old_pred = name_between(SENDER, NEW_OWNER)
+    changed = key_in(old_pred, SENDER, inside=False, prefix='changed')
+    stale = key_in(old_pred, SENDER, inside=False, prefix='stale')
+
+    # Both were changed elsewhere while the new owner was down, outside the range handed back to it
+    sender.storage.apply('tags', 'put', changed, ['f1', 'f2'])
+    new_owner.storage.apply('tags', 'put', changed, ['f1'])
+    new_owner.storage.apply('tags', 'put', stale, ['f3'])
+    new_owner.flush()
+    new_owner.load_storage()
+    assert new_owner.rejoining
+
+    sender.delegate_data(NEW_OWNER, NOBODY, NOBODY, False, old_pred)
+
+    assert sorted(new_owner.tags[changed]) == ['f1', 'f2']
+    assert stale not in new_owner.tags
+    assert not new_owner.rejoining
+
+
+def test_assumed_bins_are_moved_into_the_owned_ones(databases):
+    sender, _ = databases
+    sender.storage.apply('replicated_pred_files', 'put', 'f1', ['blue'])
+    with open(f"{sender.replicated_pred_bins_path}/f1", 'wb') as file:
+        file.write(b'content')
+
+    sender.assume_data(NOBODY)
+
+    assert list(sender.files['f1']) == ['blue']
+    with open(f"{sender.bins_path}/f1", 'rb') as file:
+        assert file.read() == b'content'
+    assert not os.path.exists(f"{sender.replicated_pred_bins_path}/f1")
+
+
+def test_digest_while_writers_change_the_table(databases):
+    sender, _ = databases
+    with sender.storage.batch():
+        for i in range(2000):
+            sender.storage.apply('tags', 'put', f"tag-{i}", ['f1'])
+
+    stop = threading.Event()
+    def writer():
+        i = 0
+        while not stop.is_set():
+            sender.storage.apply('tags', 'put', f"new-{i}", ['f1'])
+            i += 1
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        for _ in range(20):
+            assert len(sender.digest(sender.tags)) >= 2000
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_lists_inserted_in_another_order_are_not_resent(databases):
+    sender, new_owner = databases
+    sender.storage.apply('tags', 'put', 'blue', ['f1', 'f2'])
+    new_owner.storage.apply('tags', 'put', 'blue', ['f2', 'f1'])
+
+    changed, dropped = sender.diff(sender.export(sender.tags), new_owner.digest(new_owner.tags))
+
+    assert changed == {} and dropped == []
+
+
+def test_digest_and_diff_only_drop_keys_in_scope(databases):
+    sender, new_owner = databases
+    sender.storage.apply('files', 'put', 'f1', ['blue'])
+    with open(f"{sender.bins_path}/f1", 'wb') as file:
+        file.write(b'content')
+    new_owner.storage.apply('files', 'put', 'f1', ['blue'])
+    with open(f"{new_owner.bins_path}/f1", 'wb') as file:
+        file.write(b'stale')
+    new_owner.storage.apply('files', 'put', 'f2', ['blue'])
+    new_owner.storage.apply('files', 'put', 'f3', ['blue'])
+
+    digest = new_owner.digest(new_owner.files, new_owner.bins_path)
+    changed, dropped = sender.diff(sender.export(sender.files), digest, sender.bins_path, scope=lambda k: k != 'f3')
+
+    # Same list but another bin, f1 is sent again
+    assert changed == {'f1': ['blue']}
+    assert dropped == ['f2']
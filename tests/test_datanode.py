@@ -0,0 +1,69 @@
+import pytest
+from runtime import NodeRuntime
+from database import Database
+from DataNode import DataNode
+from ChordNodeReference import ChordNodeReference
+from lookup_cache import LookupCache
+from vnodes import vnode_name
+
+HOST = '127.0.0.31'
+SIBLING = vnode_name(HOST, 1)     # Second virtual node of the host, right after it on the ring
+SUCC_HOST = '127.0.0.32'
+PRED_HOST = '127.0.0.33'
+
+
+@pytest.fixture
+def node(tmp_path, monkeypatch, free_port):
+    """The first virtual node of a host, with its sibling as both successor and predecessor"""
+    monkeypatch.chdir(tmp_path)
+    runtime = NodeRuntime()
+    databases = {ip: Database(ip, free_port, runtime) for ip in (HOST, SIBLING, SUCC_HOST, PRED_HOST)}
+
+    # Only what the handlers of an owner use, without joining a ring
+    node = DataNode.__new__(DataNode)
+    node.ip, node.ref = HOST, ChordNodeReference(HOST)
+    node.id = node.ref.id
+    node.succ = ChordNodeReference(SIBLING)
+    node.succ_list = [node.succ, ChordNodeReference(SUCC_HOST)]
+    node.pred, node.predpred = ChordNodeReference(SIBLING), ChordNodeReference(PRED_HOST)
+    node.lookup = lambda id: node.ref
+    node.lookup_cache, node.cached_replica_targets = LookupCache(), None
+    node.database = databases[HOST]
+    return node, databases
+
+
+def test_replicas_skip_virtual_nodes_of_the_same_host(node):
+    node, databases = node
+
+    node.handle_insert_tag('blue')
+
+    assert 'blue' in databases[HOST].tags
+    assert 'blue' in databases[SUCC_HOST].replicated_pred_tags
+    assert 'blue' in databases[PRED_HOST].replicated_succ_tags
+    assert 'blue' not in databases[SIBLING].replicated_pred_tags
+    assert 'blue' not in databases[SIBLING].replicated_succ_tags
+
+
+class RemoteSibling:
+    """A sibling as predecessor, whose own predecessor is asked remotely"""
+    def __init__(self):
+        self.ip, self.id = SIBLING, ChordNodeReference(SIBLING).id
+        self.asked = 0
+
+    @property
+    def pred(self):
+        self.asked += 1
+        return ChordNodeReference(PRED_HOST)
+
+
+def test_replica_targets_are_resolved_once_per_ring_epoch(node):
+    node, _ = node
+    node.pred, node.predpred = RemoteSibling(), None
+
+    for _ in range(3):
+        assert node.replica_targets() == (SUCC_HOST, PRED_HOST)
+    assert node.pred.asked == 1
+
+    node.lookup_cache.invalidate()
+    assert node.replica_targets() == (SUCC_HOST, PRED_HOST)
+    assert node.pred.asked == 2
@@ -0,0 +1,45 @@
+import socket
+import threading
+import time
+import pytest
+from const import OK, END, REQUEST_PERMISSION
+from framing import send_frame, recv_frame
+from codec import pack_map
+from runtime import NodeRuntime
+from leader import Leader
+
+
+@pytest.fixture
+def permission(free_port):
+    """Opens a permission request for some tags to a leader, the permission is held until END is sent"""
+    Leader('127.0.0.1', lambda query_tags: [], port=free_port, runtime=NodeRuntime())
+    sockets = []
+
+    def request(tags: list[str]) -> socket.socket:
+        s = socket.create_connection(('127.0.0.1', free_port))
+        sockets.append(s)
+        send_frame(s, REQUEST_PERMISSION, pack_map({'tags': tags, 'files': [], 'query_tags': []}, 0))
+        return s
+
+    yield request
+    for s in sockets:
+        s.close()
+
+
+def test_waiting_request_is_granted_when_the_holder_ends(permission):
+    holder = permission(['blue'])
+    assert recv_frame(holder).op == OK
+
+    waiting = permission(['blue'])
+    granted = threading.Event()
+    threading.Thread(target=lambda: recv_frame(waiting).op == OK and granted.set(), daemon=True).start()
+    assert not granted.wait(0.55)
+
+    # Requests for other resources are not held behind it
+    other = permission(['green'])
+    assert recv_frame(other).op == OK
+
+    start = time.monotonic()
+    send_frame(holder, END)
+    assert granted.wait(5)
+    assert time.monotonic() - start < 0.1
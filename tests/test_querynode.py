@@ -0,0 +1,26 @@
+import socket
+import threading
+from const import OK, BUSY
+from framing import Frame, BusyError, send_data, recv_frame
+from QueryNode import QueryNode
+
+
+def test_busy_leader_is_answered_with_busy(free_port):
+    # Only what a query needs, without joining a ring
+    node = QueryNode.__new__(QueryNode)
+    def busy(*args, **kwargs):
+        raise BusyError("Leader is busy")
+    node._request_with_permission = busy
+
+    with socket.create_server(('127.0.0.1', free_port)) as server:
+        client = socket.create_connection(('127.0.0.1', free_port), timeout=5)
+        conn, _ = server.accept()
+        with client, conn:
+            served = threading.Thread(target=node.handle_request, args=(conn, Frame(0, 0, 0, b'list')))
+            served.start()
+
+            assert recv_frame(client).op == OK
+            send_data(client, 'blue')
+            assert recv_frame(client).op == BUSY
+            served.join(5)
+            assert not served.is_alive()
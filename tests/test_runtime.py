@@ -0,0 +1,70 @@
+import threading
+import pytest
+from const import OK
+from framing import BusyError, send_frame
+from runtime import NodeRuntime
+from connection_pool import ConnectionPool
+
+BLOCK = 1       # Holds its worker until released
+LOCAL = 2       # Answers at once
+RELAY = 3       # Nested, forwards itself to the same port until its hop count runs out
+HOLD = 4        # Nested, holds its worker until released
+
+
+@pytest.fixture
+def saturated_port(free_port):
+    """A port with one worker and no queue, its worker held by a BLOCK request"""
+    port = free_port
+    pool = ConnectionPool(busy_retries=0)
+    release = threading.Event()
+    blocked = threading.Event()
+
+    def handler(conn, frame):
+        if frame.op in (BLOCK, HOLD):
+            blocked.set()
+            release.wait(10)
+        elif frame.op == RELAY:
+            hops = int(frame.payload)
+            if hops:
+                pool.request('127.0.0.1', port, RELAY, str(hops - 1), timeout=5)
+        send_frame(conn, OK, b'done', frame.req_id)
+
+    runtime = NodeRuntime()
+    runtime.serve('127.0.0.1', port, handler, workers=1, queue_size=0, nested_ops={RELAY, HOLD}, nested_workers=4)
+    threading.Thread(target=pool.request, args=('127.0.0.1', port, BLOCK), daemon=True).start()
+    assert blocked.wait(5)
+    blocked.clear()
+    yield port, pool, runtime, blocked
+    release.set()
+
+
+def test_nested_requests_are_served_while_the_port_is_saturated(saturated_port):
+    port, pool, runtime, _ = saturated_port
+
+    # Every hop is a new request to the same port, waiting on the next one
+    frame = pool.request('127.0.0.1', port, RELAY, '3', timeout=5)
+
+    assert frame.op == OK and frame.payload == b'done'
+    stats = runtime.stats()[port]
+    assert stats['running'] == 1 and stats['nested']['max_running'] == 4
+
+
+def test_saturated_port_still_rejects_other_requests(saturated_port):
+    port, pool, _, _ = saturated_port
+
+    with pytest.raises(BusyError):
+        pool.request('127.0.0.1', port, LOCAL, timeout=5)
+
+
+def test_nested_requests_are_rejected_when_their_workers_are_taken(saturated_port):
+    port, pool, runtime, blocked = saturated_port
+
+    for _ in range(4):
+        threading.Thread(target=pool.request, args=('127.0.0.1', port, HOLD), daemon=True).start()
+        assert blocked.wait(5)
+        blocked.clear()
+
+    with pytest.raises(BusyError):
+        pool.request('127.0.0.1', port, RELAY, '0', timeout=5)
+    stats = runtime.stats()[port]['nested']
+    assert stats['running'] == 4 and stats['rejected'] == 1
@@ -0,0 +1,69 @@
+import pytest
+from storage import open_storage
+
+ENGINES = ['dict', 'sqlite']
+
+OPS = [
+    ('tags', 'put', 'blue', ['f1', 'f2', 'f1']),
+    ('tags', 'add', 'blue', 'f3'),
+    ('tags', 'add', 'blue', 'f1'),
+    ('tags', 'rm', 'blue', 'f2'),
+    ('tags', 'put', 'red', ['f1']),
+    ('tags', 'discard', 'red', 'f1'),
+    ('tags', 'put', 'green', ['f4']),
+    ('tags', 'rm', 'green', 'f4'),
+    ('tags', 'merge', None, {'blue': ['f5'], 'white': ['f1', 'f2']}),
+    ('tags', 'del', 'white', None),
+    ('files', 'put', 'f1', ['blue']),
+    ('replicated_pred_tags', 'merge', None, {'old': ['f9']}),
+    ('replicated_pred_tags', 'reset', None, {'new': ['f8', 'f7']}),
+]
+
+
+# Function to read the tables of an engine as plain lists
+def contents(storage) -> dict:
+    return {name: {k: list(v) for k, v in storage.table(name).items()} for name in ('tags', 'files', 'replicated_pred_tags')}
+
+
+@pytest.fixture(params=ENGINES)
+def storage(request, tmp_path):
+    storage = open_storage(str(tmp_path), request.param)
+    storage.reset()
+    return storage
+
+
+def test_engines_apply_mutations_alike(storage):
+    for table, op, key, value in OPS:
+        storage.apply(table, op, key, value)
+
+    assert contents(storage) == {
+        'tags': {'blue': ['f5'], 'green': []},
+        'files': {'f1': ['blue']},
+        'replicated_pred_tags': {'new': ['f8', 'f7']},
+    }
+
+
+def test_engines_reject_missing_keys_and_values_alike(storage):
+    storage.apply('tags', 'put', 'blue', ['f1'])
+
+    with pytest.raises(KeyError):
+        storage.apply('tags', 'add', 'red', 'f1')
+    with pytest.raises(KeyError):
+        storage.apply('tags', 'del', 'red')
+    with pytest.raises(ValueError):
+        storage.apply('tags', 'rm', 'blue', 'f2')
+    assert list(storage.table('tags')['blue']) == ['f1']
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engines_keep_the_tables_across_restarts(tmp_path, engine):
+    storage = open_storage(str(tmp_path), engine)
+    storage.reset()
+    for table, op, key, value in OPS:
+        storage.apply(table, op, key, value)
+    storage.flush()
+
+    restarted = open_storage(str(tmp_path), engine)
+    restarted.load()
+
+    assert contents(restarted) == contents(storage)
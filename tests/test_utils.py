@@ -0,0 +1,24 @@
+import os
+import socket
+import threading
+from framing import CHUNK_SIZE
+from utils import recv_bin_file, list_hash
+
+
+def test_bin_is_received_in_chunks_into_its_file(tmp_path):
+    content = os.urandom(3 * CHUNK_SIZE + 7)
+    file_path = str(tmp_path / 'big.bin')
+
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        threading.Thread(target=sender.sendall, args=(content,), daemon=True).start()
+        assert recv_bin_file(receiver, len(content), file_path) == len(content)
+
+    with open(file_path, 'rb') as file:
+        assert file.read() == content
+    assert os.listdir(tmp_path) == ['big.bin']
+
+
+def test_posting_lists_in_any_order_hash_alike():
+    assert list_hash(['f1', 'f2', 'f3']) == list_hash(['f3', 'f1', 'f2'])
+    assert list_hash(['f1', 'f2']) != list_hash(['f1', 'f2', 'f3'])
@@ -0,0 +1,88 @@
+import os
+import pytest
+from wal import MetadataLog, PostingList
+
+
+def test_records_stay_buffered_while_no_segment_is_open(tmp_path):
+    log = MetadataLog(str(tmp_path), {'tags': {}})
+
+    log.append('tags', 'put', 'blue', ['f1'])
+    log.flush()
+
+    stats = log.stats()
+    assert stats['buffered'] == 1 and stats['commits'] == 0
+
+
+# Function to open the log of a directory as a restarted node does, replaying it into fresh tables
+def reopen(dir_path: str) -> tuple[MetadataLog, dict]:
+    tables = {'tags': {}, 'files': {}}
+    log = MetadataLog(dir_path, tables)
+    log.load()
+    return log, tables
+
+
+def test_replay_rebuilds_the_tables(tmp_path):
+    log, _ = reopen(str(tmp_path))
+    log.append('tags', 'put', 'blue', ['f1'])
+    log.append('tags', 'add', 'blue', 'f2')
+    log.append('tags', 'put', 'red', ['f1'])
+    log.append('tags', 'discard', 'red', 'f1')
+    log.append('files', 'merge', value={'f1': ['blue'], 'f2': ['blue']})
+    log.append('files', 'rm', 'f2', 'blue')
+    log.flush()
+
+    _, tables = reopen(str(tmp_path))
+
+    assert {k: list(v) for k, v in tables['tags'].items()} == {'blue': ['f1', 'f2']}
+    assert {k: list(v) for k, v in tables['files'].items()} == {'f1': ['blue'], 'f2': []}
+
+
+def test_replay_stops_at_a_torn_last_line(tmp_path):
+    log, _ = reopen(str(tmp_path))
+    log.append('tags', 'put', 'blue', ['f1'])
+    log.append('tags', 'put', 'red', ['f2'])
+    log.flush()
+
+    # A crash cut the last record while it was written
+    [segment] = [name for name in os.listdir(tmp_path) if name.startswith('wal-')]
+    with open(tmp_path / segment, 'r+') as file:
+        content = file.read()
+        file.seek(0)
+        file.truncate()
+        file.write(content[:-10])
+
+    log, tables = reopen(str(tmp_path))
+
+    assert list(tables['tags']) == ['blue']
+    assert log.stats()['seq'] == 1
+
+
+def test_snapshot_truncates_the_segments_it_covers(tmp_path):
+    log, _ = reopen(str(tmp_path))
+    log.append('tags', 'put', 'blue', ['f1'])
+    log.flush()
+    log.snapshot()
+    log.append('tags', 'add', 'blue', 'f2')
+    log.flush()
+
+    segments = sorted(name for name in os.listdir(tmp_path) if name.startswith('wal-'))
+    assert segments == ['wal-2.log'] and os.path.isfile(tmp_path / 'snapshot.json')
+
+    log, tables = reopen(str(tmp_path))
+
+    assert list(tables['tags']['blue']) == ['f1', 'f2']
+    assert log.stats()['seq'] == 2
+
+
+def test_posting_list_keeps_insertion_order_without_duplicates():
+    values = PostingList(['f2', 'f1', 'f2'])
+    values.add('f3')
+    values.add('f1')
+
+    assert list(values) == ['f2', 'f1', 'f3']
+    assert 'f3' in values and len(values) == 3
+
+    values.remove('f1')
+    assert list(values) == ['f2', 'f3']
+    with pytest.raises(ValueError):
+        values.remove('f1')
@@ -1,12 +1,24 @@
+import os
+import time
 import hashlib
 import socket
-from const import OK, END, END_FILE
+from contextlib import contextmanager
+from const import OK, END, DATA, DEFAULT_BULK_WINDOW
+from framing import *
+from codec import *
+from compression import *
+from connection_pool import pool
 from typing import Dict, List
 
 # Function to hash a string using SHA-1 and return its integer representation
 def getShaRepr(data: str):
     return int(hashlib.sha1(data.encode('utf-8')).hexdigest(), 16)
 
+# Function to hash a list of strings, to compare the posting lists of two nodes without sending them.
+# Posting lists are sets kept in insertion order, which differs between replicas, so the order is not hashed
+def list_hash(values: List[str]) -> str:
+    return hashlib.sha1('\0'.join(sorted(values)).encode('utf-8')).hexdigest()
+
 # Function to check if n id is between two other id's in chord ring
 def inbetween(k: int, start: int, end: int) -> bool:
     if start < end:
@@ -14,114 +26,161 @@ def inbetween(k: int, start: int, end: int) -> bool:
     else:  # The interval wraps around 0
         return start < k or k <= end
         
-# Function to send 2 messages using a socket and waiting OK confirmation
-def send_2(first_msg: str, second_msg: str, target_ip: str, target_port: int):
-        """Sends two messages to target ip, always waiting for OK ack"""
+# Function to send an operation and its message to target ip and waiting OK confirmation
+def send_op(op: int, fields: list[str], target_ip: str, target_port: int):
+        """Sends an operation frame to target ip, always waiting for OK ack"""
 
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((target_ip, target_port))
-                s.sendall(first_msg.encode('utf-8'))
-            
-                ack = s.recv(1024).decode('utf-8')
-                if ack != f"{OK}":
-                    raise Exception("ACK negativo")
-                
-                s.sendall(second_msg.encode('utf-8'))
-                
-                ack = s.recv(1024).decode('utf-8')
-                if ack != f"{OK}":
-                    raise Exception("ACK negativo")
+            flags = pool.flags(target_ip, target_port)
+            response = pool.request(target_ip, target_port, op, pack_fields(fields, flags, ';'), flags=flags)
+            if response.op != OK:
+                raise Exception("ACK negativo")
+        except BusyError:
+            print(f"[*] {target_ip} is busy")
         except:
             print(f"[*] {target_ip} is dead")
 
         
 
-# Function to open a socket and send a binary file
-def send_bin(op: str, file_name: str, bin: bytes, target_ip: str, target_port: int, end_msg: bool = False):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((target_ip, target_port))
+# Function to send a binary file from disk using a pooled connection
+def send_bin(op: int, file_name: str, file_path: str, target_ip: str, target_port: int):
+    flags = pool.flags(target_ip, target_port)
+    with pool.connection(target_ip, target_port) as s:
+        send_frame(s, op, pack_fields([file_name], flags, ','), flags=flags)
+        recv_ack(s)
 
-        s.sendall(op.encode('utf-8'))
+        send_file_frame(s, DATA, file_path)
 
-        ack = s.recv(1024).decode('utf-8')
-        if ack != f"{OK}":
-            raise Exception("ACK negativo")
-        
-        s.sendall(file_name.encode('utf-8'))
+        return recv_data(s)
 
-        ack = s.recv(1024).decode('utf-8')
-        if ack != f"{OK}":
-            raise Exception("ACK negativo")
-        
-        s.sendall(bin)
 
-        if end_msg:
-            s.sendall(f"{END_FILE}".encode('utf-8'))
+class BinSender:
+    """Pooled conversation that sends a binary file of known length chunk by chunk, as it becomes available"""
 
-        return s.recv(1024)
+    def __init__(self, op: int, file_name: str, length: int, target_ip: str, target_port: int):
+        self.ip = target_ip
+        self.address = (target_ip, target_port)
+        flags = pool.flags(target_ip, target_port)
+        self.sock, _, self.pooled = pool.acquire(self.address)
+        try:
+            send_frame(self.sock, op, pack_fields([file_name], flags, ';'), flags=flags)
+            recv_ack(self.sock)
+            send_header(self.sock, DATA, length)
+        except BaseException:
+            pool.discard(self.sock, self.pooled)
+            raise
+
+    def write(self, chunk: bytes):
+        self.sock.sendall(chunk)
+
+    def close(self) -> bytes:
+        """Waits the receiver response once the whole file was written"""
+        try:
+            response = recv_data(self.sock)
+        except BaseException:
+            pool.discard(self.sock, self.pooled)
+            raise
+        pool.release(self.address, self.sock, self.pooled)
+        return response
+
+    def abort(self):
+        pool.discard(self.sock, self.pooled)
+
+
+# Function to open the temp file a received binary is written to, it is renamed into place once complete
+@contextmanager
+def _part_file(file_path: str):
+    dir_name, base_name = os.path.split(file_path)
+    part_path = os.path.join(dir_name, f".{base_name}.part")
+    try:
+        with open(part_path, 'wb') as file:
+            yield file
+        os.replace(part_path, file_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+# Function to receive a binary payload into a file
+def recv_bin_file(s: socket.socket, length: int, file_path: str, forward: list[BinSender] = None) -> int:
+    """Every chunk is also written to the forward senders as it arrives, a failing sender is dropped"""
+    forward = list(forward or [])
+    with _part_file(file_path) as file:
+        def write(chunk: memoryview):
+            file.write(chunk)
+            for sender in list(forward):
+                try:
+                    sender.write(chunk)
+                except OSError:
+                    print(f"[*] {sender.ip} is dead")
+                    sender.abort()
+                    forward.remove(sender)
+
+        return recv_payload_to(s, length, write)
     
 # Function to send multiple binary files using a specified socket
-def send_bins(s: socket.socket, files_to_send: dict, path: str):
+def send_bins(s: socket.socket, files_to_send: dict, path: str, window: int = DEFAULT_BULK_WINDOW, flags: int = 0, stats: TransferStats = None):
+    """Streams every file as one frame, waiting for acks only when window files are unacknowledged.
+    Files are compressed if flags has FLAG_ZLIB and they are worth it"""
+    stats = stats or TransferStats()
+    start = time.monotonic()
+    total = 0
+    in_flight = 0
     for k, _ in files_to_send.items():
-        file_path = f"{path}/{k}"
+        if in_flight == window:
+            recv_ack(s)
+            in_flight -= 1
 
-        s.sendall(k.encode('utf-8'))
-
-        ack = s.recv(1024).decode('utf-8')
-        if ack != f"{OK}":
-            raise Exception("ACK negativo")
-
-        with open(file_path, 'rb') as file:
-            while True:
-                data = file.read(1024)
-                
-                if not data:
-                    break
-                s.sendall(data)
-            
-                ack = s.recv(1024).decode('utf-8')
-                if ack != f"{OK}":
-                    raise Exception("ACK negativo")
-        
-            s.sendall(f"{END_FILE}".encode('utf-8'))
-
-            ack = s.recv(1024).decode('utf-8')
-            if ack != f"{OK}":
-                raise Exception("ACK negativo")
+        send_data(s, k)
+        file_path = f"{path}/{k}"
+        if flags & FLAG_ZLIB and should_compress(os.path.getsize(file_path), k):
+            total += send_compressed_file(s, file_path, stats)
+        else:
+            size = send_file_frame(s, DATA, file_path)
+            stats.add(size, size)
+            total += size
+        in_flight += 1
 
+    for _ in range(in_flight):
+        recv_ack(s)
 
-    s.sendall(f"{END}".encode('utf-8'))
+    send_frame(s, END)
+    recv_ack(s)
 
-    ack = s.recv(1024).decode('utf-8')
-    if ack != f"{OK}":
-        raise Exception("ACK negativo")
+    _report_bulk("[📤] Sent", len(files_to_send), total, time.monotonic() - start)
     
 # Function to receive multiple binary files using a specified socket
-def recv_write_bins(s: socket.socket, dest_dir: str):
+def recv_write_bins(s: socket.socket, dest_dir: str, stats: TransferStats = None):
+    stats = stats or TransferStats()
+    start = time.monotonic()
+    total = 0
+    count = 0
     while True:
-        data = s.recv(1024)
-        if data.decode('utf-8') == f"{END}":
+        frame = recv_frame(s)
+        if frame.op == END:
             break
 
-        file_name = data.decode('utf-8')
-        s.sendall(f"{OK}".encode('utf-8'))
-
-        file_content = []
-        while True:
-            data = s.recv(1024)
-            if data.decode('utf-8') == f"{END_FILE}":
-                file_bin = b''.join(file_content)
-
-                # Save file binary
-                with open(f"{dest_dir}/{file_name}", 'wb') as file:
-                    file.write(file_bin)
+        file_name = frame.payload.decode('utf-8')
+        file_path = f"{dest_dir}/{file_name}"
+        _, flags, _, length = recv_header(s)
+        if flags & FLAG_ZLIB:
+            with _part_file(file_path) as file:
+                total += recv_compressed_to(s, file, stats)
+        else:
+            total += recv_bin_file(s, length, file_path)
+            stats.add(length, length)
+        count += 1
+
+        # Ack every file once it is on disk
+        send_ack(s)
+        
+    send_ack(s)
 
-                file_content = []
-                break
-            file_content.append(data)
-            s.sendall(f"{OK}".encode('utf-8'))
+    _report_bulk("[📩] Received", count, total, time.monotonic() - start)
 
-        s.sendall(f"{OK}".encode('utf-8'))
-        
-    s.sendall(f"{OK}".encode('utf-8'))
\ No newline at end of file
+# Function to print the throughput of a bulk transfer
+def _report_bulk(action: str, files: int, total: int, elapsed: float):
+    if files == 0:
+        return
+    rate = total / elapsed / (1024 * 1024) if elapsed > 0 else 0
+    print(f"{action} {files} bins, {total} bytes in {elapsed:.2f}s ({rate:.2f} MB/s)")
\ No newline at end of file
@@ -0,0 +1,19 @@
+from const import *
+
+# A physical node runs its first virtual node under its ip and the k-th under 'ip#k'.
+# That name is its identity on the ring (its id is the hash of it) and the k-th one
+# listens on every base port shifted by k * DEFAULT_VNODE_PORT_STEP
+
+
+# Function to get the name of the k-th virtual node of a host
+def vnode_name(ip: str, k: int) -> str:
+    return ip if k == 0 else f"{ip}#{k}"
+
+# Function to get the host of a node name
+def host_of(name: str) -> str:
+    return name.split('#', 1)[0]
+
+# Function to get the (host, port) a node name listens on for a base port
+def endpoint(name: str, port: int) -> tuple[str, int]:
+    host, _, k = name.partition('#')
+    return host, port + DEFAULT_VNODE_PORT_STEP * int(k or 0)
@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import time
+import threading
+from typing import Iterable
+from const import *
+
+
+class PostingList(dict):
+    """Posting list of a key, an insertion ordered set kept as the keys of a dict, so adding,
+    removing or looking up a value does not depend on the length of the list"""
+
+    def __init__(self, values: Iterable[str] = ()):
+        super().__init__(dict.fromkeys(values))
+
+    def add(self, value: str):
+        self[value] = None
+
+    def remove(self, value: str):
+        """Removes value, raising ValueError like a list if it is missing"""
+        try:
+            del self[value]
+        except KeyError:
+            raise ValueError(f"{value} not in posting list") from None
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+# Function to apply a log record [seq, table, op, key, value] to the tables
+def apply_record(tables: dict[str, dict], record: list):
+    _, name, op, key, value = record
+    table = tables[name]
+    if op == 'put':
+        table[key] = PostingList(value)
+    elif op == 'del':
+        del table[key]
+    elif op == 'add':
+        table[key].add(value)
+    elif op == 'rm':
+        table[key].remove(value)
+    elif op == 'discard':
+        table[key].remove(value)
+        if not table[key]:
+            del table[key]
+    elif op == 'merge':
+        table.update((k, PostingList(v)) for k, v in value.items())
+    elif op == 'reset':
+        table.clear()
+        table.update((k, PostingList(v)) for k, v in value.items())
+    else:
+        raise ValueError(f"Unknown log op {op}")
+
+# Function to copy the value of a record as plain lists, so it serializes and shares nothing with the tables
+def plain_value(op: str, value):
+    if op == 'put':
+        return list(value)
+    if op in ('merge', 'reset'):
+        return {k: list(v) for k, v in list(value.items())}
+    return value
+
+
+class MetadataLog:
+    """Append-only log of the mutations of the database tables, a write costs one short
+    record whatever the size of the tables.
+
+    Mutations are applied to the tables at once and their records buffered, a background
+    flusher writes the buffer to the active segment wal-<seq>.log (named after its first
+    record) every DEFAULT_FLUSH_MAX_DELAY seconds, or as soon as DEFAULT_FLUSH_MAX_PENDING
+    records are waiting, so a burst of writes shares one write and one sync. flush() is
+    the barrier for callers that need their records on disk. The fsync policy applies to
+    these group commits, even under 'always' a write is only durable once the group it
+    belongs to is committed, not when append() returns.
+
+    Once DEFAULT_WAL_SNAPSHOT_EVERY records were appended the flusher starts a new segment,
+    writes the tables to snapshot.json and deletes the older segments. The snapshot stores
+    the seq of the last record it holds, so a replay skips those records even if the
+    compaction was cut before deleting their segment."""
+
+    def __init__(self, dir_path: str, tables: dict[str, dict], fsync: str = DEFAULT_WAL_FSYNC):
+        self.dir_path = dir_path
+        self.snapshot_path = f"{dir_path}/snapshot.json"
+        self.tables = tables
+        self.fsync = fsync
+        self.lock = threading.Lock()        # Tables, seq and buffer
+        self.io_lock = threading.Lock()     # Active segment, taken before lock
+        self.wake = threading.Event()
+
+        self.seq = 0            # Seq of the last record appended
+        self.file = None        # Active segment
+        self.buffer: list[str] = []     # Records not written to the segment yet
+        self.pending = 0        # Records appended since the last snapshot
+        self.dirty = False      # Records written but not synced yet
+        self.last_sync = time.monotonic()
+
+        # Counters
+        self.commits = 0
+        self.syncs = 0
+        self.snapshots = 0
+
+        threading.Thread(target=self._background, daemon=True).start()
+
+    def append(self, table: str, op: str, key: str = None, value=None):
+        """Applies a mutation to a table and buffers its record"""
+        value = plain_value(op, value)
+        with self.lock:
+            record = [self.seq + 1, table, op, key, value]
+            apply_record(self.tables, record)
+            self.seq += 1
+            self.buffer.append(json.dumps(record) + '\n')
+            self.pending += 1
+            if len(self.buffer) >= DEFAULT_FLUSH_MAX_PENDING or self.pending >= DEFAULT_WAL_SNAPSHOT_EVERY:
+                self.wake.set()
+
+    def flush(self):
+        """Writes every record appended so far, synced to disk unless the policy is 'never'"""
+        self._commit(sync=self.fsync != 'never')
+
+    def load(self):
+        """Replays the snapshot and the segments after it into the tables"""
+        with self.io_lock, self.lock:
+            if os.path.isfile(self.snapshot_path):
+                with open(self.snapshot_path) as json_file:
+                    snapshot = json.load(json_file)
+                self.seq = snapshot['seq']
+                for name, table in snapshot['tables'].items():
+                    self.tables[name].clear()
+                    self.tables[name].update((k, PostingList(v)) for k, v in table.items())
+
+            replayed = 0
+            for _, path in self._segments():
+                with open(path) as segment:
+                    for line in segment:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break       # Torn tail of a segment cut by a crash
+                        if record[0] <= self.seq:
+                            continue
+                        apply_record(self.tables, record)
+                        self.seq = record[0]
+                        replayed += 1
+
+            self.pending = replayed
+            self._open_segment()
+        print(f"[💾] Replayed {replayed} log records up to {self.seq}")
+
+    def reset(self):
+        """Drops the snapshot and every segment, and starts over from the current tables"""
+        with self.io_lock, self.lock:
+            for _, path in self._segments():
+                os.remove(path)
+            self.seq = 0
+            self.buffer = []
+        self.snapshot()
+
+    def snapshot(self):
+        """Writes the tables to the snapshot and deletes the segments it covers"""
+        # Switching segments and copying the tables are the only steps that block writers
+        with self.io_lock, self.lock:
+            seq = self.seq
+            tables = {name: {k: list(v) for k, v in table.items()} for name, table in self.tables.items()}
+            self._open_segment()
+            self.pending = 0
+
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump({'seq': seq, 'tables': tables}, json_file, indent=4)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        for start, path in self._segments():
+            if start <= seq:
+                os.remove(path)
+        self.snapshots += 1
+
+    def _commit(self, sync: bool = False):
+        """Writes the buffered records to the active segment, syncing it if sync or the policy asks for it.
+        Writers keep appending to a new buffer meanwhile"""
+        with self.io_lock:
+            # Nowhere to write them before a segment is open, the records stay buffered
+            if self.file is None:
+                return
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+            if lines:
+                self.file.write(''.join(lines))
+                self.file.flush()
+                self.dirty = True
+                self.commits += 1
+            if self.dirty and (sync or self.fsync == 'always' or
+                               (self.fsync == 'interval' and time.monotonic() - self.last_sync >= DEFAULT_WAL_FSYNC_INTERVAL)):
+                os.fsync(self.file.fileno())
+                self.dirty = False
+                self.last_sync = time.monotonic()
+                self.syncs += 1
+
+    def _open_segment(self):
+        """Writes the buffer to the active segment, closes it and opens the one starting at the next record
+        (must hold io_lock and lock)"""
+        if self.file:
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.buffer = []
+        self.file = open(f"{self.dir_path}/wal-{self.seq + 1}.log", 'w')
+        self.dirty = False
+
+    def _segments(self) -> list[tuple[int, str]]:
+        """Returns the (first seq, path) of every segment on disk, in order"""
+        segments = []
+        for name in os.listdir(self.dir_path):
+            match = re.fullmatch(r'wal-(\d+)\.log', name)
+            if match:
+                segments.append((int(match.group(1)), f"{self.dir_path}/{name}"))
+        return sorted(segments)
+
+    def _background(self):
+        while True:
+            self.wake.wait(DEFAULT_FLUSH_MAX_DELAY)
+            self.wake.clear()
+            try:
+                if self.pending >= DEFAULT_WAL_SNAPSHOT_EVERY:
+                    self.snapshot()
+                else:
+                    self._commit()
+            except Exception as e:
+                print(f"[💾] Log maintenance failed: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'seq': self.seq,
+                'buffered': len(self.buffer),
+                'pending': self.pending,
+                'commits': self.commits,
+                'syncs': self.syncs,
+                'snapshots': self.snapshots,
+                'fsync': self.fsync,
+            }